@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+
+"""
+Objective
+  Compare neighbour lookups of the indexed routing table with the table
+  traversal previously monkey patched into kademlia.
+
+Method
+  Fill routing tables with random contacts and time findNeighbors for
+  random targets. The traversal stops after the first k contacts of the
+  nearest buckets, so its accuracy against the exact result is shown too.
+
+Usage
+  python experiments/routingbench.py [contacts ...]
+"""
+
+
+import os
+import sys
+import time
+import heapq
+import operator
+from kademlia.node import Node
+from kademlia.routing import TableTraverser
+from storjnode.network.routing import StorjRoutingTable
+
+
+K = 20
+LOOKUPS = 1000
+
+
+class MockProtocol(object):
+
+    def callPing(self, node):
+        pass
+
+
+def traverse_nearest(table, node, k=None, exclude=None):
+    k = k or table.ksize
+    nodes = []
+    for neighbor in TableTraverser(table, node):
+        if exclude is None or not neighbor.sameHomeAs(exclude):
+            heapq.heappush(nodes, (node.distanceTo(neighbor), neighbor))
+        if len(nodes) == k:
+            break
+    return list(map(operator.itemgetter(1), heapq.nsmallest(k, nodes)))
+
+
+def create_table(count):
+    # large buckets so the table keeps all contacts
+    table = StorjRoutingTable(MockProtocol(), count, Node(os.urandom(20)))
+    for i in range(count):
+        table.addContact(Node(os.urandom(20), "127.0.0.1", i))
+    return table
+
+
+def bench(name, find, targets):
+    start = time.time()
+    results = [find(target) for target in targets]
+    elapsed = time.time() - start
+    msg = "  {0:<10} {1:8.1f} us/lookup"
+    print(msg.format(name, elapsed / len(targets) * 1000000))
+    return results
+
+
+def main(counts):
+    for count in counts:
+        table = create_table(count)
+        targets = [Node(os.urandom(20)) for i in range(LOOKUPS)]
+        print("{0} contacts, k = {1}".format(len(table._ids), K))
+        indexed = bench("indexed", lambda t: table.findNeighbors(t, k=K),
+                        targets)
+        traversed = bench("traversal",
+                          lambda t: traverse_nearest(table, t, k=K), targets)
+        exact = sum(a == b for a, b in zip(indexed, traversed))
+        print("  traversal exact for {0}/{1} lookups".format(exact, LOOKUPS))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000])
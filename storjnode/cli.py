@@ -1,3 +1,4 @@
+import os
 import time
 import binascii
 import argparse
@@ -7,6 +8,8 @@ import sys
 import pprint
 from storjnode.network import WALK_TIMEOUT
 from storjnode.storage.manager import DEFAULT_STORE_PATH
+from storjnode.network.storage import SqliteStorage
+from storjnode.common import STORJ_HOME
 from pyp2p.unl import UNL
 from crochet import setup, TimeoutError
 setup()  # start twisted via crochet
@@ -38,6 +41,15 @@ def _add_programm_args(parser):
     parser.add_argument("--storage_path", default=default,
                         help=msg.format(default))
 
+    msg = ("Keep DHT values in a database at the given path, so they "
+           "survive restarts. Kept in memory by default.")
+    parser.add_argument("--dht_storage_path", default=None, help=msg)
+
+    default = os.path.join(STORJ_HOME, "routing_table.json")
+    msg = "Where to save known peers for faster restarts, default: {0}."
+    parser.add_argument("--routing_table_path", default=default,
+                        help=msg.format(default))
+
     default = None
     msg = "Optional skip DHT bootstrap."
     parser.add_argument("--bootstrap", default=default,
@@ -331,6 +343,10 @@ def setup_node(args):
     node_type = args["node_type"] or "unknown"
     nat_type = args["nat_type"] or "unknown"
 
+    dht_storage = None
+    if args["dht_storage_path"] is not None:
+        dht_storage = SqliteStorage(args["dht_storage_path"])
+
     return storjnode.network.Node(
         node_key, port=udp_port, bootstrap_nodes=bootstrap_nodes,
         refresh_neighbours_interval=WALK_TIMEOUT,
@@ -338,7 +354,9 @@ def setup_node(args):
         passive_bind=passive_bind,
         node_type=node_type,
         nat_type=nat_type,
-        store_config=store_config
+        store_config=store_config,
+        dht_storage=dht_storage,
+        routing_table_path=args["routing_table_path"]
     )
 
 
@@ -357,9 +375,12 @@ def main(args):
 
     # setup
     node = setup_node(args)
-    if args["skip_dht_bootstrap"] is None:
-        print("Waiting %fsec to find peers ..." % WALK_TIMEOUT)
-        time.sleep(WALK_TIMEOUT)
+    if not args["skip_dht_bootstrap"]:
+        print("Waiting up to %fsec to find peers ..." % WALK_TIMEOUT)
+        try:
+            print("Found {0} peers.".format(node.sync_wait_ready()))
+        except TimeoutError:
+            print("Timeout error, continuing without peers!")
 
     # run command
     {
@@ -1,6 +1,29 @@
+import hmac
+import struct
+import hashlib
+import itertools
+import multiprocessing
 from hashlib import md5
 from Crypto import Random
 from Crypto.Cipher import AES
+from Crypto.Util.strxor import strxor
+
+
+SEGMENT_MAGIC = b"StorjSEG"
+SEGMENT_VERSION = 1
+DEFAULT_SEGMENT_SIZE = 1024 * 1024  # plaintext bytes per segment
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_KDF_ITERATIONS = 100000
+MAX_KDF_ITERATIONS = 10000000
+
+
+_HEADER = struct.Struct(">8sBII16s")  # magic, version, size, iterations, salt
+_TAG_SIZE = 32
+_counter_blocks = [b""]  # cached counter blocks shared by all segments
+
+
+class AuthenticationError(Exception):
+    pass
 
 
 def _chr(i):
@@ -65,6 +88,8 @@ def symmetric_decrypt(in_file, out_file, password, key_length=32):
 
     Equivalent to `openssl aes-256-cbc -d -in in_file.enc -out out_file`
 
+    Output of segmented_encrypt is detected and decrypted as well.
+
     Arguments:
         in_file: Input file like object.
         out_file: Output file like object.
@@ -86,9 +111,14 @@ def symmetric_decrypt(in_file, out_file, password, key_length=32):
     assert(isinstance(password, bytes))
     assert(isinstance(key_length, int))
 
-    # decrypt
+    # segmented files are detected by their header
     bs = AES.block_size
-    salt = in_file.read(bs)[len(b'Salted__'):]
+    head = in_file.read(bs)
+    if head.startswith(SEGMENT_MAGIC):
+        return _segmented_decrypt(head, in_file, out_file, password, 1)
+
+    # decrypt
+    salt = head[len(b'Salted__'):]
     key, iv = _derive_key_and_iv(password, salt, key_length, bs)
     cipher = AES.new(key, AES.MODE_CBC, iv)
     next_chunk = b''
@@ -100,3 +130,169 @@ def symmetric_decrypt(in_file, out_file, password, key_length=32):
             chunk = chunk[:-padding_length]
             finished = True
         out_file.write(chunk)
+
+
+def segmented_encrypt(in_file, out_file, password,
+                      segment_size=DEFAULT_SEGMENT_SIZE, workers=1,
+                      iterations=DEFAULT_KDF_ITERATIONS):
+    """ Authenticated aes encryption in independent segments.
+
+    The input is split into segments of segment_size bytes, each encrypted
+    with AES-256-CTR and authenticated with a truncated HMAC-SHA512 tag.
+    Segments do not depend on each other, so they are processed in parallel
+    by the given number of worker processes. Keys are derived from the
+    password with PBKDF2-HMAC-SHA256.
+
+    Arguments:
+        in_file: Input file like object.
+        out_file: Output file like object.
+        password: Secure encryption password.
+        segment_size: Plaintext bytes per segment.
+        workers: Number of processes encrypting segments.
+        iterations: PBKDF2 iterations.
+
+    Example:
+        > from storjnode import encryptedio
+        > with open("in_file", 'rb') as fi, open("out_file.enc", 'wb') as fo:
+        >     encryptedio.segmented_encrypt(fi, fo, b"secure_password")
+    """
+    assert(isinstance(password, bytes))
+    assert(0 < segment_size <= MAX_SEGMENT_SIZE)
+    assert(0 < iterations <= MAX_KDF_ITERATIONS)
+    assert(workers > 0)
+
+    salt = Random.new().read(16)
+    header = _HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, segment_size,
+                          iterations, salt)
+    enc_key, mac_key = _derive_segment_keys(password, salt, iterations)
+    out_file.write(header)
+    tasks = ((enc_key, mac_key, header, index, final, data)
+             for index, final, data in _read_segments(in_file, segment_size))
+    _map_segments(_encrypt_segment, tasks, out_file, workers)
+
+
+def segmented_decrypt(in_file, out_file, password, workers=1):
+    """ Decrypt and authenticate the output of segmented_encrypt.
+
+    Segments are written once authenticated, if an error is raised the
+    output written so far must be discarded.
+
+    Arguments:
+        in_file: Input file like object.
+        out_file: Output file like object.
+        password: Secure encryption password.
+        workers: Number of processes decrypting segments.
+
+    Raises:
+        ValueError: if the input has no valid header
+        storjnode.encryptedio.AuthenticationError: if the password is
+        wrong or the input was modified or truncated
+    """
+    assert(isinstance(password, bytes))
+    assert(workers > 0)
+    _segmented_decrypt(b"", in_file, out_file, password, workers)
+
+
+def _segmented_decrypt(head, in_file, out_file, password, workers):
+    header = head + _read_full(in_file, _HEADER.size - len(head))
+    if len(header) != _HEADER.size:
+        raise ValueError("Incomplete header!")
+    magic, version, segment_size, iterations, salt = _HEADER.unpack(header)
+    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+        raise ValueError("Unsupported format!")
+    if not (0 < segment_size <= MAX_SEGMENT_SIZE and
+            0 < iterations <= MAX_KDF_ITERATIONS):
+        raise ValueError("Invalid header!")
+
+    enc_key, mac_key = _derive_segment_keys(password, salt, iterations)
+    segments = _read_segments(in_file, segment_size + _TAG_SIZE)
+    tasks = ((enc_key, mac_key, header, index, final, data)
+             for index, final, data in segments)
+    _map_segments(_decrypt_segment, tasks, out_file, workers)
+
+
+def _derive_segment_keys(password, salt, iterations):
+    keys = hashlib.pbkdf2_hmac("sha256", password, salt, iterations, 64)
+    return keys[:32], keys[32:]
+
+
+def _read_full(in_file, size):
+    # file like objects may return less than requested before the end
+    data = in_file.read(size)
+    while 0 < len(data) < size:
+        chunk = in_file.read(size - len(data))
+        if len(chunk) == 0:
+            break
+        data += chunk
+    return data
+
+
+def _read_segments(in_file, size):
+    """Yields (index, final, data), the last segment is final."""
+    data = _read_full(in_file, size)
+    for index in itertools.count():
+        following = _read_full(in_file, size) if len(data) == size else b""
+        final = len(following) == 0
+        yield index, final, data
+        if final:
+            return
+        data = following
+
+
+def _crypt_segment(enc_key, index, data):
+    # CTR mode with a key per segment, so all segments share the same
+    # counter blocks and a segment is encrypted with a single ECB call.
+    if len(data) == 0:
+        return data
+    key = hmac.new(enc_key, struct.pack(">Q", index), hashlib.sha256).digest()
+    size = (len(data) + 15) // 16 * 16
+    if len(_counter_blocks[0]) < size:
+        _counter_blocks[0] = b"".join(struct.pack(">QQ", 0, i)
+                                      for i in range(size // 16))
+    keystream = AES.new(key, AES.MODE_ECB).encrypt(_counter_blocks[0][:size])
+    return strxor(data, keystream[:len(data)])
+
+
+def _tag(mac_key, header, index, final, ciphertext):
+    # header, position and final flag are authenticated so segments
+    # cannot be reordered, dropped or moved to other files
+    mac = hmac.new(mac_key, header + struct.pack(">QB", index, final),
+                   hashlib.sha512)
+    mac.update(ciphertext)
+    return mac.digest()[:_TAG_SIZE]
+
+
+def _encrypt_segment(task):
+    enc_key, mac_key, header, index, final, data = task
+    ciphertext = _crypt_segment(enc_key, index, data)
+    return ciphertext + _tag(mac_key, header, index, final, ciphertext)
+
+
+def _decrypt_segment(task):
+    enc_key, mac_key, header, index, final, segment = task
+    if len(segment) < _TAG_SIZE:
+        raise AuthenticationError("Truncated segment {0}!".format(index))
+    ciphertext, tag = segment[:-_TAG_SIZE], segment[-_TAG_SIZE:]
+    if not hmac.compare_digest(tag, _tag(mac_key, header, index, final,
+                                         ciphertext)):
+        raise AuthenticationError("Invalid segment {0}!".format(index))
+    return _crypt_segment(enc_key, index, ciphertext)
+
+
+def _map_segments(func, tasks, out_file, workers):
+    if workers == 1:
+        for task in tasks:
+            out_file.write(func(task))
+        return
+
+    # a few segments per worker at a time to bound memory use
+    pool = multiprocessing.Pool(workers)
+    try:
+        batch = list(itertools.islice(tasks, workers * 2))
+        while len(batch) > 0:
+            for result in pool.map(func, batch):
+                out_file.write(result)
+            batch = list(itertools.islice(tasks, workers * 2))
+    finally:
+        pool.terminate()
+        pool.join()
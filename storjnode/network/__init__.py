@@ -1,7 +1,14 @@
 from . import api  # NOQA
+from . import cache  # NOQA
 from . import file_transfer  # NOQA
+from . import multiplex  # NOQA
+from . import nodeid  # NOQA
 from . import protocol  # NOQA
+from . import refresh  # NOQA
+from . import routing  # NOQA
 from . import server  # NOQA
+from . import storage  # NOQA
+from . import swarm  # NOQA
 from . import map  # NOQA
 from . api import Node  # NOQA
 from . api import DEFAULT_BOOTSTRAP_NODES  # NOQA
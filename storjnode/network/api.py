@@ -1,4 +1,3 @@
-import time
 import threading
 import binascii
 import random
@@ -6,13 +5,15 @@ import logging
 import storjnode
 from btctxstore import BtcTxStore
 from crochet import wait_for, run_in_reactor
-from twisted.internet.task import LoopingCall
+from twisted.internet import defer
 from storjnode.util import valid_ip
 from storjnode.network.server import StorjServer, QUERY_TIMEOUT, WALK_TIMEOUT
+from storjnode.network.server import READY_MIN_PEERS
+from storjnode.network.cache import ValueCache, DEFAULT_TTL
 
 
 # File transfer.
-from storjnode.network.file_transfer import FileTransfer, process_transfers
+from storjnode.network.file_transfer import FileTransfer, TransferEngine
 from pyp2p.net import Net
 from pyp2p.dht_msg import DHT as SimDHT
 
@@ -47,6 +48,8 @@ class Node(object):
                  key, ksize=20, port=None, bootstrap_nodes=None,
                  dht_storage=None, max_messages=1024,
                  refresh_neighbours_interval=WALK_TIMEOUT,
+                 dht_cache_size=0, dht_cache_ttl=DEFAULT_TTL,
+                 routing_table_path=None,
 
                  # data transfer args
                  disable_data_transfer=True, store_config=None,
@@ -65,6 +68,10 @@ class Node(object):
             dht_storage: implements :interface:`~kademlia.storage.IStorage`
             max_messages (int): Max unprecessed messages, additional dropped.
             refresh_neighbours_interval (float): Auto refresh neighbours.
+            dht_cache_size (int): Max DHT values cached, 0 disables cache.
+            dht_cache_ttl (float): Seconds DHT values are cached.
+            routing_table_path: Save routing table to bootstrap from on
+                                restart, not saved by default.
 
             disable_data_transfer: Disable data transfer for this node.
             store_config: Dict of storage paths to optional attributes.
@@ -79,6 +86,9 @@ class Node(object):
             wan_ip: TODO doc string
         """
         self.disable_data_transfer = bool(disable_data_transfer)
+        self.dht_cache = None
+        if dht_cache_size > 0:
+            self.dht_cache = ValueCache(size=dht_cache_size, ttl=dht_cache_ttl)
         self._transfer_request_handlers = set()
         self._transfer_complete_handlers = set()
 
@@ -116,7 +126,8 @@ class Node(object):
 
         # start services
         self._setup_server(key, ksize, dht_storage, max_messages,
-                           refresh_neighbours_interval, bootstrap_nodes)
+                           refresh_neighbours_interval, bootstrap_nodes,
+                           routing_table_path)
 
         if not self.disable_data_transfer:
             self._setup_data_transfer_client(
@@ -135,13 +146,21 @@ class Node(object):
         self._message_dispatcher_thread.start()
 
     def _setup_server(self, key, ksize, storage, max_messages,
-                      refresh_neighbours_interval, bootstrap_nodes):
+                      refresh_neighbours_interval, bootstrap_nodes,
+                      routing_table_path):
         self.server = StorjServer(
             key, ksize=ksize, storage=storage, max_messages=max_messages,
-            refresh_neighbours_interval=refresh_neighbours_interval
+            refresh_neighbours_interval=refresh_neighbours_interval,
+            routing_table_path=routing_table_path
         )
         self.server.listen(self.port)
-        self.server.bootstrap(bootstrap_nodes)
+        self._bootstrap(bootstrap_nodes)
+
+    @run_in_reactor
+    def _bootstrap(self, bootstrap_nodes):
+        # Requests must be sent from the reactor thread, else replies can
+        # arrive before they are registered and are dropped.
+        return self.server.bootstrap(bootstrap_nodes)
 
     def _setup_data_transfer_client(self, store_config, passive_port,
                                     passive_bind, node_type, nat_type, wan_ip):
@@ -170,15 +189,19 @@ class Node(object):
 
         # Setup success callback values.
         self._data_transfer.success_value = (self.sync_get_wan_ip(), self.port)
+        self._transfer_engine = TransferEngine(self._data_transfer)
         self.process_data_transfers()
 
     def stop(self):
         """Stop storj node."""
         self._message_dispatcher_thread_stop = True
+        self.server.wake_message_waiters()
         self._message_dispatcher_thread.join()
         self.server.stop()
         if not self.disable_data_transfer:
+            self._stop_data_transfers()
             self._data_transfer.net.stop()
+            self._data_transfer.handles.close_all()
 
     ##################
     # node interface #
@@ -187,6 +210,31 @@ class Node(object):
     def refresh_neighbours(self):
         self.server.refresh_neighbours()
 
+    def is_ready(self, min_peers=READY_MIN_PEERS):
+        """Returns True once the node knows min_peers or has bootstrapped."""
+        return self.server.is_ready(min_peers=min_peers)
+
+    def async_wait_ready(self, min_peers=READY_MIN_PEERS):
+        """Wait until the node knows min_peers or has bootstrapped.
+
+        Returns:
+            A twisted.internet.defer.Deferred that resloves to the number
+            of known peers once ready.
+        """
+        return self.server.when_ready(min_peers=min_peers)
+
+    @wait_for(timeout=WALK_TIMEOUT)
+    def sync_wait_ready(self, min_peers=READY_MIN_PEERS):
+        """Wait until the node knows min_peers or has bootstrapped.
+
+        Returns:
+            The number of known peers once ready.
+
+        Raises:
+            crochet.TimeoutError after storjnode.network.server.WALK_TIMEOUT
+        """
+        return self.async_wait_ready(min_peers=min_peers)
+
     def get_known_peers(self):
         """Returns list of hex encoded node ids."""
         peers = list(self.server.get_known_peers())
@@ -273,9 +321,11 @@ class Node(object):
         if self.disable_data_transfer:
             raise Exception("Data transfer disabled!")
 
-        time.sleep(5)  # Give enough time to copy UNL.
-        LoopingCall(process_transfers, self._data_transfer).start(0.002,
-                                                                  now=True)
+        self._transfer_engine.start()
+
+    @wait_for(timeout=QUERY_TIMEOUT)
+    def _stop_data_transfers(self):
+        self._transfer_engine.stop()
 
     ###########################
     # data transfer interface #
@@ -320,6 +370,27 @@ class Node(object):
         """
         self.async_request_data_transfer(data_id, peer_unl, direction)
 
+    def async_request_data_swarm(self, data_id, peer_unls, file_size):
+        """Download data from several peers at once.
+
+        Byte ranges of the data are requested from all peers, with more
+        requested from faster peers, and the data is verified once complete.
+
+        Args:
+            data_id: The sha256 sum of the data to be transfered.
+            peer_unls: The node UNLs of the peers storing the data.
+            file_size: The size of the data in bytes.
+
+        Returns:
+            A twisted.internet.defer.Deferred that resloves to
+            own transport address (ip, port) if successfull else None
+
+        Raises:
+            TransferError: If the data not transfered from any peer.
+        """
+        return self._data_transfer.swarm_data_request(data_id, peer_unls,
+                                                      file_size)
+
     def add_transfer_request_handler(self, handler):
         """Add an allow transfer request handler.
 
@@ -381,27 +452,31 @@ class Node(object):
     # network utilities #
     #####################
 
-    def async_map_network(self, outfile=None, attempts=2):
+    def async_map_network(self, outfile=None, attempts=2, resume=None):
         """Create a map of the network.
 
-        Output to outfile:
-            {
-                ID : {"transport": (ip, address), "neighbours": [ID, ...]},
-            }
+        Nodes are written to outfile as soon as scanned, a line each:
+            {"id": ID, "transport": [ip, port],
+             "neighbours": [[ID, ip, port], ...], "reached": bool}
 
         Args:
             outfile: A file like object to write mapping data to.
             attempts: How often to attempt to contact each node.
+            resume: A file like object with the output of an interrupted
+                    crawl to continue. Resumed nodes are not written to
+                    outfile again, so append to the same file.
 
         Returns:
             A twisted.internet.defer.Deferred that resloves to
             (num_nodes_found, num_nodes_unreached)
         """
-        return self.server.map_network(outfile=outfile, attempts=attempts)
+        return self.server.map_network(outfile=outfile, attempts=attempts,
+                                       resume=resume)
 
     @wait_for(timeout=WALK_TIMEOUT*20)
-    def sync_map_network(self, outfile=None, attempts=3):
-        return self.async_map_network(outfile=outfile, attempts=attempts)
+    def sync_map_network(self, outfile=None, attempts=3, resume=None):
+        return self.async_map_network(outfile=outfile, attempts=attempts,
+                                      resume=resume)
 
     #######################
     # messaging interface #
@@ -475,10 +550,9 @@ class Node(object):
 
     def _message_dispatcher_loop(self):
         while not self._message_dispatcher_thread_stop:
-            for received in self.server.get_messages():
+            for received in self.server.wait_for_messages():
                 for handler in self._message_handlers:
                     self._dispatch_message(received, handler)
-            time.sleep(0.05)
 
     def add_message_handler(self, handler):
         """Add message handler to be call when a message is received.
@@ -516,15 +590,88 @@ class Node(object):
             None if not found, the value otherwise.
         """
         # FIXME return default if not found (add to kademlia)
+        if self.dht_cache is not None:
+            value = self.dht_cache.get(key)
+            if value is not None:
+                return defer.succeed(value)
+            generation = self.dht_cache.generation()
+            d = self.server.get(key)
+            return d.addCallback(self._cache_value, key, generation)
         return self.server.get(key)
 
+    def _cache_value(self, value, key, generation):
+        # not cached if set locally while the lookup was in flight
+        self.dht_cache.set(key, value, generation=generation)
+        return value
+
+    def _invalidate_cached(self, result, keys):
+        for key in keys:
+            self.dht_cache.invalidate(key)
+        return result
+
     def async_set(self, key, value):
         """Set the given key to the given value in the network.
 
         Returns:
             A twisted.internet.defer.Deferred that resloves when set.
         """
-        self.server.set(key, value)
+        if self.dht_cache is not None:
+
+            # also invalidate on completion, in case a get started while
+            # setting cached the old value
+            self._invalidate_cached(None, [key])
+            d = self.server.set(key, value)
+            return d.addBoth(self._invalidate_cached, [key])
+        return self.server.set(key, value)
+
+    def async_get_many(self, keys, default=None):
+        """Get several keys at once, the lookups run concurrently.
+
+        Returns:
+            A twisted.internet.defer.Deferred that resloves to a dict
+            {key: value} with default for keys not found.
+        """
+        keys = set(keys)
+        cached = {}
+        generation = None
+        if self.dht_cache is not None:
+            generation = self.dht_cache.generation()
+            for key in keys:
+                value = self.dht_cache.get(key)
+                if value is not None:
+                    cached[key] = value
+
+        def handle(values):
+            if self.dht_cache is not None:
+                for key, value in values.items():
+                    self._cache_value(value, key, generation)
+            values.update(cached)
+            return dict((k, default if v is None else v)
+                        for k, v in values.items())
+
+        missing = keys.difference(cached)
+        d = self.server.get_many(missing) if missing else defer.succeed({})
+        return d.addCallback(handle)
+
+    def async_set_many(self, items):
+        """Set several keys at once, the lookups run concurrently.
+
+        All lookups run at once, so setting many keys takes about as long
+        as setting one.
+
+        Args:
+            items: Dict or iterable of (key, value) pairs.
+
+        Returns:
+            A twisted.internet.defer.Deferred that resloves to a dict
+            {key: True if set else False}.
+        """
+        if self.dht_cache is not None:
+            items = dict(items)
+            self._invalidate_cached(None, items.keys())
+            d = self.server.set_many(items)
+            return d.addBoth(self._invalidate_cached, list(items.keys()))
+        return self.server.set_many(items)
 
     ###############################
     # blocking DHT dict interface #
@@ -546,7 +693,25 @@ class Node(object):
         Raises:
             crochet.TimeoutError after storjnode.network.server.WALK_TIMEOUT
         """
-        self.async_set(key, value)
+        return self.async_set(key, value)
+
+    @wait_for(timeout=WALK_TIMEOUT)
+    def sync_get_many(self, keys, default=None):
+        """Get several keys at once, see async_get_many.
+
+        Raises:
+            crochet.TimeoutError after storjnode.network.server.WALK_TIMEOUT
+        """
+        return self.async_get_many(keys, default=default)
+
+    @wait_for(timeout=WALK_TIMEOUT)
+    def sync_set_many(self, items):
+        """Set several keys at once, see async_set_many.
+
+        Raises:
+            crochet.TimeoutError after storjnode.network.server.WALK_TIMEOUT
+        """
+        return self.async_set_many(items)
 
     def __getitem__(self, key):
         """x.__getitem__(y) <==> x[y]"""
@@ -569,9 +734,11 @@ class Node(object):
 
     def setdefault(self, key, default=None):
         """D.setdefault(k[,d]) -> D.get(k,d), also set D[k]=d if k not in D"""
-        if key not in self:
+        value = self.get(key)
+        if value is None:
             self[key] = default
-        return self[key]
+            return default
+        return value
 
     def update(self, e=None, **f):
         """D.update([e, ]**f) -> None.  Update D from dict/iterable e and f.
@@ -579,11 +746,12 @@ class Node(object):
         If e present and lacks .keys() method, does: for (k, v) in e: D[k] = v
         In either case, this is followed by: for k in f: D[k] = f[k]
         """
+        items = {}
         if e and "keys" in dir(e):
             for k in e:
-                self[k] = e[k]
-        else:
+                items[k] = e[k]
+        elif e:
             for (k, v) in e:
-                self[k] = v
-        for k in f:
-            self[k] = f[k]
+                items[k] = v
+        items.update(f)
+        self.sync_set_many(items)
@@ -0,0 +1,112 @@
+"""
+Bounded cache of DHT values read from the network.
+
+Entries expire after a time to live so values changed by other nodes are
+seen eventually, the least recently used entries are evicted when full.
+
+Lookups can finish after the key was set locally, so readers take a
+generation before looking up a value and only cache it if the key was not
+invalidated since.
+"""
+
+import time
+import threading
+import collections
+
+
+DEFAULT_SIZE = 1024  # max cached values
+DEFAULT_TTL = 60.0  # seconds values are cached
+
+
+class ValueCache(object):
+
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        """Create a value cache.
+
+        Args:
+            size (int): Max cached values, least recently used evicted.
+            ttl (float): Seconds until a cached value expires.
+        """
+        assert(size > 0)
+        assert(ttl > 0)
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # key -> (expires, value)
+        self._generation = 0  # incremented by every invalidation
+        self._invalidated = collections.OrderedDict()  # key -> generation
+        self._forgotten = 0  # newest generation dropped from _invalidated
+        self._mutex = threading.RLock()
+
+    def generation(self):
+        """Returns the current generation, to pass to set later."""
+        with self._mutex:
+            return self._generation
+
+    def get(self, key):
+        """Returns the cached value of key or None if not cached."""
+        with self._mutex:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return None
+
+            # move to most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, generation=None):
+        """Cache value of key, None values are not cached.
+
+        Args:
+            key: The key of the value.
+            value: The value to cache.
+            generation: From generation() before the value was read, it is
+                        not cached if the key was invalidated since.
+        """
+        if value is None:
+            return
+        with self._mutex:
+            if generation is not None:
+                invalidated = self._invalidated.get(key, self._forgotten)
+                if invalidated > generation:
+                    return  # value may be older than the invalidation
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove key from the cache."""
+        with self._mutex:
+            self._entries.pop(key, None)
+            self._generation += 1
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = self._generation
+
+            # forget the oldest invalidations, treat unknown keys as recent
+            while len(self._invalidated) > self.size:
+                oldest = self._invalidated.popitem(last=False)
+                self._forgotten = oldest[1]
+
+    def clear(self):
+        """Remove all keys from the cache."""
+        with self._mutex:
+            self._entries.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._forgotten = self._generation
+
+    def stats(self):
+        """Returns dict with the hits, misses and size of the cache."""
+        with self._mutex:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries)
+            }
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,6 +1,5 @@
 """
 Issues:
-    * Delete con_info and con_transfers when con is closed
     * Should contract also be deleted when its transfered? Prob
     * To do: add a clean up routine based on old cons
 
@@ -11,19 +10,25 @@ import pyp2p.unl
 import pyp2p.net
 import pyp2p.dht_msg
 import logging
+import storjnode.util
 import storjnode.storage as storage
+from storjnode.network.multiplex import Multiplexer, DEFAULT_WINDOW
+from storjnode.network.multiplex import FRAME_WINDOW, FRAME_LENGTH, FRAME_DATA
+from storjnode.network.multiplex import WINDOW, LENGTH
 from collections import OrderedDict
 from btctxstore import BtcTxStore
-import tempfile
 import time
 import json
 import hashlib
 import sys
 import os
-import binascii
 import struct
+import binascii
 from threading import Lock
+from zope.interface import implementer
 from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+from twisted.internet.interfaces import IReadWriteDescriptor
 
 
 mutex = Lock()
@@ -36,6 +41,82 @@ class RequestDenied(Exception):
 class TransferError(Exception):
     pass
 
+
+DEFAULT_TIMER_INTERVAL = 0.5  # seconds between polling messages and timeouts
+
+
+# Advertised in contracts, peers without it send unframed whole files.
+PROTOCOL_VERSION = 1  # framed streams, see storjnode.network.multiplex
+LEGACY_FILE_SIZE = struct.Struct("<20s")  # size header of unframed transfers
+LEGACY_QUEUE_END = u"0" * 64  # sent instead of a contract id when done
+
+
+if sys.version_info >= (3, 0, 0):
+    INT_TYPES = (int,)
+else:
+    INT_TYPES = (int, long)
+
+
+READ_FLAGS = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+
+
+class FileHandleCache(object):
+    """Open file descriptors for active transfers.
+
+    Files are opened once and accessed with positional reads and writes.
+    At most max_open descriptors are kept open, the least recently used
+    are closed and transparently reopened when accessed again.
+    """
+
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self._files = {}  # {key: (path, flags)}
+        self._fds = OrderedDict()  # {key: fd} least recently used first
+        self._mutex = Lock()
+
+    def __contains__(self, key):
+        return key in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def open(self, key, path, flags):
+        """Register a file under the given key, opened on first access."""
+        with self._mutex:
+            self._files[key] = (path, flags)
+
+    def pread(self, key, size, offset):
+        with self._mutex:
+            return storjnode.util.pread(self._get_fd(key), size, offset)
+
+    def pwrite(self, key, data, offset):
+        with self._mutex:
+            return storjnode.util.pwrite(self._get_fd(key), data, offset)
+
+    def close(self, key):
+        """Close and forget a file, ignored if not registered."""
+        with self._mutex:
+            self._files.pop(key, None)
+            fd = self._fds.pop(key, None)
+            if fd is not None:
+                os.close(fd)
+
+    def close_all(self):
+        for key in list(self._files):
+            self.close(key)
+
+    def _get_fd(self, key):
+        fd = self._fds.pop(key, None)
+        if fd is None:
+            path, flags = self._files[key]
+            fd = os.open(path, flags)
+        self._fds[key] = fd  # now most recently used
+        while len(self._fds) > self.max_open:
+            evicted_key, evicted_fd = self._fds.popitem(last=False)
+            os.close(evicted_fd)
+        return fd
+
 def process_transfers(client):
     _log.debug("In process transfers")
 
@@ -57,6 +138,13 @@ def process_transfers(client):
         if not con.connected:
             # Broken connections.
             for contract_id in list(client.con_info[con]):
+                if contract_id in client.contracts:
+                    data_id = client.contracts[contract_id]["data_id"]
+                    client.close_data_handles(data_id)
+
+                    # Keep partial download to resume from.
+                    client.suspend_download(con, contract_id)
+
                 if contract_id in client.defers:
                     e = TransferError("Connection died.")
                     client.defers[contract_id].errback(e)
@@ -65,6 +153,13 @@ def process_transfers(client):
                     if contract_id in client.contracts:
                         del client.contracts[contract_id]
 
+            # Forget broken connection.
+            del client.con_info[con]
+            if con in client.multiplexers:
+                del client.multiplexers[con]
+            if con in client.con_transfer:
+                del client.con_transfer[con]
+
     # Expired handshakes.
     for contract_id in list(client.contracts):
         if contract_id in client.handshake:
@@ -95,7 +190,9 @@ def process_transfers(client):
             continue
 
         # Wait until there's new transfers to process.
-        if not client.is_queued(con):
+        mux = client.multiplexers.get(con)
+        buffered = mux is not None and mux.buffered
+        if not client.is_queued(con) and not buffered:
             # Socket has hung ungracefully.
             duration = time.time() - con.alive
             if duration >= 15.0:
@@ -106,173 +203,265 @@ def process_transfers(client):
             _log.debug("Not queued: skipping")
             continue
 
-        # Get active contract ID.
-        if con not in client.con_transfer:
-            _log.debug("Con not in con_Transfer")
+        # Unframed transfers of peers without framed streams.
+        if con in client.con_transfer:
+            process_legacy_transfer(client, con)
             continue
 
-        contract_id = client.con_transfer[con]
-        _log.debug("Contract id =")
-        _log.debug(contract_id)
-        if len(contract_id) < 64:
-            remaining = 64 - len(contract_id)
-            _log.debug("Blocking = " + str(con.blocking))
-            partial = con.recv(remaining)
-            _log.debug("Contract id chunk = " + partial)
-            _log.debug("Connected = " + str(con.connected))
-            if not len(partial):
-                _log.debug("Did not receive contract id")
-                continue
-
+        # Received frames (and those of streams that were not open yet.)
+        mux = client.get_multiplexer(con)
+        frames = mux.backlog + mux.receive()
+        mux.backlog = []
+        for frame_type, contract_id, payload in frames:
+            client.process_frame(con, frame_type, contract_id, payload)
+
+        # Grant download windows and interleave upload data.
+        if con.connected:
+            client.send_frames(con)
+            mux.flush()
+
+
+def process_legacy_transfer(client, con):
+    # The master sends the contract id of the next transfer.
+    contract_id = client.con_transfer[con]
+    if len(contract_id) < 64:
+        partial = con.recv(64 - len(contract_id))
+        if len(partial):
             client.con_transfer[con] += partial
-            _log.debug("Skipping contract id.")
-            continue
+        return
+
+    # Reached end of transfer queue.
+    if contract_id == LEGACY_QUEUE_END:
+        return
+
+    # Anything left to transfer?
+    if contract_id not in client.con_info[con]:
+        _log.debug("Unknown legacy transfer: closing con")
+        con.close()
+        return
+    con_info = client.con_info[con][contract_id]
+    if not con_info["remaining"]:
+        return
+
+    contract = client.contracts[contract_id]
+    data_id = contract["data_id"]
+    if con_info["upload"]:
+        # Send file size.
+        if con_info["file_size"] is None:
+            file_size = os.path.getsize(client.store.find(data_id))
+            client.set_legacy_file_size(con_info, file_size)
+            header = str(file_size).encode("ascii")
+            con.send(LEGACY_FILE_SIZE.pack(header), send_all=1)
+
+        # Upload next chunk.
+        if con_info["remaining"]:
+            position = con_info["end"] - con_info["remaining"]
+            chunk = client.get_data_chunk(data_id, position)
+            if not len(chunk):
+                _log.debug("Upload changed size: closing con")
+                con.close()
+                return
+            con_info["remaining"] -= con.send(chunk)
+    else:
+        # Receive file size.
+        if con_info["file_size"] is None:
+            size_buf = con_info["file_size_buf"]
+            size_buf += con.recv(LEGACY_FILE_SIZE.size - len(size_buf),
+                                 encoding="ascii")
+            con_info["file_size_buf"] = size_buf
+            if len(size_buf) < LEGACY_FILE_SIZE.size:
+                return
+            header, = LEGACY_FILE_SIZE.unpack(size_buf)
+            client.set_legacy_file_size(con_info, int(header.rstrip(b"\0")))
 
-        # Reached end of transfer queue.
-        if contract_id == u"0" * 64:
-            _log.debug("Skippng end of queue")
-            continue
+        # Download next chunk.
+        if con_info["remaining"]:
+            data = con.recv(con_info["remaining"], encoding="ascii")
+            if not len(data):
+                return
+            position = con_info["end"] - con_info["remaining"]
+            con_info["remaining"] -= len(data)
+            if data_id in client.downloading:
+                client.save_data_chunk(data_id, data, position)
 
-        # Anything left to do?
-        if contract_id not in client.con_info[con]:
-            continue
-        con_info = client.con_info[con][contract_id]
-        if not con_info["remaining"]:
-            _log.debug("Skipping remaining.")
-            continue
+    if con_info["remaining"]:
+        return
 
-        # Upload.
-        contract = client.contracts[contract_id]
-        transfer_complete = 0
-        if client.net.unl == pyp2p.unl.UNL(value=contract["host_unl"]):
-            _log.debug("Uploading: Found our UNL")
-
-            # Send file size.
-            if not con_info["file_size"]:
-                # Get file size.
-                path = storage.manager.find(
-                    client.store_config,
-                    contract["data_id"]
-                )
-                file_size = os.path.getsize(path)
-                con_info["file_size"] = file_size
-                con_info["remaining"] = file_size
-
-                # Marshal file size for network.
-                if sys.version_info >= (3, 0, 0):
-                    net_file_size = struct.pack(
-                        "<20s",
-                        str(file_size).encode("ascii")
-                    )
-                else:
-                    net_file_size = struct.pack(
-                        "<20s",
-                        str(file_size)
-                    )
+    # Ready for the next transfer.
+    client.complete_transfer(con, contract_id)
+    if client.net.unl.is_master(client.get_their_unl(contract)):
+        client.queue_next_transfer(con)
+    else:
+        client.con_transfer[con] = u""
 
-                # Send file size.
-                con.send(net_file_size, send_all=1)
 
+@implementer(IReadWriteDescriptor)
+class _SocketWatcher(object):
+    """Reactor descriptor that wakes the engine when a socket is ready.
 
-            # Get next chunk from file.
-            position = con_info["file_size"] - con_info["remaining"]
-            data_chunk = client.get_data_chunk(
-                contract["data_id"],
-                position
-            )
+    The file descriptor is duplicated so it stays valid for the reactor
+    even if pyp2p closes the socket before the watcher is removed.
+    """
 
-            # Upload chunk binary to socket.
-            bytes_sent = con.send(data_chunk)
-            _log.debug(bytes_sent)
-            if bytes_sent:
-                con_info["remaining"] -= bytes_sent
+    def __init__(self, engine, sock):
+        self.engine = engine
+        self.sock = sock  # pyp2p.sock.Sock or listening socket
+        self.fd = os.dup(getattr(sock, "s", sock).fileno())
+        self.reading = False
+        self.writing = False
 
-            _log.debug("Remaining = ")
-            _log.debug(con_info["remaining"])
+    def fileno(self):
+        return self.fd
 
-            # Everything uploaded.
-            if not con_info["remaining"]:
-                transfer_complete = 1
-        else:
-            _log.debug("Attempting to download.")
-
-            # Get file size.
-            if not con_info["file_size"]:
-                file_size_buf = con_info["file_size_buf"]
-                if len(file_size_buf) < 20:
-                    remaining = 20 - len(file_size_buf)
-                    partial = con.recv(remaining)
-                    if not len(partial):
-                        continue
-
-                    file_size_buf += partial
-                    if len(file_size_buf) == 20:
-                        file_size, = struct.unpack("<20s", file_size_buf)
-                        file_size = int(file_size_buf.rstrip(b"\0"))
-                        con_info["file_size"] = file_size
-                        con_info["remaining"] = file_size
-                    else:
-                        continue
-
-            # Download.
-            data = con.recv(
-                con_info["remaining"],
-                encoding="ascii"
-            )
-            _log.debug(con.connected)
+    def doRead(self):
+        self.engine.schedule()
 
-            if len(data):
-                con_info["remaining"] -= len(data)
-                client.save_data_chunk(contract["data_id"], data)
+    def doWrite(self):
+        self.engine.schedule()
 
-            _log.debug("Remaining = ")
-            _log.debug(con_info["remaining"])
+    def connectionLost(self, reason):
+        self.engine.schedule()
 
-            # When done downloading close con.
-            if not con_info["remaining"]:
-                # Check download.
-                data_id = contract["data_id"]
-                temp_path = client.downloading[data_id]
-                with open(temp_path, "rw") as shard:
-                    # Delete file if it doesn't hash right!
-                    found_hash = storage.shard.get_id(shard)
-                    if found_hash != data_id:
-                        _log.debug(found_hash)
-                        _log.debug(data_id)
-                        _log.debug("Error: downloaded file doesn't hash right!")
-                        os.remove(temp_path)
-                        continue
-
-                    # Move shard to storage.
-                    storage.manager.add(
-                        client.store_config,
-                        shard
-                    )
+    def logPrefix(self):
+        return "TransferEngine"
+
+
+class TransferEngine(object):
 
-                # Remove that we're downloading this.
-                del client.downloading[data_id]
+    def __init__(self, client, timer_interval=DEFAULT_TIMER_INTERVAL,
+                 reactor=None):
+        """Readiness driven processing of a clients data transfers.
 
-                # Ready for a new transfer (if there are any.)
-                transfer_complete = 1
+        Transfers are only processed when a socket is ready for the I/O
+        process_transfers will do next, when woken up or when the timer
+        fires to poll for contract messages and expire timeouts.
 
-        their_unl = client.get_their_unl(contract)
-        is_master = client.net.unl.is_master(their_unl)
-        _log.debug("Is master = " + str(is_master))
-        if transfer_complete:
-            # Return async success.
-            if contract_id in client.defers:
-                # Call any callbacks registered with this defer.
-                client.defers[contract_id].callback(client.success_value)
-                del client.defers[contract_id]
+        Args:
+            client: The FileTransfer to process transfers for.
+            timer_interval: Seconds between timer driven processing.
+            reactor: Twisted reactor to use, defaults to the global one.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.client = client
+        self.reactor = reactor
+        self.timer_interval = timer_interval
+        self.running = False
+        self._watchers = {}  # {sock: _SocketWatcher}
+        self._scheduled = None  # delayed call of pending processing
+        self._timer = LoopingCall(self.schedule)
+        self._timer.clock = reactor
+        client.engine = self
+
+    def start(self):
+        """Start processing transfers, must be called in the reactor."""
+        self.running = True
+        self._timer.start(self.timer_interval, now=True)
+
+    def stop(self):
+        """Stop processing transfers, must be called in the reactor."""
+        self.running = False
+        if self._timer.running:
+            self._timer.stop()
+        if self._scheduled is not None and self._scheduled.active():
+            self._scheduled.cancel()
+        self._scheduled = None
+        for sock in list(self._watchers):
+            self._unwatch(sock)
+
+    def wakeup(self):
+        """Process transfers soon, safe to call from any thread."""
+        self.reactor.callFromThread(self.schedule)
+
+    def schedule(self):
+        """Process transfers in the next reactor iteration (coalesced)."""
+        if self.running and self._scheduled is None:
+            self._scheduled = self.reactor.callLater(0, self.process)
+
+    def process(self):
+        self._scheduled = None
+        try:
+            process_transfers(self.client)
+        except Exception as e:
+            _log.error("Processing transfers failed: {0}".format(repr(e)))
+        if self.running:
+            self.update()
+
+    def update(self):
+        """Watch each socket only for the I/O process_transfers does next."""
+        interests = {}
+        net = self.client.net
+        if net.passive is not None:
+            interests[net.passive] = (True, False)  # accept connections
+        for node in net.inbound + net.outbound:
+            con = node["con"]
+            if con.connected and con.s is not None:
+                interests[con] = self.get_interest(con)
+
+        for sock in list(self._watchers):
+            if sock not in interests:
+                self._unwatch(sock)
+        for sock, (reading, writing) in interests.items():
+            self._watch(sock, reading, writing)
+
+    def get_interest(self, con):
+        """Returns (reading, writing) wanted by process_transfers for con."""
+        client = self.client
+        if con.nonce is None:
+            return True, False  # synchronize receives the nonce
+        if con in client.con_transfer:
+            return self.get_legacy_interest(con)
+        mux = client.multiplexers.get(con)
+        buffered = mux is not None and mux.buffered > 0
+        if not client.is_queued(con):
+            return False, buffered
+        return True, buffered or client.wants_send(con)
 
-            if is_master:
-                client.queue_next_transfer(con)
+    def get_legacy_interest(self, con):
+        client = self.client
+        if not client.is_queued(con):
+            return False, False
+        contract_id = client.con_transfer[con]
+        if len(contract_id) < 64:
+            return True, False  # receive the next contract id
+        if contract_id not in client.con_info[con]:
+            return False, False
+        if client.con_info[con][contract_id]["upload"]:
+            return False, True
+        return True, False
+
+    def _watch(self, sock, reading, writing):
+        watcher = self._watchers.get(sock)
+        if watcher is None:
+            if not (reading or writing):
+                return
+            watcher = _SocketWatcher(self, sock)
+            self._watchers[sock] = watcher
+        if reading != watcher.reading:
+            if reading:
+                self.reactor.addReader(watcher)
             else:
-                client.con_transfer[con] = u""
+                self.reactor.removeReader(watcher)
+            watcher.reading = reading
+        if writing != watcher.writing:
+            if writing:
+                self.reactor.addWriter(watcher)
+            else:
+                self.reactor.removeWriter(watcher)
+            watcher.writing = writing
+
+    def _unwatch(self, sock):
+        watcher = self._watchers.pop(sock)
+        if watcher.reading:
+            self.reactor.removeReader(watcher)
+        if watcher.writing:
+            self.reactor.removeWriter(watcher)
+        os.close(watcher.fd)
 
 
 class FileTransfer:
-    def __init__(self, net, wif=None, store_config=None, handlers=None):
+    def __init__(self, net, wif=None, store_config=None, handlers=None,
+                 max_open_files=64):
         # Accept direct connections.
         self.net = net
 
@@ -286,6 +475,7 @@ class FileTransfer:
         # Where will the data be stored?
         self.store_config = store_config
         assert(len(list(store_config)))
+        self.store = storage.manager.get_store(store_config)
 
         # Handlers for certain events.
         self.handlers = handlers
@@ -306,15 +496,51 @@ class FileTransfer:
         # All contracts associated with this connection.
         self.con_info = {}
 
-        # File transfer currently active on connection.
+        # Framed streams of the transfers on a connection.
+        self.multiplexers = {}
+
+        # Contracts with peers that don't support framed streams.
+        self.legacy_contracts = set()
+
+        # Contract id being transferred on their unframed connections.
         self.con_transfer = {}
 
         # List of active downloads.
         # (Never try to download multiple copies of the same thing at once.)
         self.downloading = {}
 
+        # Running hash of active downloads (verified without rereading.)
+        self.hashers = {}
+
+        # Size and running hash of interrupted downloads.
+        self.partials = {}
+
+        # Downloads from multiple peers.
+        self.swarms = {}
+
+        # Open files of active transfers.
+        self.handles = FileHandleCache(max_open=max_open_files)
+
+        # Set by the TransferEngine processing this client.
+        self.engine = None
+
+        # Cached results of comparing UNLs with ours.
+        self.our_unls = {}
+
+    def wakeup(self):
+        """Wake up the transfer engine, safe to call from any thread."""
+        if self.engine is not None:
+            self.engine.wakeup()
+
+    def is_our_unl(self, unl):
+        # Parsing a UNL looks up the WAN IP unless given, so cache results.
+        if unl not in self.our_unls:
+            their_unl = pyp2p.unl.UNL(value=unl, wan_ip=self.net.unl.wan_ip)
+            self.our_unls[unl] = self.net.unl == their_unl
+        return self.our_unls[unl]
+
     def get_their_unl(self, contract):
-        if self.net.unl == pyp2p.unl.UNL(value=contract["dest_unl"]):
+        if self.is_our_unl(contract["dest_unl"]):
             their_unl = contract["src_unl"]
         else:
             their_unl = contract["dest_unl"]
@@ -339,21 +565,59 @@ class FileTransfer:
 
         return 0
 
-    def cleanup_transfers(self, con):
-        # Close con - there's nothing left to download.
-        if not self.is_queued(con):
-            # Cleanup con transfers.
-            if con in self.con_transfer:
-                del self.con_transfer[con]
-
-            # Cleanup con_info.
-            if con in self.con_info:
-                del self.con_info[con]
+    def open_stream(self, con, contract_id):
+        # Associate TCP con with contract.
+        contract = self.contracts[contract_id]
+        file_size = contract["file_size"]
+        upload = self.is_our_unl(contract["host_unl"])
+
+        # Store con association.
+        if con not in self.con_info:
+            self.con_info[con] = {}
+
+        # Associate contract with con.
+        legacy = contract_id in self.legacy_contracts
+        if contract_id not in self.con_info[con]:
+            self.con_info[con][contract_id] = {
+                "contract_id": contract_id,
+                "remaining": 350, # Tree fiddy.
+                "file_size": None,  # sent with first frame
+                "offset": contract.get(u"offset") or 0,
+                "end": None,  # end of byte range once file size known
+                "upload": upload,
+                "credit": 0,  # upload data the peer accepts
+                "grant": DEFAULT_WINDOW  # credit to give the peer
+            }
 
-            # Todo: cleanup contract + handshake state.
+            # Unframed transfers always send the whole file.
+            if legacy:
+                self.con_info[con][contract_id]["offset"] = 0
+                self.con_info[con][contract_id]["file_size_buf"] = b""
+
+        # Record download state.
+        data_id = contract["data_id"]
+        if data_id in self.swarms:
+            _log.debug("Success: swarm download")
+        elif not upload:
+            _log.debug("Success: download")
+            offset = self.con_info[con][contract_id]["offset"]
+            path = self.store.create_partial_file(data_id, file_size)
+            self.downloading[data_id] = path
+            self.hashers[data_id] = self.resume_partial(data_id, path, offset)
+        else:
+            _log.debug("Success: upload")
+
+        # Queue transfer if the connection isn't busy.
+        if legacy:
+            transfer = self.con_transfer.get(con)
+            if transfer is None or transfer == LEGACY_QUEUE_END:
+                if self.net.unl.is_master(self.get_their_unl(contract)):
+                    self.queue_next_transfer(con)
+                else:
+                    self.con_transfer[con] = u""
 
     def queue_next_transfer(self, con):
-        _log.debug("Queing next transfer")
+        # Tell the peer which unframed transfer is next.
         for contract_id in list(self.con_info[con]):
             con_info = self.con_info[con][contract_id]
             if con_info["remaining"]:
@@ -361,8 +625,213 @@ class FileTransfer:
                 con.send(contract_id, send_all=1)
                 return
 
-        # Mark end of transfers.
-        self.con_transfer[con] = u"0" * 64
+        # Mark end of the queue.
+        self.con_transfer[con] = LEGACY_QUEUE_END
+        con.send(LEGACY_QUEUE_END, send_all=1)
+
+    def get_partial_size(self, data_id):
+        path = self.store.find_partial(data_id)
+        if path is None:
+            return 0
+        return os.path.getsize(path)
+
+    def resume_partial(self, data_id, path, offset):
+        # Data after the offset is downloaded again.
+        assert(os.path.getsize(path) >= offset)
+        with open(path, "r+b") as partial:
+            partial.truncate(offset)
+
+        # Running hash of the kept data, rehashed if not from this run.
+        size, hasher = self.partials.pop(data_id, (None, None))
+        if size != offset:
+            hasher = hashlib.sha256()
+            with open(path, "rb") as partial:
+                for block in storage.shard.iter_blocks(partial):
+                    hasher.update(block)
+
+        return hasher
+
+    def suspend_download(self, con, contract_id):
+        con_info = self.con_info[con][contract_id]
+        data_id = self.contracts[contract_id]["data_id"]
+        if con_info["upload"] or data_id not in self.downloading:
+            return
+        if data_id in self.swarms:
+            return
+
+        # Everything before the position has been saved and hashed.
+        if con_info["end"] is None:
+            position = con_info["offset"]
+        else:
+            position = con_info["end"] - con_info["remaining"]
+        self.downloading.pop(data_id)
+        self.partials[data_id] = (position, self.hashers.pop(data_id))
+
+    def set_file_size(self, con_info, file_size):
+        # Limit the contracts byte range to the file.
+        start = min(con_info["offset"], file_size)
+        length = self.contracts[con_info["contract_id"]].get(u"length")
+        if length is None:
+            end = file_size
+        else:
+            end = min(start + length, file_size)
+        con_info["file_size"] = file_size
+        con_info["end"] = end
+        con_info["remaining"] = end - start
+
+    def set_legacy_file_size(self, con_info, file_size):
+        # Unframed transfers ignore the contracts byte range.
+        con_info["file_size"] = file_size
+        con_info["end"] = file_size
+        con_info["remaining"] = file_size
+
+    def get_multiplexer(self, con):
+        if con not in self.multiplexers:
+            self.multiplexers[con] = Multiplexer(con)
+        return self.multiplexers[con]
+
+    def should_grant(self, con_info):
+        # Grant download credit once half the window has been received.
+        if con_info["upload"] or not con_info["remaining"]:
+            return 0
+        return con_info["grant"] >= DEFAULT_WINDOW // 2
+
+    def wants_send(self, con):
+        for con_info in list(self.con_info[con].values()):
+            if con_info["upload"]:
+                if con_info["file_size"] is None:
+                    return 1
+                if con_info["credit"] and con_info["remaining"]:
+                    return 1
+            elif self.should_grant(con_info):
+                return 1
+
+        return 0
+
+    def process_frame(self, con, frame_type, contract_id, payload):
+        # Ignore streams of unknown contracts.
+        if contract_id not in self.contracts:
+            _log.debug("Frame for unknown contract")
+            return
+
+        # Stream not associated with this con yet.
+        if contract_id not in self.con_info[con]:
+            self.multiplexers[con].backlog.append(
+                (frame_type, contract_id, payload)
+            )
+            return
+
+        con_info = self.con_info[con][contract_id]
+        if frame_type == FRAME_WINDOW and con_info["upload"]:
+            # Peer accepts more data.
+            credit, = WINDOW.unpack(payload)
+            con_info["credit"] += credit
+        elif frame_type == FRAME_LENGTH and not con_info["upload"]:
+            # Size of the download.
+            file_size, = LENGTH.unpack(payload)
+            self.set_file_size(con_info, file_size)
+            if not con_info["remaining"]:
+                self.complete_transfer(con, contract_id)
+        elif frame_type == FRAME_DATA and not con_info["upload"] and \
+                con_info["file_size"] is not None and \
+                len(payload) <= con_info["remaining"]:
+            # Save downloaded chunk.
+            data_id = self.contracts[contract_id]["data_id"]
+            position = con_info["end"] - con_info["remaining"]
+            con_info["remaining"] -= len(payload)
+            con_info["grant"] += len(payload)
+            if data_id in self.downloading:  # else finished by another peer
+                self.save_data_chunk(data_id, payload, position)
+            if not con_info["remaining"]:
+                self.complete_transfer(con, contract_id)
+        else:
+            _log.debug("Invalid frame: closing con")
+            con.close()
+
+    def send_frames(self, con):
+        mux = self.multiplexers[con]
+        streams = self.con_info[con]
+        uploads = []
+        for contract_id in sorted(streams):
+            con_info = streams[contract_id]
+            if con_info["upload"]:
+                # Announce upload size.
+                if con_info["file_size"] is None:
+                    data_id = self.contracts[contract_id]["data_id"]
+                    file_size = os.path.getsize(self.store.find(data_id))
+                    self.set_file_size(con_info, file_size)
+                    mux.length(contract_id, file_size)
+                    if not con_info["remaining"]:
+                        self.complete_transfer(con, contract_id)
+
+                if con_info["credit"] and con_info["remaining"]:
+                    uploads.append(contract_id)
+            elif self.should_grant(con_info):
+                mux.window(contract_id, con_info["grant"])
+                con_info["grant"] = 0
+
+        # Interleave upload chunks, resuming the rotation of the last call.
+        if uploads:
+            start = mux.rotation % len(uploads)
+            uploads = uploads[start:] + uploads[:start]
+        while uploads and mux.writable():
+            contract_id = uploads.pop(0)
+            con_info = streams[contract_id]
+            data_id = self.contracts[contract_id]["data_id"]
+            position = con_info["end"] - con_info["remaining"]
+            chunk_size = min(
+                mux.frame_size, con_info["credit"], con_info["remaining"]
+            )
+            chunk = self.get_data_chunk(data_id, position, chunk_size)
+            if len(chunk) != chunk_size:
+                _log.debug("Upload changed size: closing con")
+                con.close()
+                return
+
+            mux.data(contract_id, chunk)
+            mux.rotation += 1
+            con_info["credit"] -= chunk_size
+            con_info["remaining"] -= chunk_size
+            if not con_info["remaining"]:
+                self.complete_transfer(con, contract_id)
+            elif con_info["credit"]:
+                uploads.append(contract_id)
+
+    def complete_transfer(self, con, contract_id):
+        contract = self.contracts[contract_id]
+        data_id = contract["data_id"]
+        self.close_data_handles(data_id)
+
+        # Check download.
+        con_info = self.con_info[con][contract_id]
+        downloading = data_id in self.downloading
+        if not con_info["upload"] and downloading and \
+                data_id not in self.swarms:
+            temp_path = self.downloading.pop(data_id)
+            hasher = self.hashers.pop(data_id)
+            if con_info["end"] < con_info["file_size"]:
+                # Only a byte range was requested, keep it to resume from.
+                self.partials[data_id] = (con_info["end"], hasher)
+            elif hasher.hexdigest() != data_id:
+                # Delete file if it doesn't hash right!
+                _log.debug(hasher.hexdigest())
+                _log.debug(data_id)
+                _log.debug("Error: downloaded file doesn't hash right!")
+                self.store.remove_temp_file(temp_path)
+                if contract_id in self.defers:
+                    e = TransferError("Downloaded data hash mismatch.")
+                    self.defers[contract_id].errback(e)
+                    del self.defers[contract_id]
+                return
+            else:
+                # Move shard to storage.
+                self.store.move(temp_path, data_id)
+
+        # Return async success.
+        if contract_id in self.defers:
+            # Call any callbacks registered with this defer.
+            self.defers[contract_id].callback(self.success_value)
+            del self.defers[contract_id]
 
     def is_valid_syn(self, msg):
         # List of expected fields.
@@ -412,27 +881,50 @@ class FileTransfer:
             _log.debug(type(msg[u"file_size"]))
             return 0
 
+        # Check optional protocol version and byte range.
+        for range_key in (u"version", u"offset", u"length"):
+            value = msg.get(range_key)
+            if value is not None:
+                if type(value) not in INT_TYPES or value < 0:
+                    _log.debug("Invalid byte range " + range_key)
+                    return 0
+
         # Are we the host?
-        if self.net.unl == pyp2p.unl.UNL(value=msg[u"host_unl"]):
+        if self.is_our_unl(msg[u"host_unl"]):
             # Then check we have this file.
-            path = storage.manager.find(self.store_config, msg[u"data_id"])
+            path = self.store.find(msg[u"data_id"])
             if path is None:
                 _log.debug("Failed to find file we're uploading")
                 return 0
         else:
             # Do we already have this file?
-            path = storage.manager.find(self.store_config, msg[u"data_id"])
+            path = self.store.find(msg[u"data_id"])
             if path is not None:
                 _log.debug("Attempting to download file we already have")
                 return 0
 
+            # Pieces of a download from multiple peers.
+            if msg[u"data_id"] in self.swarms:
+                return 1
+
             # Are we already trying to download this?
             if msg[u"data_id"] in self.downloading:
                 _log.debug("We're already trying to download this")
                 return 0
 
+            # Can only resume from what was downloaded.
+            offset = msg.get(u"offset") or 0
+            if offset > self.get_partial_size(msg[u"data_id"]):
+                _log.debug("Offset is past the partial download")
+                return 0
+
         return 1
 
+    def is_framed(self, msg):
+        # Peers advertise the protocol version they support.
+        version = msg.get(u"version")
+        return type(version) in INT_TYPES and version >= PROTOCOL_VERSION
+
     def protocol(self, msg):
         msg = json.loads(msg, object_pairs_hook=OrderedDict)
 
@@ -442,50 +934,10 @@ class FileTransfer:
                 with mutex:
                     _log.debug("IN SUCCESS CALLBACK")
                     _log.debug("Success() contract_id = " + str(contract_id))
+                    self.open_stream(con, contract_id)
 
-                    # Associate TCP con with contract.
-                    contract = self.contracts[contract_id]
-                    file_size = contract["file_size"]
-
-                    # Store con association.
-                    if con not in self.con_info:
-                        self.con_info[con] = {}
-
-                    # Associate contract with con.
-                    if contract_id not in self.con_info[con]:
-                        self.con_info[con][contract_id] = {
-                            "contract_id": contract_id,
-                            "remaining": 350, # Tree fiddy.
-                            "file_size": file_size,
-                            "file_size_buf": b""
-                        }
-
-                    # Record download state.
-                    data_id = contract["data_id"]
-                    if self.net.unl != pyp2p.unl.UNL(value=host_unl):
-                        _log.debug("Success: download")
-                        fp, self.downloading[data_id] = tempfile.mkstemp()
-                    else:
-                        # Set initial upload for this con.
-                        _log.debug("Success: upload")
-
-                    # Queue first transfer.
-                    their_unl = self.get_their_unl(contract)
-                    is_master = self.net.unl.is_master(their_unl)
-                    _log.debug("Is master = " + str(is_master))
-                    if con not in self.con_transfer:
-                        if is_master:
-                            # A transfer to queue processing.
-                            self.queue_next_transfer(con)
-                        else:
-                            # A transfer to receive (unknown.)
-                            self.con_transfer[con] = u""
-                    else:
-                        if self.con_transfer[con] == u"0" * 64:
-                            if is_master:
-                                self.queue_next_transfer(con)
-                            else:
-                                self.con_transfer[con] = u""
+                # Start watching the new transfer.
+                self.wakeup()
             return success
 
         # Sanity checking.
@@ -507,10 +959,15 @@ class FileTransfer:
                 "timestamp": time.time()
             }
 
+            # Fall back to unframed transfers for old peers.
+            if not self.is_framed(msg):
+                self.legacy_contracts.add(contract_id)
+
             # Create reply.
             reply = OrderedDict({
                 u"status": u"SYN-ACK",
                 u"syn": msg,
+                u"version": PROTOCOL_VERSION
             })
 
             # Sign reply.
@@ -548,8 +1005,21 @@ class FileTransfer:
                 _log.debug("SYN-ACK: sig is invalid.")
                 return
 
-            # Update handshake.
+            # Fall back to unframed transfers for old peers.
             contract = self.contracts[contract_id]
+            if not self.is_framed(msg):
+                self.legacy_contracts.add(contract_id)
+
+                # Which can't transfer pieces of a swarm download.
+                if contract["data_id"] in self.swarms:
+                    _log.debug("SYN-ACK: peer can't send byte ranges.")
+                    if contract_id in self.defers:
+                        e = TransferError("Peer doesn't support byte ranges.")
+                        self.defers[contract_id].errback(e)
+                        del self.defers[contract_id]
+                    return
+
+            # Update handshake.
             self.handshake[contract_id] = {
                 "state": u"ACK",
                 "timestamp": time.time()
@@ -700,9 +1170,13 @@ class FileTransfer:
 
         return self.data_request(action, data_id, file_size, node_unl)
 
-    def data_request(self, action, data_id, file_size, node_unl):
+    def data_request(self, action, data_id, file_size, node_unl,
+                     offset=None, length=None):
         """
         Action = put (upload), get (download.)
+
+        Offset and length limit the transfer to a byte range. Downloads
+        resume from earlier interrupted attempts unless given an offset.
         """
         _log.debug("In data request function")
 
@@ -711,12 +1185,12 @@ class FileTransfer:
             # We store this data.
             direction = u"send"
             host_unl = self.net.unl.value
-            assert(storage.manager.find(self.store_config, data_id) is not None)
+            assert(self.store.find(data_id) is not None)
         else:
             # They store the data.
             direction = u"receive"
             host_unl = node_unl
-            if data_id in self.downloading:
+            if data_id in self.downloading and data_id not in self.swarms:
                 raise Exception("Already trying to download this.")
 
         # Encoding.
@@ -739,6 +1213,13 @@ class FileTransfer:
             if type(node_unl) == str:
                 node_unl = unicode(node_unl)
 
+        # Resume partial download.
+        if direction == u"receive" and data_id not in self.swarms:
+            partial_size = self.get_partial_size(data_id)
+            if offset is None:
+                offset = partial_size
+            assert(offset <= partial_size)
+
         # Create contract.
         contract = OrderedDict({
             u"status": u"SYN",
@@ -747,7 +1228,10 @@ class FileTransfer:
             u"file_size": file_size,
             u"host_unl": host_unl,
             u"dest_unl": node_unl,
-            u"src_unl": self.net.unl.value
+            u"src_unl": self.net.unl.value,
+            u"offset": offset or 0,
+            u"length": length,
+            u"version": PROTOCOL_VERSION
         })
 
         # Sign contract.
@@ -771,37 +1255,56 @@ class FileTransfer:
         # Return defer for async code.
         return d
 
+    def swarm_data_request(self, data_id, node_unls, file_size):
+        """
+        Download data from multiple peers at once.
+        """
+        swarm = storjnode.network.swarm.SwarmDownload(
+            self, data_id, node_unls, file_size
+        )
+        return swarm.start()
+
     def remove_file_from_storage(self, data_id):
-        storage.manager.remove(self.store_config, data_id)
+        self.store.remove(data_id)
 
     def move_file_to_storage(self, path):
         with open(path, "rb") as shard:
-            storage.manager.add(self.store_config, shard)
+            shard_path = self.store.add(shard)
             return {
                 "file_size": storage.shard.get_size(shard),
-                "data_id": storage.shard.get_id(shard)
+                "data_id": os.path.basename(shard_path)
             }
 
     def get_data_chunk(self, data_id, position, chunk_size=1048576):
-        path = storage.manager.find(self.store_config, data_id)
-        buf = b""
-        with open(path, "rb") as fp:
-            fp.seek(position, 0)
-            buf = fp.read(chunk_size)
-
-            return buf
+        key = ("read", data_id)
+        if key not in self.handles:
+            self.handles.open(key, self.store.find(data_id), READ_FLAGS)
+        return self.handles.pread(key, chunk_size, position)
 
-    def save_data_chunk(self, data_id, chunk):
+    def save_data_chunk(self, data_id, chunk, position=None):
         _log.debug("Saving data chunk for " + str(data_id))
         _log.debug("of size + " + str(len(chunk)))
         assert(data_id in self.downloading)
 
         # Find temp file path.
-        path = self.downloading[data_id]
-
-        _log.debug(path)
-        with open(path, "ab") as fp:
-            fp.write(chunk)
+        key = ("write", data_id)
+        if key not in self.handles:
+            path = self.downloading[data_id]
+            _log.debug(path)
+            self.handles.open(key, path, WRITE_FLAGS)
+
+        # Append if no position given.
+        if position is None:
+            position = os.path.getsize(self.downloading[data_id])
+        self.handles.pwrite(key, chunk, position)
+
+        # Update running hash (pieces of swarms are hashed once complete.)
+        if data_id in self.hashers:
+            self.hashers[data_id].update(chunk)
+
+    def close_data_handles(self, data_id):
+        self.handles.close(("read", data_id))
+        self.handles.close(("write", data_id))
 
 if __name__ == "__main__":
 
@@ -1,136 +1,393 @@
 import os
-import time
+import csv
+import json
+import random
 import logging
 import binascii
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
 from kademlia.node import Node
-from crochet import TimeoutError
-from threading import Thread
-from threading import RLock
-from graphviz import Digraph
-from storjnode import util
-from storjnode.network.server import QUERY_TIMEOUT
+from crochet import run_in_reactor
+from twisted.internet import defer
+from graphviz import Graph
+from storjnode.network.nodeid import to_long
+from storjnode.network.routing import ID_BITS
 
 
 _log = logging.getLogger(__name__)
 
 
-class _NetworkMapper(object):  # will not scale but good for now
+DEFAULT_CONCURRENCY = 32  # find node requests in flight
+DEFAULT_ATTEMPTS = 1  # find node requests per node
+CIRCO_MAX_NODES = 64  # larger graphs use the faster sfdp layout
+LABEL_MAX_NODES = 512  # larger graphs are drawn without labels
 
-    def __init__(self, storjnode, worker_num=32):
+
+class _NetworkMapper(object):
+
+    def __init__(self, server, start, concurrency=DEFAULT_CONCURRENCY,
+                 attempts=DEFAULT_ATTEMPTS, progress=None, sink=None,
+                 resume=None):
         """Network crawler used to map the network.
 
+        Runs in the reactor thread, so no thread is needed per request.
+
         Args:
-            storjnode: Node used to crawl the network.
-            worker_num: Number of workers used to crawl the network.
+            server: StorjServer used to crawl the network.
+            start: Nodes [(id, ip, port)] to start crawling at.
+            concurrency: Maximum find node requests in flight.
+            attempts: How often to attempt to contact each node.
+            progress: Optional callable given (num_scanned, num_pending)
+                      whenever a node was scanned.
+            sink: Optional callable given (id, (ip, port), peers, reached)
+                  for every scanned node, which is then not kept in memory.
+            resume: Scanned nodes of an earlier crawl to continue.
         """
+        assert(concurrency > 0)
+        assert(attempts > 0)
+
         # pipeline: toscan -> scanning -> scanned
-        self.toscan = {}  # {id: (ip, port)}
+        self.toscan = OrderedDict()  # {id: (ip, port)}
         self.scanning = {}  # {id: (ip, port)}
         self.scanned = {}  # {id: {"addr":(ip, port), "peers":[(id, ip, port)]}}
+        self.unreached = set()  # ids of scanned nodes that never responded
+        self.failures = {}  # {id: failed attempts}
 
-        self.mutex = RLock()
-        self.server = storjnode.server
-        self.worker_num = worker_num
+        self.server = server
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.progress = progress
+        self.sink = sink
+        self.deferred = defer.Deferred()
+        self._filling = False
 
-        # start crawl at self
-        self.toscan[storjnode.get_id()] = ("127.0.0.1", storjnode.port)
+        # continue at the unscanned peers of resumed nodes
+        resume = resume or {}
+        for node_id, results in resume.items():
+            self.scanned[node_id] = None if sink else results
+        for results in resume.values():
+            for peer in results["peers"]:
+                self.discovered(*peer)
 
-    def get_next_node(self):
-        """Moves node from toscan to scanning.
+        for node_id, ip, port in start:
+            self.discovered(node_id, ip, port)
 
-        Returns moved node or None if toscan is empty.
-        """
-        with self.mutex:
-            if len(self.toscan) > 0:
-                node_id, transport_address = self.toscan.popitem()
-                self.scanning[node_id] = transport_address
-                return Node(node_id, transport_address[0], transport_address[1])
-            else:
-                return None
+    def discovered(self, node_id, ip, port):
+        """Add node to pipeline unless already known."""
+        known = (node_id in self.toscan or node_id in self.scanning or
+                 node_id in self.scanned)
+        if not known:
+            self.toscan[node_id] = (ip, port)
 
     def processed(self, node, neighbours):
         """Move node from scanning to scanned and add new nodes to pipeline."""
-        with self.mutex:
-            del self.scanning[node.id]
-            self.scanned[node.id] = {
-                "addr": (node.ip, node.port), "peers": neighbours
-            }
-            for peer in neighbours:
-                peer = Node(*peer)
-                if(peer.id not in self.scanning and
-                        peer.id not in self.scanned):
-                    self.toscan[peer.id] = (peer.ip, peer.port)
-
-    def worker(self):
-        """Process nodes from toscan to scanned until network walked."""
-        while True:
-            time.sleep(0.002)
-
-            # get next node to scan
-            with self.mutex:
-                node = self.get_next_node()
-                if node is None and len(self.scanning) == 0:
-                    return  # done! Nothing to scan and nothing being scanned
-
-            # no node to scan but other workers still scanning, so more may come
-            if node is None:
-                continue
-
-            # get neighbors
-            d = self.server.protocol.callFindNode(node, node)
-            d = util.default_defered(d, [])
-            try:
-                neighbours = util.wait_for_defered(d, timeout=QUERY_TIMEOUT)
-            except TimeoutError:  # pragma: no cover
-                msg = "Timeout when getting neighbors of %s"  # pragma: no cover
-                hexid = binascii.hexlify(node.id)
-                _log.debug(msg % hexid)  # pragma: no cover
-                neighbours = []  # pragma: no cover
+        del self.scanning[node.id]
+        self._scanned(node, neighbours, True)
+        for peer in neighbours:
+            self.discovered(*peer)
+        self._report()
 
-            # add to results and neighbours to scanned
-            self.processed(node, neighbours)
+    def failed(self, node):
+        """Retry node or move it to scanned without peers if out of attempts.
+        """
+        del self.scanning[node.id]
+        self.failures[node.id] = self.failures.get(node.id, 0) + 1
+        if self.failures[node.id] < self.attempts:
+            self.toscan[node.id] = (node.ip, node.port)
+            return
+        hexid = binascii.hexlify(node.id)
+        _log.debug("Could not get neighbours of %s" % hexid)
+        self.unreached.add(node.id)
+        self._scanned(node, [], False)
+        self._report()
 
     def crawl(self):
-        """Start workers and block until network is crawled."""
-        workers = [Thread(target=self.worker) for i in range(self.worker_num)]
-        for worker in workers:
-            worker.start()
-        for worker in workers:
-            worker.join()
-        return self.scanned
+        """Crawl the network, must be called in the reactor thread.
+
+        Returns:
+            A twisted.internet.defer.Deferred that resolves to the scanned
+            nodes once the network was walked.
+        """
+        self._fill()
+        return self.deferred
 
+    def _fill(self):
+        # responses while filling are handled by the running loop
+        if self._filling:
+            return
+        self._filling = True
+        try:
+            while self.toscan and len(self.scanning) < self.concurrency:
+                node_id, addr = self.toscan.popitem(last=False)
+                self.scanning[node_id] = addr
+                node = Node(node_id, addr[0], addr[1])
+                d = self.server.protocol.callFindNode(node, node)
+                d.addCallbacks(self._on_response, self._on_error,
+                               callbackArgs=(node,), errbackArgs=(node,))
+        finally:
+            self._filling = False
 
-def render(network_map, path, name, view=True):
+        # done! Nothing to scan and nothing being scanned
+        if not self.toscan and not self.scanning and not self.deferred.called:
+            self.deferred.callback(self.scanned)
 
-    dot = Digraph(comment=name, engine="circo")
+    def _on_response(self, result, node):
+        found, neighbours = result
+        if found:
+            self.processed(node, [tuple(peer) for peer in neighbours])
+        else:
+            self.failed(node)
+        self._fill()
+
+    def _on_error(self, failure, node):
+        hexid = binascii.hexlify(node.id)
+        _log.warning("Error getting neighbours of %s: %s" % (hexid, failure))
+        self.failed(node)
+        self._fill()
+
+    def _scanned(self, node, neighbours, reached):
+        addr = (node.ip, node.port)
+        if self.sink is None:
+            self.scanned[node.id] = {"addr": addr, "peers": neighbours}
+            return
+        self.scanned[node.id] = None  # only needed to skip known nodes
+        try:
+            self.sink(node.id, addr, neighbours, reached)
+        except Exception as e:
+            _log.error("Network map sink failed: %s" % repr(e))
+
+    def _report(self):
+        if self.progress is not None:
+            pending = len(self.toscan) + len(self.scanning)
+            self.progress(len(self.scanned), pending)
 
-    # add nodes
-    for nodeid, results in network_map.items():
-        nodehexid = binascii.hexlify(nodeid)
-        ip, port = results["addr"]
-        label = "%s\n%s:%i" % (nodehexid, ip, port)
-        dot.node(nodehexid, label)
 
-    # add connections
+def crawl(server, start, concurrency=DEFAULT_CONCURRENCY,
+          attempts=DEFAULT_ATTEMPTS, progress=None, sink=None, resume=None):
+    """Crawl the network, must be called in the reactor thread.
+
+    Args:
+        server: StorjServer used to crawl the network.
+        start: Nodes [(id, ip, port)] to start crawling at.
+        concurrency: Maximum find node requests in flight.
+        attempts: How often to attempt to contact each node.
+        progress: Optional callable given (num_scanned, num_pending).
+        sink: Optional callable given (id, (ip, port), peers, reached) as
+              soon as a node was scanned, see write_record.
+        resume: Network map of an earlier crawl to continue, see load.
+
+    Returns:
+        A twisted.internet.defer.Deferred that resolves to (network_map,
+        unreached) once walked, see generate for the map format. With a
+        sink the network map only holds the ids, mapped to None.
+    """
+    mapper = _NetworkMapper(server, start, concurrency=concurrency,
+                            attempts=attempts, progress=progress, sink=sink,
+                            resume=resume)
+    return mapper.crawl().addCallback(lambda m: (m, mapper.unreached))
+
+
+def write_record(outfile, nodeid, addr, peers, reached=True):
+    """Write a scanned node as a line of json to a file like object.
+
+    Output:
+        {"id": ID, "transport": [ip, port],
+         "neighbours": [[ID, ip, port], ...], "reached": bool}
+    """
+    record = {
+        "id": _to_hex(nodeid),
+        "transport": list(addr),
+        "neighbours": [[_to_hex(p), ip, port] for p, ip, port in peers],
+        "reached": reached
+    }
+    outfile.write(json.dumps(record) + "\n")
+    outfile.flush()
+
+
+def dump(network_map, outfile, unreached=()):
+    """Write network map to a file like object, a record per line."""
     for nodeid, results in network_map.items():
-        nodehexid = binascii.hexlify(nodeid)
-        for peerid, ip, port in results["peers"]:
-            peerhexid = binascii.hexlify(peerid)
-            dot.edge(nodehexid, peerhexid, constraint='false')
+        write_record(outfile, nodeid, results["addr"], results["peers"],
+                     reached=nodeid not in unreached)
+
 
-    # render graph
-    dot.render(os.path.join(path, '%s.gv' % name), view=view)
+def load(infile):
+    """Read a network map written by dump or a crawl.
 
+    An incomplete last record of an interrupted crawl is skipped. Nodes
+    retried by a resumed crawl are recorded again, the last record wins.
+
+    Returns:
+        (network_map, unreached), see crawl.
+    """
+    network_map = {}
+    unreached = set()
+    for line in infile:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            _log.warning("Skipping incomplete network map record.")
+            continue
+        nodeid = binascii.unhexlify(record["id"])
+        ip, port = record["transport"]
+        network_map[nodeid] = {
+            "addr": (str(ip), port),
+            "peers": [(binascii.unhexlify(p), str(peer_ip), peer_port)
+                      for p, peer_ip, peer_port in record["neighbours"]]
+        }
+        if record["reached"]:
+            unreached.discard(nodeid)
+        else:
+            unreached.add(nodeid)
+    return network_map, unreached
 
-def generate(storjnode, worker_num=32):
+
+def _to_hex(nodeid):
+    return binascii.hexlify(nodeid).decode("ascii")
+
+
+def reduce_graph(network_map, prefix_bits=None, sample=None, seed=None):
+    """Reduce a network map to an undirected graph for rendering or export.
+
+    Args:
+        network_map: The network map, see generate.
+        prefix_bits: Collapse nodes sharing this many leading id bits.
+        sample: Only keep this many randomly chosen nodes.
+        seed: Seed of the random sample.
+
+    Returns:
+        (nodes, edges) with nodes {key: label} and edges a set of
+        (key, key) pairs, each connection included once.
+    """
+    assert(prefix_bits is None or 0 < prefix_bits <= ID_BITS)
+    nodeids = sorted(network_map.keys())  # sorted so samples repeat
+    if sample is not None and sample < len(nodeids):
+        nodeids = random.Random(seed).sample(nodeids, sample)
+    included = set(nodeids)
+
+    # node keys and labels
+    keys = {}
+    nodes = {}
+    if prefix_bits is None:
+        for nodeid in nodeids:
+            keys[nodeid] = _to_hex(nodeid)
+            ip, port = network_map[nodeid]["addr"]
+            nodes[keys[nodeid]] = "%s\n%s:%i" % (keys[nodeid], ip, port)
+    else:
+        counts = {}
+        width = (prefix_bits + 3) // 4
+        for nodeid in nodeids:
+            prefix = to_long(nodeid) >> (ID_BITS - prefix_bits)
+            keys[nodeid] = "{0:0{1}x}/{2}".format(prefix, width, prefix_bits)
+            counts[keys[nodeid]] = counts.get(keys[nodeid], 0) + 1
+        for key, count in counts.items():
+            nodes[key] = "%s\n%i nodes" % (key, count)
+
+    # deduplicated connections between included nodes
+    edges = set()
+    for nodeid in nodeids:
+        for peerid, ip, port in network_map[nodeid]["peers"]:
+            if peerid not in included:
+                continue
+            a, b = keys[nodeid], keys[peerid]
+            if a != b:
+                edges.add((min(a, b), max(a, b)))
+
+    return nodes, edges
+
+
+def create_graph(network_map, name, engine=None, prefix_bits=None,
+                 sample=None, seed=None):
+    """Create a graphviz graph of a network map, see reduce_graph.
+
+    Unless an engine is given small graphs use circo and larger ones the
+    faster sfdp layout. Nodes of large graphs are drawn without labels.
+    """
+    nodes, edges = reduce_graph(network_map, prefix_bits=prefix_bits,
+                                sample=sample, seed=seed)
+    if engine is None:
+        engine = "circo" if len(nodes) <= CIRCO_MAX_NODES else "sfdp"
+
+    graph = Graph(comment=name, engine=engine)
+    graph.attr("graph", overlap="false", outputorder="edgesfirst")
+    labeled = len(nodes) <= LABEL_MAX_NODES
+    if not labeled:
+        graph.attr("node", shape="point")
+    for key in sorted(nodes):
+        if labeled:
+            graph.node(key, nodes[key])
+        else:
+            graph.node(key)
+    for a, b in sorted(edges):
+        graph.edge(a, b)
+    return graph
+
+
+def render(network_map, path, name, view=True, engine=None,
+           prefix_bits=None, sample=None, seed=None):
+    """Render a network map with graphviz, see create_graph.
+
+    Returns:
+        The path of the rendered file.
+    """
+    graph = create_graph(network_map, name, engine=engine,
+                         prefix_bits=prefix_bits, sample=sample, seed=seed)
+    return graph.render(os.path.join(path, '%s.gv' % name), view=view)
+
+
+def export_csv(network_map, outfile, prefix_bits=None, sample=None,
+               seed=None):
+    """Write the connections of a network map as csv, see reduce_graph."""
+    nodes, edges = reduce_graph(network_map, prefix_bits=prefix_bits,
+                                sample=sample, seed=seed)
+    writer = csv.writer(outfile, lineterminator="\n")
+    writer.writerow(["source", "target"])
+    for a, b in sorted(edges):
+        writer.writerow([a, b])
+
+
+def export_graphml(network_map, outfile, prefix_bits=None, sample=None,
+                   seed=None):
+    """Write a network map as GraphML, see reduce_graph."""
+    nodes, edges = reduce_graph(network_map, prefix_bits=prefix_bits,
+                                sample=sample, seed=seed)
+    outfile.write(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+        '  <key id="label" for="node" attr.name="label"'
+        ' attr.type="string"/>\n'
+        '  <graph id="storj" edgedefault="undirected">\n'
+    )
+    for key in sorted(nodes):
+        outfile.write('    <node id=%s><data key="label">%s</data></node>\n'
+                      % (quoteattr(key), escape(nodes[key])))
+    for a, b in sorted(edges):
+        outfile.write('    <edge source=%s target=%s/>\n'
+                      % (quoteattr(a), quoteattr(b)))
+    outfile.write('  </graph>\n</graphml>\n')
+
+
+def generate(storjnode, worker_num=DEFAULT_CONCURRENCY,
+             attempts=DEFAULT_ATTEMPTS):
     """Crawl the network to get a map of all nodes and connections.
 
+    Blocks until the network was walked.
+
     Args:
         storjnode: Node used to crawl the network.
-        worker_num: Number of workers used to crawl the network.
+        worker_num: Maximum find node requests in flight.
+        attempts: How often to attempt to contact each node.
 
     Returns: {
             nodeid: {"addr":(ip, port), "peers":[(id, ip, port)]},
         }
     """
-    return _NetworkMapper(storjnode, worker_num=worker_num).crawl()
+    @run_in_reactor
+    def walk():
+        start = [(storjnode.get_id(), "127.0.0.1", storjnode.port)]
+        return crawl(storjnode.server, start, concurrency=worker_num,
+                     attempts=attempts)
+    network_map, unreached = walk().wait()
+    return network_map
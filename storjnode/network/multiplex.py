@@ -0,0 +1,162 @@
+"""
+Framed streams multiplexed over a single pyp2p connection.
+
+Every frame is a header of the frame type, the 32 byte stream (contract)
+id and the payload length, followed by the payload. Senders may only send
+as much stream data as the receiver granted with window frames, so each
+stream is flow controlled on its own and several transfers can share a
+connection without small ones waiting behind large ones.
+"""
+
+import time
+import errno
+import socket
+import struct
+import logging
+import binascii
+
+
+FRAME_WINDOW = 1  # grants the sender credit, payload is WINDOW
+FRAME_LENGTH = 2  # total length of the stream data, payload is LENGTH
+FRAME_DATA = 3  # stream data
+FRAME_TYPES = (FRAME_WINDOW, FRAME_LENGTH, FRAME_DATA)
+
+HEADER = struct.Struct("!B32sI")  # type, stream id, payload length
+WINDOW = struct.Struct("!I")
+LENGTH = struct.Struct("!Q")
+
+DEFAULT_FRAME_SIZE = 16 * 1024  # stream data per frame
+DEFAULT_WINDOW = 256 * 1024  # credit granted per stream
+MAX_PAYLOAD = 1024 * 1024
+RECV_SIZE = 64 * 1024
+MAX_RECV = 1024 * 1024  # per call, so busy connections cannot starve others
+SEND_HIGH_WATER = 64 * 1024  # buffered bytes before pausing new frames
+
+
+_log = logging.getLogger(__name__)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Multiplexer(object):
+
+    def __init__(self, con, frame_size=DEFAULT_FRAME_SIZE):
+        """Frame reader and writer for a non-blocking pyp2p connection.
+
+        Frames are read from and written to the underlying socket directly
+        so whole buffers move per system call. Errors close the connection,
+        which process_transfers then reports for its transfers.
+
+        Args:
+            con: The connected pyp2p.sock.Sock.
+            frame_size: Maximum stream data in a single data frame.
+        """
+        self.con = con
+        self.frame_size = frame_size
+        self.backlog = []  # received frames of streams not yet opened
+        self.rotation = 0  # data frames queued, rotates the stream order
+        self._inbuf = bytearray()
+        self._outbuf = bytearray()
+
+    @property
+    def buffered(self):
+        """Number of queued bytes not yet sent."""
+        return len(self._outbuf)
+
+    def writable(self):
+        """True if more frames should be queued before flushing."""
+        return len(self._outbuf) < SEND_HIGH_WATER
+
+    def queue(self, frame_type, stream_id, payload=b""):
+        """Queue a frame to be sent by the next flush."""
+        assert(frame_type in FRAME_TYPES)
+        assert(len(payload) <= MAX_PAYLOAD)
+        header = HEADER.pack(frame_type, binascii.unhexlify(stream_id),
+                             len(payload))
+        self._outbuf += header
+        self._outbuf += payload
+
+    def window(self, stream_id, size):
+        self.queue(FRAME_WINDOW, stream_id, WINDOW.pack(size))
+
+    def length(self, stream_id, size):
+        self.queue(FRAME_LENGTH, stream_id, LENGTH.pack(size))
+
+    def data(self, stream_id, chunk):
+        self.queue(FRAME_DATA, stream_id, chunk)
+
+    def flush(self):
+        """Send as much of the queued frames as the socket accepts.
+
+        Returns:
+            The number of bytes sent.
+        """
+        sent = 0
+        while self._outbuf and self.con.connected:
+            try:
+                count = self.con.s.send(self._outbuf)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._close("Send failed: {0}".format(repr(e)))
+                break
+            del self._outbuf[:count]
+            sent += count
+        if sent:
+            self.con.alive = time.time()
+        return sent
+
+    def receive(self):
+        """Read available data and parse it into frames.
+
+        Returns:
+            A list of (frame_type, stream_id, payload) tuples.
+        """
+        received = 0
+        while received < MAX_RECV and self.con.connected:
+            try:
+                chunk = self.con.s.recv(RECV_SIZE)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._close("Receive failed: {0}".format(repr(e)))
+                break
+            if not chunk:
+                self._close("Connection closed by peer.")
+                break
+            self._inbuf += chunk
+            received += len(chunk)
+        if received:
+            self.con.alive = time.time()
+
+        try:
+            return self._parse()
+        except ProtocolError as e:
+            self._close(str(e))
+            return []
+
+    def _parse(self):
+        frames = []
+        offset = 0
+        while len(self._inbuf) - offset >= HEADER.size:
+            frame_type, stream_id, size = HEADER.unpack_from(self._inbuf,
+                                                             offset)
+            if frame_type not in FRAME_TYPES:
+                raise ProtocolError("Invalid frame type {0}.".format(
+                    frame_type
+                ))
+            if size > MAX_PAYLOAD:
+                raise ProtocolError("Frame payload too large.")
+            end = offset + HEADER.size + size
+            if len(self._inbuf) < end:
+                break  # incomplete frame
+            payload = bytes(self._inbuf[offset + HEADER.size:end])
+            stream_id = binascii.hexlify(stream_id).decode("ascii")
+            frames.append((frame_type, stream_id, payload))
+            offset = end
+        del self._inbuf[:offset]
+        return frames
+
+    def _close(self, reason):
+        _log.debug("Closing multiplexed connection: {0}".format(reason))
+        self.con.close()
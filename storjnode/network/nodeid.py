@@ -0,0 +1,56 @@
+"""
+Compact node ids for the message hot paths.
+
+kademlia.node.Node objects carry an address and convert their id through
+a hex string, too much for ids that are only compared by XOR distance.
+"""
+
+import sys
+import binascii
+
+
+if sys.version_info >= (3, 0, 0):
+    def to_long(nodeid):
+        """Returns the integer form of a binary node id."""
+        return int.from_bytes(nodeid, "big")
+else:
+    def to_long(nodeid):
+        """Returns the integer form of a binary node id."""
+        return long(binascii.hexlify(nodeid), 16)  # NOQA
+
+
+def distance(a, b):
+    """Returns the XOR distance of two binary node ids or nodes."""
+    a = a.long_id if hasattr(a, "long_id") else to_long(a)
+    b = b.long_id if hasattr(b, "long_id") else to_long(b)
+    return a ^ b
+
+
+class NodeId(object):
+    """Node id with a cached integer form.
+
+    Can be used in place of kademlia.node.Node where only the id matters,
+    such as routing table lookups.
+    """
+
+    __slots__ = ("id", "long_id")
+
+    def __init__(self, nodeid):
+        self.id = nodeid
+        self.long_id = to_long(nodeid)
+
+    def distanceTo(self, node):
+        """Get the distance to another NodeId or kademlia.node.Node."""
+        return self.long_id ^ node.long_id
+
+    def __eq__(self, other):
+        return isinstance(other, NodeId) and self.long_id == other.long_id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.long_id)
+
+    def __repr__(self):
+        return "NodeId({0})".format(binascii.hexlify(self.id))
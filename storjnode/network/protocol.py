@@ -1,31 +1,14 @@
 import binascii
-import heapq
-import operator
 import logging
 try:
     from Queue import Queue, Full  # py2
 except ImportError:
     from queue import Queue, Full  # py3
 from kademlia.protocol import KademliaProtocol
-from kademlia.routing import RoutingTable
-from kademlia.routing import TableTraverser
 from kademlia.node import Node
 from storjnode import util
-
-
-def _findNearest(self, node, k=None, exclude=None):
-    k = k or self.ksize
-    nodes = []
-    for neighbor in TableTraverser(self, node):
-        if exclude is None or not neighbor.sameHomeAs(exclude):
-            heapq.heappush(nodes, (node.distanceTo(neighbor), neighbor))
-        if len(nodes) == k:
-            break
-
-    return list(map(operator.itemgetter(1), heapq.nsmallest(k, nodes)))
-
-
-RoutingTable.findNeighbors = _findNearest  # XXX monkey patch find neighbors
+from storjnode.network.routing import StorjRoutingTable
+from storjnode.network.nodeid import distance
 
 
 class StorjProtocol(KademliaProtocol):
@@ -36,6 +19,8 @@ class StorjProtocol(KademliaProtocol):
         self.messages_relay = Queue(maxsize=max_messages)
         self.messages_received = Queue(maxsize=max_messages)
         KademliaProtocol.__init__(self, *args, **kwargs)
+        self.router = StorjRoutingTable(self, self.router.ksize,
+                                        self.sourceNode)
         self.log = logging.getLogger(__name__)
         self.noisy = False
 
@@ -43,7 +28,14 @@ class StorjProtocol(KademliaProtocol):
         return not self.messages_received.empty()
 
     def get_messages(self):
-        return util.empty_queue(self.messages_received)
+        messages = util.empty_queue(self.messages_received)
+        return [message for message in messages if message is not None]
+
+    def wait_for_messages(self, timeout):
+        return util.wait_for_queue(self.messages_received, timeout)
+
+    def wake_message_waiters(self):
+        util.wake_queue(self.messages_received)
 
     def queue_relay_message(self, entry):
         try:
@@ -85,8 +77,8 @@ class StorjProtocol(KademliaProtocol):
             return None
 
         # do not relay away from dest
-        sender_distance = Node(sender_id).distanceTo(Node(dest_id))
-        our_distance = self.sourceNode.distanceTo(Node(dest_id))
+        sender_distance = distance(sender_id, dest_id)
+        our_distance = distance(self.sourceNode, dest_id)
         if our_distance >= sender_distance:
             self.log.debug("Dropping relay message, self not closer to dest.")
             return None
@@ -0,0 +1,118 @@
+"""
+Adaptive refresh of the routing table.
+
+Only buckets without lookups since the last refresh are refreshed, by looking
+up a random id in their range, which counts as a lookup until the next
+refresh. The time between refreshes doubles while the routing table is stable
+and halves when many contacts changed since the last refresh, so stable nodes
+send little refresh traffic.
+"""
+
+import time
+import random
+import logging
+import binascii
+from kademlia.node import Node
+from kademlia.crawling import NodeSpiderCrawl
+from twisted.internet import defer
+from twisted.internet import reactor
+
+
+_log = logging.getLogger(__name__)
+
+
+CHURN_THRESHOLD = 0.1  # ratio of changed contacts that speeds up refreshing
+MIN_INTERVAL_DIVISOR = 4.0  # fastest refresh interval relative to the base
+MAX_INTERVAL_FACTOR = 8.0  # slowest refresh interval relative to the base
+
+
+def random_id_in(bucket):
+    """Returns a random binary node id in the range of a bucket."""
+    # the range includes its upper bound, 2 ** 160 for the last bucket
+    nodeid = random.randint(bucket.range[0], bucket.range[1] - 1)
+    return binascii.unhexlify("%040x" % nodeid)
+
+
+class NeighbourRefresher(object):
+
+    def __init__(self, server, interval, clock=None):
+        """Refresh stale buckets of a server's routing table periodically.
+
+        Args:
+            server: The StorjServer to refresh.
+            interval (float): Base seconds between refreshes.
+            clock: Provides callLater, the twisted reactor by default.
+        """
+        assert(interval > 0.0)
+        self.server = server
+        self.clock = clock or reactor
+        self.interval = interval
+        self.min_interval = interval / MIN_INTERVAL_DIVISOR
+        self.max_interval = interval * MAX_INTERVAL_FACTOR
+        self._last_refresh = time.time()  # same clock as bucket updates
+        self._contacts = None  # contact ids at the last refresh
+        self._delayed = None
+        self._stopped = False
+
+    def start(self):
+        """Schedule refreshes, the first after the base interval."""
+        self._stopped = False
+        self._schedule()
+
+    def stop(self):
+        """Stop refreshing, must be called from the reactor thread."""
+        self._stopped = True
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+        self._delayed = None
+
+    def get_stale_buckets(self):
+        """Returns the buckets without lookups since the last refresh."""
+        return [b for b in self.server.protocol.router.buckets
+                if b.lastUpdated < self._last_refresh]
+
+    def refresh(self):
+        """Refresh stale buckets and adapt the interval to the churn.
+
+        Returns:
+            Defered that fires once the refresh lookups completed.
+        """
+        self._delayed = None
+        self._adapt_interval()
+        started = time.time()
+        buckets = self.get_stale_buckets()
+        for bucket in buckets:
+            bucket.touchLastUpdated()  # not stale until the next refresh
+        msg = "Refreshing %i stale buckets, next refresh in %fsec"
+        _log.debug(msg % (len(buckets), self.interval))
+
+        ds = [self._lookup(Node(random_id_in(bucket))) for bucket in buckets]
+
+        def done(results):
+            self._last_refresh = started
+            self._schedule()
+        return defer.DeferredList(ds).addCallback(done)
+
+    def _lookup(self, node):
+        router = self.server.protocol.router
+        nearest = router.findNeighbors(node, k=self.server.alpha)
+        if len(nearest) == 0:
+            return defer.succeed([])
+        spider = NodeSpiderCrawl(self.server.protocol, node, nearest,
+                                 self.server.ksize, self.server.alpha)
+        return spider.find()
+
+    def _adapt_interval(self):
+        contacts = self.server.protocol.router.get_long_ids()
+        previous, self._contacts = self._contacts, contacts
+        if previous is None:
+            return
+        churn = len(previous ^ contacts) / float(max(len(previous), 1))
+        if churn >= CHURN_THRESHOLD:
+            self.interval = max(self.min_interval, self.interval / 2.0)
+        else:
+            self.interval = min(self.max_interval, self.interval * 2.0)
+
+    def _schedule(self):
+        if not self._stopped:
+            self._delayed = self.clock.callLater(self.interval, self.refresh)
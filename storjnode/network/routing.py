@@ -0,0 +1,149 @@
+"""
+Kademlia routing table with its contacts indexed by integer node id.
+
+Nodes sharing a longer id prefix with a target are always closer to it by
+XOR distance, and the ids with a given prefix are a contiguous slice of the
+sorted ids. The exact k nearest nodes are therefore found among the few
+contacts of the smallest prefix slice that holds at least k of them.
+"""
+
+import os
+import json
+import bisect
+import heapq
+import logging
+import binascii
+from storjnode.util import ensure_path_exists
+from kademlia.routing import RoutingTable
+
+
+ID_BITS = 160
+
+
+_log = logging.getLogger(__name__)
+
+
+def save_contacts(path, contacts):
+    """Save contacts to a json file at path, replacing it atomically.
+
+    Args:
+        path: File path to write to.
+        contacts: Iterable of kademlia.node.Node.
+    """
+    data = [[binascii.hexlify(c.id).decode("ascii"), c.ip, c.port]
+            for c in contacts]
+    ensure_path_exists(os.path.dirname(os.path.abspath(path)))
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as fp:
+        json.dump({"contacts": data}, fp)
+    if os.path.exists(path):
+        os.remove(path)  # windows cannot rename over files
+    os.rename(temp_path, path)
+
+
+def load_contacts(path):
+    """Load contacts saved by save_contacts.
+
+    Returns:
+        List of (nodeid, ip, port), empty if no valid file at path.
+    """
+    if not os.path.isfile(path):
+        return []
+    try:
+        with open(path, "r") as fp:
+            data = json.load(fp)
+        return [(binascii.unhexlify(hexid), ip, int(port))
+                for hexid, ip, port in data["contacts"]]
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        _log.warning("Ignoring invalid contacts file {0}: {1}".format(
+            path, repr(e)
+        ))
+        return []
+
+
+class StorjRoutingTable(RoutingTable):
+
+    on_new_contact = None  # called with contacts added to the table
+
+    def flush(self):
+        RoutingTable.flush(self)
+        self._ids = []  # sorted long ids of all contacts
+        self._nodes = {}  # long id -> contact
+
+    def addContact(self, node):
+        RoutingTable.addContact(self, node)
+        contact = self.buckets[self.getBucketFor(node)][node.id]
+        if contact is not None:  # else bucket full and node not added
+            self._index(contact)
+
+    def removeContact(self, node):
+        bucket = self.buckets[self.getBucketFor(node)]
+        RoutingTable.removeContact(self, node)
+        if bucket[node.id] is None:
+            self._unindex(node.long_id)
+
+        # a replacement node may have taken its place
+        for contact in bucket.getNodes():
+            self._index(contact)
+
+    def count(self):
+        """Returns the number of contacts."""
+        return len(self._ids)
+
+    def get_long_ids(self):
+        """Returns the set of contact long ids."""
+        return set(self._nodes)
+
+    def findNeighbors(self, node, k=None, exclude=None):
+        """Returns the k contacts nearest to node, nearest first.
+
+        Contacts at the same ip and port as exclude are skipped. Unlike
+        kademlia, node itself is included if it is a contact.
+        """
+        k = k or self.ksize
+        target = node.long_id
+        self.buckets[self.getBucketFor(node)].touchLastUpdated()
+
+        # Smallest prefix slice with k contacts, widened for excluded ones.
+        shift = self._get_shift(target, k)
+        while True:
+            lo, hi = self._get_slice(target, shift)
+            contacts = [self._nodes[i] for i in self._ids[lo:hi]]
+            if exclude is not None:
+                contacts = [c for c in contacts if not c.sameHomeAs(exclude)]
+            if len(contacts) >= k or shift == ID_BITS:
+                break
+            shift += 1
+
+        return heapq.nsmallest(k, contacts, key=lambda c: c.long_id ^ target)
+
+    def _index(self, contact):
+        is_new = contact.long_id not in self._nodes
+        if is_new:
+            bisect.insort(self._ids, contact.long_id)
+        self._nodes[contact.long_id] = contact
+        if is_new and self.on_new_contact is not None:
+            self.on_new_contact(contact)
+
+    def _unindex(self, long_id):
+        if self._nodes.pop(long_id, None) is not None:
+            del self._ids[bisect.bisect_left(self._ids, long_id)]
+
+    def _get_slice(self, target, shift):
+        # index range of the ids sharing all but the low shift bits
+        prefix = target >> shift
+        lo = bisect.bisect_left(self._ids, prefix << shift)
+        hi = bisect.bisect_left(self._ids, (prefix + 1) << shift)
+        return lo, hi
+
+    def _get_shift(self, target, k):
+        # binary search the smallest slice holding k ids
+        low, high = 0, ID_BITS
+        while low < high:
+            shift = (low + high) // 2
+            lo, hi = self._get_slice(target, shift)
+            if hi - lo >= k:
+                high = shift
+            else:
+                low = shift + 1
+        return low
@@ -1,30 +1,40 @@
-import time
 import threading
 import btctxstore
 import binascii
 import logging
+import collections
 from storjnode import util
 from kademlia.routing import TableTraverser
 from storjnode.network.protocol import StorjProtocol
+from storjnode.network.nodeid import NodeId
+from storjnode.network import routing
+from storjnode.network.refresh import NeighbourRefresher
+from storjnode.network import map as network_map
 from twisted.internet import defer
+from twisted.internet import reactor
 from pycoin.encoding import a2b_hashed_base58
 from kademlia.network import Server
 from kademlia.storage import ForgetfulStorage
-from twisted.internet.task import LoopingCall
+from twisted.internet.task import LoopingCall, deferLater
 from kademlia.node import Node
 from kademlia.crawling import NodeSpiderCrawl
-from crochet import TimeoutError
 
 
 QUERY_TIMEOUT = 5.0
 WALK_TIMEOUT = QUERY_TIMEOUT * 24
+DEFAULT_RELAY_WORKERS = 8  # concurrent relay messages
+WAKEUP_INTERVAL = 1.0  # max seconds threads block waiting for messages
+ROUTING_TABLE_SAVE_INTERVAL = 300.0  # seconds between routing table saves
+READY_MIN_PEERS = 8  # known peers for a node to be ready while bootstrapping
 
 
 class StorjServer(Server):
 
     def __init__(self, key, ksize=20, alpha=3, storage=None,
                  max_messages=1024, default_hop_limit=64,
-                 refresh_neighbours_interval=0.0):
+                 refresh_neighbours_interval=0.0,
+                 max_relay_workers=DEFAULT_RELAY_WORKERS,
+                 routing_table_path=None):
         """
         Create a server instance.  This will start listening on the given port.
 
@@ -33,10 +43,28 @@ class StorjServer(Server):
             ksize (int): The k parameter from the kademlia paper.
             alpha (int): The alpha parameter from the kademlia paper
             storage: implements :interface:`~kademlia.storage.IStorage`
-            refresh_neighbours_interval (float): Auto refresh neighbours.
+            refresh_neighbours_interval (float): Auto refresh neighbours,
+                                                 base seconds between
+                                                 refreshes of stale buckets.
+            max_messages (int): Max messages queued to relay or received,
+                                further messages are dropped.
+            max_relay_workers (int): Max relay messages sent at once.
+            routing_table_path: File the routing table is saved to
+                                periodically and on stop, its contacts
+                                are used to bootstrap on the next start.
         """
+        assert(max_relay_workers > 0)
+        self.port = None  # set by listen
         self._default_hop_limit = default_hop_limit
         self._refresh_neighbours_interval = refresh_neighbours_interval
+        self._max_relay_workers = max_relay_workers
+        self._max_messages = max_messages
+        self._relay_pending = collections.deque()  # entries waiting to relay
+        self._relay_busy = set()  # destinations being relayed to
+        self._relay_dispatching = False
+        self._relay_changed = False
+        self._bootstrapped = False
+        self._ready_waiters = []  # [(min_peers, deferred)]
 
         # TODO validate key is valid wif/hwif for mainnet or testnet
         testnet = False  # FIXME get from wif/hwif
@@ -57,8 +85,21 @@ class StorjServer(Server):
             self.node, self.storage, ksize, max_messages=max_messages,
             max_hop_limit=self._default_hop_limit
         )
+        self.protocol.router.on_new_contact = self._check_ready
         self.refreshLoop = LoopingCall(self.refreshTable).start(3600)
 
+        # restore contacts saved by the last run
+        self.routing_table_path = routing_table_path
+        self._saved_contacts = []
+        self._save_routing_table_loop = None
+        if routing_table_path is not None:
+            self._saved_contacts = routing.load_contacts(routing_table_path)
+            self._save_routing_table_loop = LoopingCall(
+                self.save_routing_table
+            )
+            self._save_routing_table_loop.start(ROUTING_TABLE_SAVE_INTERVAL,
+                                                now=False)
+
         self._start_threads()
 
     def _start_threads(self):
@@ -68,25 +109,137 @@ class StorjServer(Server):
         self._relay_thread = threading.Thread(target=self._relay_loop)
         self._relay_thread.start()
 
-        # setup refresh neighbours thread
+        # setup refresh neighbours
+        self._refresher = None
         if self._refresh_neighbours_interval > 0.0:
-            self._refresh_thread_stop = False
-            self._refresh_thread = threading.Thread(target=self._refresh_loop)
-            self._refresh_thread.start()
+            self._refresher = NeighbourRefresher(
+                self, self._refresh_neighbours_interval
+            )
+            reactor.callFromThread(self._refresher.start)
 
     def stop(self):
-        if self._refresh_neighbours_interval > 0.0:
-            self._refresh_thread_stop = True
-            self._refresh_thread.join()
+        if self._refresher is not None:
+            reactor.callFromThread(self._refresher.stop)
 
         self._relay_thread_stop = True
+        util.wake_queue(self.protocol.messages_relay)
         self._relay_thread.join()
 
+        if self._save_routing_table_loop is not None:
+            reactor.callFromThread(self._save_routing_table_loop.stop)
+            self.save_routing_table()
+
         # FIXME actually disconnect from port and stop properly
 
+    def listen(self, port):
+        self.port = port
+        return Server.listen(self, port)
+
+    def bootstrap(self, addrs):
+        """Bootstrap from addrs and the contacts saved by the last run.
+
+        All saved contacts are pinged at once and those responding are
+        added to the routing table, so a restarted node is well connected
+        after a single round trip.
+
+        Args:
+            addrs: A list of (ip, port) tuples of known nodes.
+
+        Returns:
+            Defered that fires once bootstrapped.
+        """
+        # if the transport hasn't been initialized yet, wait a second
+        if self.protocol.transport is None:
+            return deferLater(reactor, 1, self.bootstrap, addrs)
+        return self._bootstrap(addrs).addBoth(self._bootstrap_done)
+
+    def _bootstrap_done(self, result):
+        self._bootstrapped = True
+        self._check_ready()
+        return result
+
+    def _bootstrap(self, addrs):
+        saved, self._saved_contacts = self._saved_contacts, []
+        if len(saved) == 0:
+            return Server.bootstrap(self, addrs)
+        self.log.debug("Bootstrapping from %i saved contacts" % len(saved))
+
+        def add_contact(result, ip, port):
+            reached, nodeid = result
+            if reached and nodeid != self.node.id:
+                self.protocol.router.addContact(Node(nodeid, ip, port))
+
+        def crawl(results):
+            # look up own id to fill the nearest buckets
+            nearest = self.protocol.router.findNeighbors(self.node)
+            if len(nearest) == 0:
+                return None
+            spider = NodeSpiderCrawl(self.protocol, self.node, nearest,
+                                     self.ksize, self.alpha)
+            return spider.find()
+
+        pings = []
+        for nodeid, ip, port in saved:
+            d = self.protocol.ping((ip, port), self.node.id)
+            pings.append(d.addCallback(add_contact, ip, port))
+        warm = defer.DeferredList(pings).addCallback(crawl)
+        return defer.DeferredList([warm, Server.bootstrap(self, addrs)])
+
+    def is_ready(self, min_peers=READY_MIN_PEERS):
+        """Returns True if the node is bootstrapped.
+
+        A node is ready once it knows min_peers, or knows any peers after
+        its first bootstrap finished.
+        """
+        peers = self.protocol.router.count()
+        return peers >= min_peers or (self._bootstrapped and peers > 0)
+
+    def when_ready(self, min_peers=READY_MIN_PEERS):
+        """Wait until the node is ready, see is_ready.
+
+        Returns:
+            Defered number of known peers once ready.
+        """
+        d = defer.Deferred()
+        self._ready_waiters.append((min_peers, d))
+        self._check_ready()
+        return d
+
+    def _check_ready(self, contact=None):
+        ready = [(m, d) for m, d in self._ready_waiters if self.is_ready(m)]
+        if len(ready) == 0:
+            return
+        self._ready_waiters = [w for w in self._ready_waiters
+                               if w not in ready]
+        for min_peers, d in ready:
+            d.callback(self.protocol.router.count())
+
+    def save_routing_table(self, path=None):
+        """Save the routing table contacts.
+
+        Args:
+            path: File to save to, routing_table_path by default.
+        """
+        path = path or self.routing_table_path
+        assert(path is not None)
+        contacts = []
+        for bucket in list(self.protocol.router.buckets):
+            contacts.extend(bucket.getNodes())
+        if len(contacts) == 0:
+            self.log.debug("No contacts, not saving routing table.")
+            return
+        try:
+            routing.save_contacts(path, contacts)
+            msg = "Saved %i contacts to %s"
+            self.log.debug(msg % (len(contacts), path))
+        except (IOError, OSError) as e:
+            self.log.error("Saving routing table failed: %s" % repr(e))
+
     def refresh_neighbours(self):
         self.log.debug("Refreshing neighbours ...")
-        self.bootstrap(self.bootstrappableNeighbors())
+        reactor.callFromThread(
+            lambda: self.bootstrap(self.bootstrappableNeighbors())
+        )
 
     def get_id(self):
         address = self._btctxstore.get_address(self.key)
@@ -102,6 +255,14 @@ class StorjServer(Server):
     def get_messages(self):
         return self.protocol.get_messages()
 
+    def wait_for_messages(self, timeout=WAKEUP_INTERVAL):
+        """Wait until messages were received and return them."""
+        return self.protocol.wait_for_messages(timeout)
+
+    def wake_message_waiters(self):
+        """Wake threads blocked in wait_for_messages."""
+        self.protocol.wake_message_waiters()
+
     def relay_message(self, nodeid, message):
         """Send relay message to a node.
 
@@ -135,20 +296,37 @@ class StorjServer(Server):
         })
 
     def _relay_message(self, entry):
-        """Returns entry if failed to relay to a closer node or None"""
+        """Relay entry to the nearest node closer to its destination.
+
+        Nodes are tried one after the other until one accepts the message.
 
-        dest = Node(entry["dest"])
+        Returns:
+            A twisted.internet.defer.Deferred that resolves to the relay
+            result if relayed to a closer node, otherwise None.
+        """
+        dest = NodeId(entry["dest"])
         nearest = self.protocol.router.findNeighbors(dest, exclude=self.node)
         self.log.debug("Relaying to nearest: %s" % repr(nearest))
+        our_distance = dest.distanceTo(self.node)
+        candidates = []
         for relay_node in nearest:
 
             # do not relay away from node
-            if dest.distanceTo(self.node) <= dest.distanceTo(relay_node):
+            if our_distance <= dest.distanceTo(relay_node):
                 msg = "Skipping %s, farther then self."
                 self.log.debug(msg % repr(relay_node))
                 continue
+            candidates.append(relay_node)
+
+        def relay(index):
+            if index == len(candidates):
+                # failed to relay message
+                dest_hexid = binascii.hexlify(entry["dest"])
+                self.log.debug("Failed to relay message for %s" % dest_hexid)
+                return None
 
             # relay message
+            relay_node = candidates[index]
             hexid = binascii.hexlify(relay_node.id)
             self.log.debug("Attempting to relay message for %s" % hexid)
             defered = self.protocol.callRelayMessage(
@@ -156,36 +334,71 @@ class StorjServer(Server):
             )
             defered = util.default_defered(defered, None)
 
-            # wait for relay result
-            try:
-                result = util.wait_for_defered(defered, timeout=QUERY_TIMEOUT)
-            except TimeoutError:  # pragma: no cover
-                msg = "Timeout while relayed message to %s"  # pragma: no cover
-                self.log.debug(msg % hexid)  # pragma: no cover
-                result = None  # pragma: no cover
+            def handle(result):
+                if result is None:
+                    return relay(index + 1)
 
-            # successfull relay
-            if result is not None:
+                # successfull relay
                 self.log.debug("Successfully relayed message to %s" % hexid)
-                return  # relay to nearest peer, avoid amplification attacks
+                return result  # relay to nearest peer, avoid amplification
 
-        # failed to relay message
-        dest_hexid = binascii.hexlify(entry["dest"])
-        self.log.debug("Failed to relay message for %s" % dest_hexid)
+            return defered.addCallback(handle)
 
-    def _refresh_loop(self):
-        while not self._refresh_thread_stop:
-            # sleep first because of initial bootstrap
-            # FIXME loop quicker by saving next refresh time, for faster stop
-            time.sleep(self._refresh_neighbours_interval)
-            self.refresh_neighbours()
+        return defer.maybeDeferred(relay, 0)
+
+    def _relay_dispatch(self):
+        """Start relaying pending entries while workers are available.
+
+        Must be called in the reactor thread. Entries for a destination
+        are relayed one at a time so they arrive in the order queued.
+        """
+        # relays that complete at once only flag another pass
+        self._relay_changed = True
+        if self._relay_dispatching:
+            return
+        self._relay_dispatching = True
+        try:
+            while self._relay_changed:
+                self._relay_changed = False
+                waiting = collections.deque()
+                while self._relay_pending:
+                    entry = self._relay_pending.popleft()
+                    busy = len(self._relay_busy) >= self._max_relay_workers
+                    if busy or entry["dest"] in self._relay_busy:
+                        waiting.append(entry)
+                        continue
+                    self._relay_busy.add(entry["dest"])
+                    defered = self._relay_message(entry)
+                    defered.addErrback(self._relay_error)
+                    defered.addBoth(self._relay_done, entry["dest"])
+                self._relay_pending = waiting
+        finally:
+            self._relay_dispatching = False
+
+    def _relay_error(self, failure):
+        self.log.error("Error while relaying message: %s" % failure)
+
+    def _relay_done(self, result, dest):
+        self._relay_busy.discard(dest)
+        self._relay_dispatch()
+
+    def _relay_queue(self, entries):
+        for entry in entries:
+
+            # drop entries that do not fit, as the protocol queue is emptied
+            if len(self._relay_pending) >= self._max_messages:
+                msg = "Relay message queue full, dropping message for %s"
+                self.log.warning(msg % binascii.hexlify(entry["dest"]))
+                continue
+            self._relay_pending.append(entry)
+        self._relay_dispatch()
 
     def _relay_loop(self):
+        queue = self.protocol.messages_relay
         while not self._relay_thread_stop:
-            # FIXME use worker pool to process queue
-            for entry in util.empty_queue(self.protocol.messages_relay):
-                self._relay_message(entry)
-            time.sleep(0.05)
+            entries = util.wait_for_queue(queue, WAKEUP_INTERVAL)
+            if entries:
+                reactor.callFromThread(self._relay_queue, entries)
 
     def direct_message(self, nodeid, message):
         """Send direct message to a node.
@@ -225,6 +438,103 @@ class StorjServer(Server):
                                  self.ksize, self.alpha)
         return spider.find().addCallback(found_callback)
 
+    def get_many(self, keys):
+        """Get several keys, looking them up concurrently.
+
+        Args:
+            keys: Iterable of keys to get.
+
+        Returns:
+            Defered dict {key: value}, value is None if not found.
+        """
+        keys = list(set(keys))
+
+        def handle(results):
+            values = {}
+            for key, (success, value) in zip(keys, results):
+                if not success:
+                    msg = "Failed to get key %s: %s"
+                    self.log.warning(msg % (key, value.getErrorMessage()))
+                values[key] = value if success else None
+            return values
+
+        ds = [self.get(key) for key in keys]
+        return defer.DeferredList(ds, consumeErrors=True).addCallback(handle)
+
+    def set_many(self, items):
+        """Set several keys, looking up the nodes to store them concurrently.
+
+        Every key is looked up on its own, as it must be stored on the
+        nodes nearest to it.
+
+        Args:
+            items: Dict or iterable of (key, value) pairs.
+
+        Returns:
+            Defered dict {key: True if stored on any node else False}.
+        """
+        items = dict(items)
+        keys = list(items.keys())
+
+        def handle(results):
+            stored = {}
+            for key, (success, result) in zip(keys, results):
+                if not success:
+                    msg = "Failed to set key %s: %s"
+                    self.log.warning(msg % (key, result.getErrorMessage()))
+                stored[key] = bool(result) if success else False
+            return stored
+
+        ds = [self.set(key, items[key]) for key in keys]
+        return defer.DeferredList(ds, consumeErrors=True).addCallback(handle)
+
+    def map_network(self, outfile=None, attempts=2, resume=None,
+                    concurrency=network_map.DEFAULT_CONCURRENCY):
+        """Crawl the network starting at this node and its known peers.
+
+        Args:
+            outfile: A file like object nodes are written to once scanned.
+            attempts: How often to attempt to contact each node.
+            resume: A file like object with the output of an earlier crawl
+                    to continue, unreached nodes are tried again.
+            concurrency: Maximum find node requests in flight.
+
+        Returns:
+            Defered (num_nodes_found, num_nodes_unreached)
+        """
+        start = [tuple(node) for node in self.get_known_peers()]
+        if self.port is not None:
+            start.insert(0, (self.node.id, "127.0.0.1", self.port))
+
+        resumed = None
+        if resume is not None:
+            scanned, unreached = network_map.load(resume)
+            resumed = dict((nodeid, results)
+                           for nodeid, results in scanned.items()
+                           if nodeid not in unreached)
+
+            # the output may end in an incomplete record, start a new line
+            # so the next record is not appended to it
+            if outfile is not None:
+                outfile.write("\n")
+
+        def progress(scanned, pending):
+            msg = "Mapped %i nodes, %i pending."
+            self.log.debug(msg % (scanned, pending))
+
+        def sink(nodeid, addr, peers, reached):
+            network_map.write_record(outfile, nodeid, addr, peers, reached)
+
+        def handle(result):
+            scanned, unreached = result
+            return len(scanned), len(unreached)
+
+        d = network_map.crawl(self, start, concurrency=concurrency,
+                              attempts=attempts, progress=progress,
+                              sink=sink if outfile is not None else None,
+                              resume=resumed)
+        return d.addCallback(handle)
+
     def get_hex_id(self):
         return binascii.hexlify(self.get_id())
 
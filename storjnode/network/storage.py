@@ -0,0 +1,169 @@
+"""
+Persistent DHT value storage.
+
+Values are kept in a sqlite database instead of memory, so a restarted node
+still holds the values it was asked to store and memory use does not grow
+with the number of values.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+import umsgpack
+from zope.interface import implementer
+from kademlia.storage import IStorage
+from storjnode.common import STORJ_HOME
+
+
+DEFAULT_PATH = os.path.join(STORJ_HOME, "dht.sqlite")
+DEFAULT_TTL = 604800  # a week, same as kademlia.storage.ForgetfulStorage
+DEFAULT_MAX_ENTRIES = 65536
+ITERATE_PAGE_SIZE = 256  # values loaded at once when iterating
+
+
+_log = logging.getLogger(__name__)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dht_values (
+    key BLOB PRIMARY KEY,
+    value BLOB NOT NULL,
+    birthday REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dht_values_birthday ON dht_values (birthday);
+"""
+
+
+@implementer(IStorage)
+class SqliteStorage(object):
+
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        """Create a sqlite backed storage, existing values are kept.
+
+        Args:
+            path: Database file path, ":memory:" for a temporary database.
+            ttl: Seconds values are kept after they were last set.
+            max_entries: Max values stored, the oldest are removed first.
+        """
+        assert(ttl > 0)
+        assert(max_entries > 0)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._mutex = threading.RLock()
+        if path != ":memory:":
+            dirname = os.path.dirname(os.path.abspath(path))
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._count = self._db.execute(
+            "SELECT COUNT(*) FROM dht_values"
+        ).fetchone()[0]
+        self.cull()
+        _log.debug("Loaded %i dht values from %s" % (self._count, path))
+
+    def __setitem__(self, key, value):
+        with self._mutex, self._db:
+            key = sqlite3.Binary(key)
+            exists = self._db.execute(
+                "SELECT 1 FROM dht_values WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO dht_values VALUES (?, ?, ?)",
+                (key, sqlite3.Binary(umsgpack.packb(value)), time.time())
+            )
+            if not exists:
+                self._count += 1
+            self._cull()
+
+    def __getitem__(self, key):
+        with self._mutex:
+            row = self._db.execute(
+                "SELECT value FROM dht_values WHERE key = ? AND birthday > ?",
+                (sqlite3.Binary(key), time.time() - self.ttl)
+            ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return umsgpack.unpackb(bytes(row[0]))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        with self._mutex:
+            return self._db.execute(
+                "SELECT 1 FROM dht_values WHERE key = ? AND birthday > ?",
+                (sqlite3.Binary(key), time.time() - self.ttl)
+            ).fetchone() is not None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return (key for key, value in self.iteritems())
+
+    def cull(self):
+        """Remove expired values."""
+        with self._mutex, self._db:
+            self._cull()
+
+    def _cull(self):
+        removed = self._db.execute(
+            "DELETE FROM dht_values WHERE birthday <= ?",
+            (time.time() - self.ttl,)
+        ).rowcount
+
+        # remove oldest values if full
+        overflow = max(0, self._count - removed - self.max_entries)
+        if overflow > 0:
+            removed += self._db.execute(
+                "DELETE FROM dht_values WHERE key IN (SELECT key FROM "
+                "dht_values ORDER BY birthday LIMIT ?)", (overflow,)
+            ).rowcount
+        self._count -= removed
+
+    def iteritemsOlderThan(self, secondsOld):
+        """Iterate (key, value) of values set at least secondsOld ago.
+
+        Used to republish values, oldest first.
+        """
+        now = time.time()
+        return self._iterate(now - self.ttl, now - secondsOld)
+
+    def iteritems(self):
+        """Iterate (key, value) of all values, oldest first."""
+        return self._iterate(time.time() - self.ttl, time.time())
+
+    def _iterate(self, after, until):
+        # Fetched in pages continuing after the last row, so memory use is
+        # bounded and values may be set while iterating.
+        query = (
+            "SELECT key, value, birthday FROM dht_values "
+            "WHERE birthday <= ? AND (birthday > ? OR "
+            "(birthday = ? AND key > ?)) ORDER BY birthday, key LIMIT ?"
+        )
+        last_key = None  # no key compares greater than NULL
+        while True:
+            with self._mutex:
+                rows = self._db.execute(
+                    query, (until, after, after, last_key, ITERATE_PAGE_SIZE)
+                ).fetchall()
+            for key, value, birthday in rows:
+                yield bytes(key), umsgpack.unpackb(bytes(value))
+            if len(rows) < ITERATE_PAGE_SIZE:
+                return
+            after, last_key = rows[-1][2], rows[-1][0]
+
+    def close(self):
+        """Close the database, the storage cannot be used afterwards."""
+        with self._mutex:
+            self._db.close()
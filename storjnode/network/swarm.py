@@ -0,0 +1,219 @@
+"""
+Download a shard from several peers at once.
+
+The shard is split into pieces that are requested as byte range contracts
+from the peers. Peers ask for the next piece when one of theirs completes,
+so fast peers download more of the shard. Once no pieces are left, pieces
+still held by slow peers are also requested from idle ones and whichever
+completes first is used.
+"""
+
+import time
+import logging
+import storjnode
+from twisted.internet import defer
+from twisted.internet import threads
+
+
+DEFAULT_PIECE_SIZE = 1024 * 1024 * 4
+DEFAULT_MAX_PENDING = 2  # concurrent pieces requested from a peer
+DEFAULT_MAX_FAILURES = 2  # failed requests before a peer is dropped
+MAX_DUPLICATES = 1  # extra requests of a piece held by a slow peer
+
+
+_log = logging.getLogger(__name__)
+
+
+class SwarmDownload(object):
+
+    def __init__(self, client, data_id, peer_unls, file_size,
+                 piece_size=DEFAULT_PIECE_SIZE,
+                 max_pending=DEFAULT_MAX_PENDING,
+                 max_failures=DEFAULT_MAX_FAILURES):
+        """Download a shard from several peers, see start.
+
+        Args:
+            client: The storjnode.network.file_transfer.FileTransfer.
+            data_id: The sha256 sum of the shard to download.
+            peer_unls: UNLs of the peers storing the shard.
+            file_size: The size of the shard in bytes.
+            piece_size: The size of the byte ranges requested from peers.
+            max_pending: Maximum pieces requested from a peer at once.
+            max_failures: Failed requests before a peer is dropped.
+        """
+        assert(storjnode.storage.shard.valid_id(data_id))
+        assert(len(peer_unls))
+        self.client = client
+        self.data_id = data_id
+        self.file_size = file_size
+        self.max_pending = max_pending
+        self.max_failures = max_failures
+        self.path = None
+        self.deferred = defer.Deferred()
+        self.finished = False
+
+        # Pieces not yet requested, in flight and done.
+        self.pieces = [
+            (offset, min(piece_size, file_size - offset))
+            for offset in range(0, file_size, piece_size)
+        ]
+        self.queued = list(self.pieces)
+        self.requests = []  # [{"piece", "peer", "started"}]
+        self.done = set()
+
+        # Download statistics of the peers.
+        self.peers = {}
+        for peer_unl in peer_unls:
+            self.peers[peer_unl] = {"bytes": 0, "seconds": 0.0,
+                                    "failures": 0}
+
+    def start(self):
+        """Start downloading.
+
+        Returns:
+            A twisted.internet.defer.Deferred that resolves to the clients
+            success value once the shard was verified and stored.
+
+        Raises:
+            Exception: If already downloading the shard.
+        """
+        client = self.client
+        if self.data_id in client.downloading:
+            raise Exception("Already trying to download this.")
+        self.path = client.store.create_temp_file(self.file_size)
+        client.downloading[self.data_id] = self.path
+        client.swarms[self.data_id] = self
+        self.fill()
+        return self.deferred
+
+    def get_rate(self, peer_unl):
+        """Returns the measured bytes per second of a peer or None."""
+        stats = self.peers[peer_unl]
+        if not stats["seconds"]:
+            return None
+        return stats["bytes"] / stats["seconds"]
+
+    def fill(self):
+        """Request pieces until every peer has max_pending in flight."""
+        if self.finished:
+            return
+        if len(self.done) == len(self.pieces):
+            return self._verify()
+        if not self.peers:
+            return self._finish(storjnode.network.file_transfer.TransferError(
+                "No peers left to download from."
+            ))
+
+        for peer_unl in self._get_idle_peers():
+            while self._count_pending(peer_unl) < self.max_pending:
+                # failed requests may finish or drop the peer
+                if self.finished or peer_unl not in self.peers:
+                    break
+                piece = self._next_piece(peer_unl)
+                if piece is None:
+                    break
+                self._request(piece, peer_unl)
+
+    def _get_idle_peers(self):
+        # fastest first, so they get the remaining pieces
+        def key(peer_unl):
+            rate = self.get_rate(peer_unl)
+            return -rate if rate is not None else 0
+        return sorted(self.peers, key=key)
+
+    def _count_pending(self, peer_unl):
+        return len([r for r in self.requests if r["peer"] == peer_unl])
+
+    def _next_piece(self, peer_unl):
+        if self.queued:
+            return self.queued.pop(0)
+
+        # Endgame: also request pieces held by the slowest peers.
+        candidates = []
+        for request in self.requests:
+            piece = request["piece"]
+            holders = [r["peer"] for r in self.requests
+                       if r["piece"] == piece]
+            if peer_unl in holders or len(holders) > MAX_DUPLICATES:
+                continue
+            rate = self.get_rate(request["peer"]) or 0
+            candidates.append((rate, request["started"], piece))
+        if not candidates:
+            return None
+        return min(candidates)[2]
+
+    def _request(self, piece, peer_unl):
+        request = {"piece": piece, "peer": peer_unl, "started": time.time()}
+        self.requests.append(request)
+        try:
+            d = self.client.data_request(
+                u"download", self.data_id, self.file_size, peer_unl,
+                offset=piece[0], length=piece[1]
+            )
+        except Exception as e:
+            return self._on_failure(e, request)
+        d.addCallbacks(self._on_success, self._on_failure,
+                       callbackArgs=(request,), errbackArgs=(request,))
+
+    def _on_success(self, result, request):
+        self.requests.remove(request)
+        piece = request["piece"]
+        stats = self.peers.get(request["peer"])
+        if stats is not None:
+            stats["bytes"] += piece[1]
+            stats["seconds"] += time.time() - request["started"]
+        self.done.add(piece)
+        self.fill()
+
+    def _on_failure(self, failure, request):
+        self.requests.remove(request)
+        piece = request["piece"]
+        peer_unl = request["peer"]
+        msg = "Swarm download of {0} {1} from {2} failed: {3}"
+        _log.debug(msg.format(self.data_id, piece, peer_unl, failure))
+
+        # Drop unreliable peers.
+        stats = self.peers.get(peer_unl)
+        if stats is not None:
+            stats["failures"] += 1
+            if stats["failures"] >= self.max_failures:
+                del self.peers[peer_unl]
+
+        # Request again unless done or still requested from another peer.
+        requested = [r["piece"] for r in self.requests]
+        if piece not in self.done and piece not in requested:
+            self.queued.insert(0, piece)
+        self.fill()
+
+    def _verify(self):
+        self.finished = True
+        client = self.client
+        client.close_data_handles(self.data_id)
+        del client.swarms[self.data_id]
+        del client.downloading[self.data_id]
+
+        def get_id():
+            with open(self.path, "rb") as shard:
+                return storjnode.storage.shard.get_id(shard)
+
+        def check(found_id):
+            if found_id != self.data_id:
+                client.store.remove_temp_file(self.path)
+                e = storjnode.network.file_transfer.TransferError(
+                    "Downloaded data hash mismatch."
+                )
+                return self.deferred.errback(e)
+            client.store.move(self.path, self.data_id)
+            self.deferred.callback(client.success_value)
+
+        d = threads.deferToThread(get_id)  # hash without blocking reactor
+        d.addCallbacks(check, self.deferred.errback)
+
+    def _finish(self, error):
+        self.finished = True
+        client = self.client
+        client.close_data_handles(self.data_id)
+        del client.swarms[self.data_id]
+        del client.downloading[self.data_id]
+        client.store.remove_temp_file(self.path)
+        self.deferred.errback(error)
@@ -0,0 +1,241 @@
+import os
+import json
+import logging
+import threading
+import storjnode
+
+
+INDEX_FILENAME = ".shard_index"
+COMPACT_MIN_RECORDS = 1024  # never compact journals smaller than this
+
+
+_log = logging.getLogger(__name__)
+_indexes = {}  # {path: ShardIndex}
+_indexes_mutex = threading.Lock()
+
+
+class ShardIndex(object):
+
+    def __init__(self, store_path):
+        """Persistent index of the shards in a store path.
+
+        Maps shard ids to their location, size and mtime so lookups can be
+        answered without touching the filesystem. Changes are appended to a
+        journal in the store path, which is replayed on load and compacted
+        once it holds more stale than live records.
+
+        The index doubles as a usage ledger, the bytes used by the indexed
+        shards are tracked in `used` and `len(index)` is the shard count.
+
+        Args:
+            store_path: The normalized store path to index.
+        """
+        self.store_path = store_path
+        self.path = os.path.join(store_path, INDEX_FILENAME)
+        self._mutex = threading.RLock()
+        self._shards = {}  # {shard_id: {"path": relpath, "size", "mtime"}}
+        self._records = 0  # number of records in the journal
+        self.used = 0  # bytes used by indexed shards
+        self.load()
+
+    def __contains__(self, shard_id):
+        return shard_id in self._shards
+
+    def __len__(self):
+        return len(self._shards)
+
+    def __iter__(self):
+        with self._mutex:
+            return iter(list(self._shards))
+
+    def load(self):
+        """Load the index from its journal, rebuild from disk if needed."""
+        with self._mutex:
+            if not os.path.isfile(self.path):
+                return self.rebuild()
+            shards = {}
+            records = 0
+            try:
+                with open(self.path, "r") as journal:
+                    for line in journal:
+                        record = json.loads(line)
+                        if record[0] == "+":
+                            shard_id, relpath, size, mtime = record[1:]
+                            shards[shard_id] = {
+                                "path": relpath, "size": size, "mtime": mtime
+                            }
+                        elif record[0] == "-":
+                            shards.pop(record[1], None)
+                        records += 1
+            except (ValueError, IndexError, TypeError):
+                msg = "Corrupt shard index {0}, rebuilding from disk!"
+                _log.warning(msg.format(self.path))
+                return self.rebuild()
+            self._shards = shards
+            self._records = records
+            self.used = sum(e["size"] for e in shards.values())
+
+    def rebuild(self):
+        """Rebuild the index by scanning the store path for shards."""
+        with self._mutex:
+            shards = self._scan()
+            self._shards = shards
+            self.used = sum(e["size"] for e in shards.values())
+            if os.path.isdir(self.store_path):
+                self.compact()
+            msg = "Indexed {0} shards in '{1}'."
+            _log.info(msg.format(len(shards), self.store_path))
+
+    def reconcile(self):
+        """Correct the index and usage ledger against the shards on disk.
+
+        Unlike rebuild the disk is scanned without holding the index lock,
+        so shards can be added and removed while reconciling.
+
+        Returns:
+            The number of corrected index entries.
+        """
+        found = self._scan()
+        corrected = 0
+        with self._mutex:
+            for shard_id in set(self._shards) | set(found):
+                indexed = self._shards.get(shard_id)
+                if indexed == found.get(shard_id):
+                    continue
+
+                # disk may have changed since scanning, so check again
+                entry = self._stat(indexed) or self._stat(found.get(shard_id))
+                if entry == indexed:
+                    continue
+                if entry is None:
+                    self.remove(shard_id)
+                else:
+                    self._set(shard_id, entry)
+                corrected += 1
+        if corrected:
+            msg = "Corrected {0} shard index entries for '{1}'."
+            _log.warning(msg.format(corrected, self.store_path))
+        return corrected
+
+    def reconcile_in_background(self):
+        """Reconcile the index in a daemon thread."""
+        def target():
+            try:
+                self.reconcile()
+            except (IOError, OSError) as e:  # pragma: no cover
+                msg = "Reconciling shard index '{0}' failed: {1}"
+                _log.error(msg.format(self.store_path, repr(e)))
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def compact(self):
+        """Rewrite the journal so it only contains live records."""
+        with self._mutex:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as journal:
+                for shard_id, entry in self._shards.items():
+                    journal.write(self._record("+", shard_id, entry))
+            if os.path.exists(self.path):
+                os.remove(self.path)  # windows cannot rename over files
+            os.rename(temp_path, self.path)
+            self._records = len(self._shards)
+
+    def get(self, shard_id):
+        """Returns the absolute path of an indexed shard or None."""
+        entry = self._shards.get(shard_id)
+        if entry is None:
+            return None
+        return os.path.join(self.store_path, entry["path"])
+
+    def add(self, shard_id, shard_path):
+        """Add a shard saved at the given path to the index."""
+        self._set(shard_id, {
+            "path": os.path.relpath(shard_path, self.store_path),
+            "size": os.path.getsize(shard_path),
+            "mtime": os.path.getmtime(shard_path)
+        })
+
+    def remove(self, shard_id):
+        """Remove a shard from the index."""
+        with self._mutex:
+            entry = self._shards.pop(shard_id, None)
+            if entry is not None:
+                self.used -= entry["size"]
+                self._append(self._record("-", shard_id))
+
+    def _set(self, shard_id, entry):
+        with self._mutex:
+            previous = self._shards.get(shard_id)
+            if previous is not None:
+                self.used -= previous["size"]
+            self._shards[shard_id] = entry
+            self.used += entry["size"]
+            self._append(self._record("+", shard_id, entry))
+
+    def _stat(self, entry):
+        if entry is None:
+            return None
+        path = os.path.join(self.store_path, entry["path"])
+        if not os.path.isfile(path):
+            return None
+        return dict(entry, size=os.path.getsize(path),
+                    mtime=os.path.getmtime(path))
+
+    def _scan(self):
+        shards = {}
+        for dirpath, dirnames, filenames in os.walk(self.store_path):
+            for filename in filenames:
+                if not storjnode.storage.shard.valid_id(filename):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    shards[filename] = {
+                        "path": os.path.relpath(path, self.store_path),
+                        "size": os.path.getsize(path),
+                        "mtime": os.path.getmtime(path)
+                    }
+                except OSError:  # pragma: no cover
+                    pass  # removed while scanning
+        return shards
+
+    def _record(self, op, shard_id, entry=None):
+        if entry is None:
+            return json.dumps([op, shard_id]) + "\n"
+        record = [op, shard_id, entry["path"], entry["size"], entry["mtime"]]
+        return json.dumps(record) + "\n"
+
+    def _append(self, record):
+        with open(self.path, "a") as journal:
+            journal.write(record)
+        self._records += 1
+        stale = self._records - len(self._shards)
+        if self._records > COMPACT_MIN_RECORDS and stale > len(self._shards):
+            self.compact()
+
+
+def get_index(store_path):
+    """Get the index for a store path, it is only loaded once per process.
+
+    Args:
+        store_path: The store path, normalized if not already loaded.
+
+    Returns:
+        The storjnode.storage.index.ShardIndex for the store path.
+    """
+    index = _indexes.get(store_path)
+    if index is not None:
+        return index
+    with _indexes_mutex:
+        normalized_path = os.path.realpath(store_path)
+        index = _indexes.get(normalized_path)
+        if index is None:
+            journal_path = os.path.join(normalized_path, INDEX_FILENAME)
+            journal_exists = os.path.isfile(journal_path)
+            index = ShardIndex(normalized_path)
+            _indexes[normalized_path] = index
+            if journal_exists:  # shards may have changed while not running
+                index.reconcile_in_background()
+        _indexes[store_path] = index  # skip normalizing on next lookup
+        return index
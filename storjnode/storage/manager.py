@@ -1,6 +1,12 @@
 import os
+import time
+import json
+import errno
 import random
 import logging
+import hashlib
+import tempfile
+import threading
 import storjnode
 from storjnode.common import STORJ_HOME
 
@@ -10,10 +16,13 @@ DEFAULT_STORE_PATH = os.path.join(STORJ_HOME, "store")
 DEFAULT_STORE_CONFIG = {
     DEFAULT_STORE_PATH: {"limit": 0, "use_folder_tree": False}
 }
+DEFAULT_FREE_SPACE_TTL = 60.0  # seconds
 
 
 _log = logging.getLogger(__name__)
 _builtin_open = open
+_stores = {}  # {store_config_key: Store}
+_stores_mutex = threading.Lock()
 
 
 def _get_shard_path(store_path, shard_id, use_folder_tree,
@@ -26,6 +35,18 @@ def _get_shard_path(store_path, shard_id, use_folder_tree,
     return os.path.join(store_path, shard_id)
 
 
+def _get_temp_path(store_path):
+    # not a valid shard id, so ignored by the shard index
+    fd, path = tempfile.mkstemp(prefix=".part-", dir=store_path)
+    os.close(fd)
+    return path
+
+
+def _get_partial_path(store_path, shard_id):
+    # not a valid shard id, so ignored by the shard index
+    return os.path.join(store_path, ".partial-" + shard_id)
+
+
 def setup(store_config=None):
     """Setup store so it can be use to store shards.
 
@@ -37,7 +58,8 @@ def setup(store_config=None):
                       use_folder_tree: Files organized in a folder tree
                                        (always on for fat partitions).
     Returns:
-        The normalized store_config with any missing attributes added.
+        The normalized store_config with any missing attributes added
+        and the filesystem type of each path under "fs_type".
 
     Raises:
         AssertionError: If input not valid.
@@ -64,7 +86,7 @@ def setup(store_config=None):
         assert(isinstance(limit, int) or isinstance(limit, long))
         assert(limit >= 0)
         free = storjnode.util.get_free_space(path)
-        used = storjnode.util.get_folder_size(path)
+        used = storjnode.storage.index.get_index(path).used
         available = (free + used)
         if limit > available:
             msg = ("Invalid storage limit for {0}: {1} > available {2}. "
@@ -73,18 +95,379 @@ def setup(store_config=None):
             limit = available  # set to available if to large
 
         # check use_folder_tree
+        fs_type = storjnode.util.get_fs_type(path)
         use_folder_tree = attributes.get("use_folder_tree", False)
-        if not use_folder_tree and storjnode.util.get_fs_type(path) == "vfat":
+        if not use_folder_tree and fs_type == "vfat":
             use_folder_tree = True  # pragma: no cover
 
         normal_paths[path] = {
-            "use_folder_tree": use_folder_tree, "limit": limit
+            "use_folder_tree": use_folder_tree, "limit": limit,
+            "fs_type": fs_type
         }
         msg = "Storing data in '{0}' with a capacity of {1}bytes!"
         _log.info(msg.format(path, limit or available))
     return normal_paths
 
 
+class Store(object):
+
+    def __init__(self, store_config=None,
+                 free_space_ttl=DEFAULT_FREE_SPACE_TTL):
+        """Shard storage over a set of store paths.
+
+        The store config is normalized and validated only once, so lookups
+        and inserts do not repeat the path, filesystem and limit checks.
+
+        Args:
+            store_config: Dict of storage paths to optional attributes.
+                          limit: The dir size limit in bytes, 0 for no limit.
+                          use_folder_tree: Files organized in a folder tree
+                                           (always on for fat partitions).
+            free_space_ttl: Seconds before free disc space is checked again.
+
+        Raises:
+            AssertionError: If input not valid.
+        """
+        self.config = setup(store_config)
+        self.free_space_ttl = free_space_ttl
+        self._free_space = {}  # {store_path: (timestamp, free_bytes)}
+        self._reserved = {}  # {temp_path: (store_path, size)}
+        self._space_mutex = threading.RLock()  # downloads finish in threads
+        self._indexes = dict([
+            (path, storjnode.storage.index.get_index(path))
+            for path in self.config.keys()
+        ])
+
+    def get_free_space(self, store_path):
+        """Returns free disc space of a store path, cached for the ttl."""
+        with self._space_mutex:
+            now = time.time()
+            cached = self._free_space.get(store_path)
+            if cached is None or now - cached[0] > self.free_space_ttl:
+                cached = (now, storjnode.util.get_free_space(store_path))
+                self._free_space[store_path] = cached
+            return cached[1]
+
+    def get_used_space(self, store_path):
+        """Returns the bytes used by shards in a store path."""
+        return self._indexes[store_path].used
+
+    def find(self, shard_id):
+        """Returns the path of a shard or None if not found."""
+        assert(storjnode.storage.shard.valid_id(shard_id))
+        for index in self._indexes.values():
+            shard_path = index.get(shard_id)
+            if shard_path is not None:
+                return shard_path
+        return None
+
+    def open(self, shard_id):
+        """Returns a read only file object for a shard.
+
+        Raises:
+            KeyError: If shard was not found.
+        """
+        shard_path = self.find(shard_id)
+        if shard_path is not None:
+            try:
+                return _builtin_open(shard_path, "rb")
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._unindex(shard_id)  # removed outside of manager
+        raise KeyError("Shard {0} not found!".format(shard_id))
+
+    def add(self, shard, shard_id=None, link=False):
+        """Add a shard and return its path.
+
+        The shard data is read only once. Real files are hashed and then
+        copied by the kernel, other file like objects are hashed while
+        being copied into the store.
+
+        Args:
+            shard: A file like object representing the shard.
+            shard_id: The shard id if already known, saves hashing it.
+            link: Hard link real files into the store if possible,
+                  only safe if the source file will not be modified.
+
+        Raises:
+            MemoryError: If note enough storage to add shard.
+        """
+        shard_size = storjnode.storage.shard.get_size(shard)
+        if shard_id is None and storjnode.storage.shard.has_fileno(shard):
+            shard_id = storjnode.storage.shard.get_id(shard)
+
+        # check if already in storage
+        if shard_id is not None:
+            shard_path = self.find(shard_id)
+            if shard_path is not None:
+                return shard_path
+
+        store_path = self._reserve_space(shard_id, shard_size)
+        use_folder_tree = self.config[store_path]["use_folder_tree"]
+        try:
+
+            # hash while copying, shard id only known once copied
+            if shard_id is None:
+                temp_path = _get_temp_path(store_path)
+                hasher = hashlib.sha256()
+                storjnode.storage.shard.save(shard, temp_path, hasher=hasher)
+                shard_id = hasher.hexdigest()
+                shard_path = self.find(shard_id)
+                if shard_path is not None:
+                    os.remove(temp_path)
+                    self._release_space(store_path, shard_size)
+                    return shard_path
+                shard_path = _get_shard_path(store_path, shard_id,
+                                             use_folder_tree,
+                                             create_needed_folders=True)
+                os.rename(temp_path, shard_path)
+
+            # copy or link with the kernel
+            else:
+                shard_path = _get_shard_path(store_path, shard_id,
+                                             use_folder_tree,
+                                             create_needed_folders=True)
+                storjnode.storage.shard.save(shard, shard_path, link=link)
+        except Exception:
+            self._release_space(store_path, shard_size)
+            raise
+
+        self._indexes[store_path].add(shard_id, shard_path)
+        return shard_path
+
+    def move(self, path, shard_id):
+        """Move a file with a known shard id into the store.
+
+        The file is renamed into place if on the same filesystem as a
+        store path, so files created with create_temp_file are never
+        copied and need no additional disc space. The caller is
+        responsable for verifying the shard id.
+
+        Args:
+            path: The path of the file to move.
+            shard_id: The verified id of the shard.
+
+        Returns:
+            Path to the added shard.
+
+        Raises:
+            MemoryError: If note enough storage to add shard.
+        """
+        assert(storjnode.storage.shard.valid_id(shard_id))
+
+        # check if already in storage
+        shard_path = self.find(shard_id)
+        if shard_path is not None:
+            self.remove_temp_file(path)
+            return shard_path
+
+        stat = os.stat(path)
+        shard_size = stat.st_size
+        preferred = os.path.dirname(os.path.realpath(path))
+        with self._space_mutex:
+            store_path = self._select_store_path(shard_id, shard_size,
+                                                 preferred=preferred,
+                                                 device=stat.st_dev)
+        use_folder_tree = self.config[store_path]["use_folder_tree"]
+        shard_path = _get_shard_path(store_path, shard_id, use_folder_tree,
+                                     create_needed_folders=True)
+        try:
+            os.rename(path, shard_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+            # other filesystem, copy into the space of the store path
+            self._use_space(store_path, shard_id, shard_size)
+            try:
+                with _builtin_open(path, "rb") as shard:
+                    storjnode.storage.shard.save(shard, shard_path)
+            except Exception:
+                self._release_space(store_path, shard_size)
+                raise
+            self.remove_temp_file(path)
+        else:
+            with self._space_mutex:  # renamed into the space it reserved
+                self._reserved.pop(path, None)
+
+        self._indexes[store_path].add(shard_id, shard_path)
+        return shard_path
+
+    def create_temp_file(self, size=0):
+        """Create a temp file in a store path with space for the given size.
+
+        Temp files are ignored by the shard index and can be moved into
+        the store without copying. The space is reserved until moved or
+        removed with remove_temp_file.
+
+        Returns:
+            The path of the created temp file.
+
+        Raises:
+            MemoryError: If note enough storage for the given size.
+        """
+        store_path = self._reserve_space(None, size)
+        try:
+            path = _get_temp_path(store_path)
+        except Exception:
+            self._release_space(store_path, size)
+            raise
+        with self._space_mutex:
+            self._reserved[path] = (store_path, size)
+        return path
+
+    def create_partial_file(self, shard_id, size=0):
+        """Get the file of a partial shard download, created if needed.
+
+        Unlike create_temp_file the path only depends on the shard id, so
+        interrupted downloads can be resumed, even after a restart.
+
+        Returns:
+            The path of the partial file.
+
+        Raises:
+            MemoryError: If note enough storage for the given size.
+        """
+        path = self.find_partial(shard_id)
+        if path is None:
+            store_path = self._reserve_space(None, size)
+            path = _get_partial_path(store_path, shard_id)
+            try:
+                _builtin_open(path, "ab").close()
+            except Exception:
+                self._release_space(store_path, size)
+                raise
+            with self._space_mutex:
+                self._reserved[path] = (store_path, size)
+        return path
+
+    def remove_temp_file(self, path):
+        """Remove a temp or partial file and release its reserved space."""
+        if os.path.exists(path):
+            os.remove(path)
+        with self._space_mutex:
+            reserved = self._reserved.pop(path, None)
+        if reserved is not None:
+            self._release_space(*reserved)
+
+    def find_partial(self, shard_id):
+        """Returns the path of a partial shard download or None."""
+        for store_path in self.config:
+            path = _get_partial_path(store_path, shard_id)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def _reserve_space(self, shard_id, size):
+        # select and reserve at once, so other threads cannot take the space
+        with self._space_mutex:
+            store_path = self._select_store_path(shard_id, size)
+            self._use_space(store_path, shard_id, size)
+            return store_path
+
+    def _use_space(self, store_path, shard_id, size):
+        # cached free space would otherwise only change once checked again
+        with self._space_mutex:
+            free_space = self.get_free_space(store_path)
+            if size > free_space:
+                msg = "Not enough space to add {0}!"
+                raise MemoryError(msg.format(shard_id or "shard"))
+            timestamp = self._free_space[store_path][0]
+            self._free_space[store_path] = (timestamp, free_space - size)
+
+    def _release_space(self, store_path, size):
+        with self._space_mutex:
+            free_space = self.get_free_space(store_path)
+            timestamp = self._free_space[store_path][0]
+            self._free_space[store_path] = (timestamp, free_space + size)
+
+    def _select_store_path(self, shard_id, shard_size, preferred=None,
+                           device=None):
+        shard_name = shard_id or "shard"
+
+        # shuffle store paths to spread shards somewhat evenly
+        items = list(self.config.items())
+        random.shuffle(items)
+        items.sort(key=lambda item: item[0] != preferred)  # preferred first
+        for store_path, attributes in items:
+
+            # check if store path limit reached
+            limit = attributes["limit"]
+            used = self.get_used_space(store_path)
+            available = limit - used
+            if limit > 0 and shard_size > available:
+                msg = ("Store path limit reached for {3} cannot add {0}: "
+                       "Required {1} > {2} available.")
+                _log.warning(msg.format(shard_name, shard_size,
+                                        available, store_path))
+                continue  # try next storepath
+
+            # renaming a file on the same device uses no disc space
+            if device is not None and os.stat(store_path).st_dev == device:
+                return store_path
+
+            # check if enough free disc space
+            free_space = self.get_free_space(store_path)
+            if shard_size > free_space:
+                msg = ("Not enough disc space in {3} to add {0}: "
+                       "Required {1} > {2} available.")
+                msg = msg.format(shard_name, shard_size, free_space,
+                                 store_path)
+                _log.warning(msg)
+                continue  # try next storepath
+
+            return store_path
+
+        raise MemoryError("Not enough space to add {0}!".format(shard_name))
+
+    def remove(self, shard_id):
+        """Remove a shard from the store."""
+        for store_path, index in self._indexes.items():
+            shard_path = index.get(shard_id)
+            index.remove(shard_id)
+            if shard_path is not None and os.path.isfile(shard_path):
+                size = os.path.getsize(shard_path)
+                os.remove(shard_path)
+                self._release_space(store_path, size)
+
+    def rebuild_index(self):
+        """Rebuild the shard index of the store paths from disk."""
+        for index in self._indexes.values():
+            index.rebuild()
+
+    def _unindex(self, shard_id):
+        for index in self._indexes.values():
+            index.remove(shard_id)
+
+
+def get_store(store_config=None):
+    """Get the Store for a store config, it is only created once.
+
+    Args:
+        store_config: Dict of storage paths to optional attributes.
+                      limit: The dir size limit in bytes, 0 for no limit.
+                      use_folder_tree: Files organized in a folder tree
+                                       (always on for fat partitions).
+
+    Returns:
+        The shared storjnode.storage.manager.Store for the store config.
+
+    Raises:
+        AssertionError: If input not valid.
+    """
+    store_config = store_config or DEFAULT_STORE_CONFIG
+    key = json.dumps(store_config, sort_keys=True)
+    store = _stores.get(key)
+    if store is None:
+        with _stores_mutex:
+            store = _stores.get(key)
+            if store is None:
+                store = Store(store_config)
+                _stores[key] = store
+    return store
+
+
 def open(store_config, shard_id):
     """Retreives a shard from storage.
 
@@ -110,11 +493,7 @@ def open(store_config, shard_id):
         with storjnode.storage.store.open(store_config, id) as shard:
             print(storjnode.storage.shard.get_id(shard)
     """
-    shard_path = find(store_config, shard_id)
-    if shard_path is not None:
-        return _builtin_open(shard_path, "rb")
-    else:
-        raise KeyError("Shard {0} not found!".format(shard_id))
+    return get_store(store_config).open(shard_id)
 
 
 def add(store_config, shard):
@@ -140,48 +519,7 @@ def add(store_config, shard):
         with open("path/to/loose/shard", "rb") as shard:
             storjnode.storage.store.add(store_config, shard)
     """
-    store_config = setup(store_config)  # setup if needed
-    shard_id = storjnode.storage.shard.get_id(shard)
-    shard_size = storjnode.storage.shard.get_size(shard)
-
-    # check if already in storage
-    shard_path = find(store_config, shard_id)
-    if shard_path is not None:
-        return shard_path
-
-    # shuffle store paths to spread shards somewhat evenly
-    items = store_config.items()
-    random.shuffle(items)
-    for store_path, attributes in items:
-
-        # check if store path limit reached
-        limit = attributes["limit"]
-        used = storjnode.util.get_folder_size(store_path)
-        available = limit - used
-        if limit > 0 and shard_size > available:
-            msg = ("Store path limit reached for {3} cannot add {0}: "
-                   "Required {1} > {2} available.")
-            _log.warning(msg.format(shard_id, shard_size,
-                                    available, store_path))
-            continue  # try next storepath
-
-        # check if enough free disc space
-        free_space = storjnode.util.get_free_space(store_path)
-        if shard_size > free_space:
-            msg = ("Not enough disc space in {3} to add {0}: "
-                   "Required {1} > {2} available.")
-            msg = msg.format(shard_id, shard_size, free_space, store_path)
-            _log.warning(msg)
-            continue  # try next storepath
-
-        # save shard
-        use_folder_tree = attributes["use_folder_tree"]
-        shard_path = _get_shard_path(store_path, shard_id, use_folder_tree,
-                                     create_needed_folders=True)
-        storjnode.storage.shard.save(shard, shard_path)
-        return shard_path
-
-    raise MemoryError("Not enough space to add {0}!".format(shard_id))
+    return get_store(store_config).add(shard)
 
 
 def remove(store_config, shard_id):
@@ -203,14 +541,14 @@ def remove(store_config, shard_id):
         store_config = {"path/alpha": None, "path/beta": None}
         storjnode.storage.store.remove(store_config, id)
     """
-    shard_path = find(store_config, shard_id)
-    if shard_path is not None:
-        return os.remove(shard_path)
+    return get_store(store_config).remove(shard_id)
 
 
 def find(store_config, shard_id):
     """Find the path of a shard.
 
+    Answered from the shard index without touching the filesystem.
+
     Args:
         store_config: Dict of storage paths to optional attributes.
                       limit: The dir size limit in bytes, 0 for no limit.
@@ -231,14 +569,26 @@ def find(store_config, shard_id):
         shard_path = storjnode.storage.store.remove(store_config, id)
         print("shard located at %s" % shard_path)
     """
-    assert(storjnode.storage.shard.valid_id(shard_id))
-    store_config = setup(store_config)  # setup if needed
-    for store_path, attributes in store_config.items():
-        use_folder_tree = attributes["use_folder_tree"]
-        shard_path = _get_shard_path(store_path, shard_id, use_folder_tree)
-        if os.path.isfile(shard_path):
-            return shard_path
-    return None
+    return get_store(store_config).find(shard_id)
+
+
+def rebuild_index(store_config):
+    """Rebuild the shard index of the store paths from disk.
+
+    Only needed if shards where added or removed without the manager.
+
+    Args:
+        store_config: Dict of storage paths to optional attributes.
+                      limit: The dir size limit in bytes, 0 for no limit.
+                      use_folder_tree: Files organized in a folder tree
+                                       (always on for fat partitions).
+
+    Example:
+        import storjnode
+        store_config = {"path/alpha": None, "path/beta": None}
+        storjnode.storage.manager.rebuild_index(store_config)
+    """
+    return get_store(store_config).rebuild_index()
 
 
 # def import_file(store_config, source_path, max_shard_size=DEFAULT_SHARD_SIZE):
@@ -1,7 +1,20 @@
+import os
 import re
+import sys
+import ctypes
 import hashlib
 
 
+# hashlib releases the GIL while hashing blocks larger then 2K
+DEFAULT_BLOCK_SIZE = 1024 * 1024  # 1M
+
+
+if sys.version_info >= (3, 0, 0):
+    STRING_TYPES = (str,)
+else:
+    STRING_TYPES = (str, unicode)
+
+
 def valid_id(shard_id):
     return bool(re.match(r"^[0-9abcdef]{64}$", shard_id))
 
@@ -18,45 +31,163 @@ def get_size(shard):
     return shard.tell()
 
 
-def get_hash(shard, salt=None):
+def iter_blocks(shard, block_size=DEFAULT_BLOCK_SIZE):
+    """Iterate over the data of a shard in blocks.
+
+    Args:
+        shard: A file like object representing the shard.
+        block_size: The maximum size of the yielded blocks.
+
+    Returns: Generator of blocks from the start to the end of the shard.
+    """
+    shard.seek(0)
+    while True:
+        block = shard.read(block_size)
+        if not block:
+            break
+        yield block
+
+
+def get_hash(shard, salt=None, block_size=DEFAULT_BLOCK_SIZE):
     """Get the hash of the shard.
 
+    The shard is hashed in blocks so memory use does not grow with the
+    shard size. Blocks larger then 2K are hashed without holding the GIL.
+
     Args:
         shard: A file like object representing the shard.
         salt: Optional salt to add as a prefix before hashing.
+        block_size: Bytes read and hashed at a time.
 
     Returns: Hex digetst of sha256(salt + shard).
     """
     hasher = hashlib.sha256()
     if salt is not None:  # salt hash if requested
         hasher.update(salt)
-    shard.seek(0)
-    hasher.update(shard.read())
+    for block in iter_blocks(shard, block_size=block_size):
+        hasher.update(block)
     return hasher.hexdigest()
 
 
-def get_id(shard):
+def get_id(shard, block_size=DEFAULT_BLOCK_SIZE):
     """Returns the sha256 sum of the shard"""
-    return get_hash(shard)
+    return get_hash(shard, block_size=block_size)
 
 
-def copy(src_shard, dest_fobj):
+def copy(src_shard, dest_fobj, hasher=None, block_size=DEFAULT_BLOCK_SIZE):
     """Copy a shard to a file like object.
 
+    Real files are copied by the kernel with copy_file_range or sendfile
+    where available, other file like objects are copied in blocks. Python
+    2 has neither, so sendfile is called through libc on linux. Other
+    platforms copy real files in blocks on python 2.
+
     Args:
         src_shard: A file like object representing the shard to copy.
         dest_fobj: A file like object to copy the shard to.
+        hasher: Optional hashlib object to update with the copied data,
+                the data is then always copied in blocks.
+        block_size: Bytes read and written at a time if copied in blocks.
     """
-    src_shard.seek(0)
-    dest_fobj.write(src_shard.read())
-
-
-def save(shard, path):
+    if hasher is None:
+        src_fd, dest_fd = _get_fileno(src_shard), _get_fileno(dest_fobj)
+        if src_fd is not None and dest_fd is not None:
+            size = get_size(src_shard)
+            dest_fobj.flush()
+            if _kernel_copy(src_fd, dest_fd, size):
+                return
+    for block in iter_blocks(src_shard, block_size=block_size):
+        if hasher is not None:
+            hasher.update(block)
+        dest_fobj.write(block)
+
+
+def save(shard, path, hasher=None, link=False):
     """Copy a shard to a file.
 
     Args:
         src_shard: A file like object representing the shard to copy.
         path: The path to save the shard at.
+        hasher: Optional hashlib object to update with the copied data.
+        link: Hard link real files instead of copying if on the same
+              filesystem. Only safe if the source file is not modified.
     """
+    if link and hasher is None and _link(shard, path):
+        return
     with open(path, "wb") as fobj:
-        copy(shard, fobj)
+        copy(shard, fobj, hasher=hasher)
+
+
+def has_fileno(shard):
+    """Returns True if the shard is a real file with a file descriptor."""
+    return _get_fileno(shard) is not None
+
+
+def _get_fileno(fobj):
+    try:
+        return fobj.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None  # not a real file
+
+
+def _kernel_copy(src_fd, dest_fd, size):
+    methods = []
+    if hasattr(os, "copy_file_range"):  # python 3.8+
+        methods.append(lambda offset: os.copy_file_range(
+            src_fd, dest_fd, size - offset, offset
+        ))
+    sendfile = getattr(os, "sendfile", None) or _libc_sendfile  # 3.3+
+    if sendfile is not None:
+        methods.append(lambda offset: sendfile(
+            dest_fd, src_fd, offset, size - offset
+        ))
+    for method in methods:
+        offset = 0
+        try:
+            while offset < size:
+                copied = method(offset)
+                if not copied:
+                    break  # source truncated
+                offset += copied
+            return True
+        except OSError:
+            if offset > 0:
+                raise  # partially copied, cannot fall back
+    return False
+
+
+def _load_libc_sendfile():
+    if not sys.platform.startswith("linux"):
+        return None  # other signatures, only sockets as destination
+    try:
+        func = ctypes.CDLL(None, use_errno=True).sendfile64
+    except (AttributeError, OSError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        """Same as os.sendfile of python 3 on linux."""
+        offset = ctypes.c_int64(offset)
+        copied = func(out_fd, in_fd, ctypes.byref(offset), count)
+        if copied < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return copied
+    return sendfile
+
+
+_libc_sendfile = _load_libc_sendfile()
+
+
+def _link(shard, path):
+    src_path = getattr(shard, "name", None)
+    if not isinstance(src_path, STRING_TYPES) or \
+            not os.path.isfile(src_path):
+        return False
+    try:
+        os.link(src_path, path)
+        return True
+    except (AttributeError, OSError):  # no os.link or other filesystem
+        return False
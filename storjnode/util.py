@@ -4,6 +4,10 @@ import platform
 import psutil
 import socket
 from crochet import wait_for
+try:
+    from Queue import Empty, Full  # py2
+except ImportError:
+    from queue import Empty, Full  # py3
 
 
 def full_path(path):
@@ -41,6 +45,29 @@ def empty_queue(queue):
     return result
 
 
+def wait_for_queue(queue, timeout):
+    """Wait for items in a queue and return all of them.
+
+    Blocks until an item was queued or the timeout expired, then returns
+    it with all other queued items. None items only wake waiting threads
+    (see wake_queue) and are dropped.
+    """
+    try:
+        result = [queue.get(timeout=timeout)]
+    except Empty:
+        return []
+    result.extend(empty_queue(queue))
+    return [item for item in result if item is not None]
+
+
+def wake_queue(queue):
+    """Wake a thread blocked in wait_for_queue."""
+    try:
+        queue.put_nowait(None)
+    except Full:
+        pass  # waiting threads return at once for full queues
+
+
 def get_inet_facing_ip():
     # source http://stackoverflow.com/a/1267524/90351
     try:
@@ -155,6 +182,34 @@ def get_folder_size(start_path):  # source http://stackoverflow.com/a/1392549
     return total_size
 
 
+def pread(fd, size, offset):
+    """Read up to size bytes at offset from a file descriptor.
+
+    Uses os.pread where available, otherwise seeks first, so callers
+    sharing a file descriptor must not read concurrently on python 2.
+    """
+    if hasattr(os, "pread"):  # python 3.3+
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def pwrite(fd, data, offset):
+    """Write all of data at offset to a file descriptor.
+
+    Uses os.pwrite where available, otherwise seeks first, so callers
+    sharing a file descriptor must not write concurrently on python 2.
+    """
+    written = 0
+    while written < len(data):
+        if hasattr(os, "pwrite"):  # python 3.3+
+            written += os.pwrite(fd, data[written:], offset + written)
+        else:
+            os.lseek(fd, offset + written, os.SEEK_SET)
+            written += os.write(fd, data[written:])
+    return written
+
+
 def ensure_path_exists(path):
     """Creates need directories if they do not already exist."""
     if not os.path.exists(path):
@@ -1,3 +1,5 @@
+import io
+import os
 import hashlib
 import unittest
 import tempfile
@@ -29,5 +31,71 @@ class TestEncryptedIO(unittest.TestCase):
         # TODO add openssl compatibility tests (already tested manually)
 
 
+class TestSegmentedEncryptedIO(unittest.TestCase):
+
+    def _encrypt(self, data, **kwargs):
+        encrypted = io.BytesIO()
+        storjnode.encryptedio.segmented_encrypt(
+            io.BytesIO(data), encrypted, b"test", segment_size=1024,
+            iterations=10, **kwargs
+        )
+        return encrypted.getvalue()
+
+    def _decrypt(self, data, password=b"test", **kwargs):
+        decrypted = io.BytesIO()
+        storjnode.encryptedio.segmented_decrypt(io.BytesIO(data), decrypted,
+                                                password, **kwargs)
+        return decrypted.getvalue()
+
+    def test_roundtrip(self):
+        for size in (0, 1, 1023, 1024, 1025, 4096, 5000):
+            data = os.urandom(size)
+            self.assertEqual(self._decrypt(self._encrypt(data)), data)
+
+    def test_parallel(self):
+        data = os.urandom(10000)
+        encrypted = self._encrypt(data, workers=2)
+        self.assertEqual(self._decrypt(encrypted, workers=2), data)
+        self.assertEqual(self._decrypt(encrypted), data)
+
+    def test_symmetric_decrypt(self):
+        data = os.urandom(5000)
+        decrypted = io.BytesIO()
+        storjnode.encryptedio.symmetric_decrypt(
+            io.BytesIO(self._encrypt(data)), decrypted, b"test"
+        )
+        self.assertEqual(decrypted.getvalue(), data)
+
+    def test_authentication(self):
+        AuthenticationError = storjnode.encryptedio.AuthenticationError
+        encrypted = self._encrypt(os.urandom(4096))
+        segment = 1024 + 32
+
+        # wrong password
+        self.assertRaises(AuthenticationError, self._decrypt, encrypted,
+                          password=b"wrong")
+
+        # modified
+        modified = bytearray(encrypted)
+        modified[-100] ^= 1
+        self.assertRaises(AuthenticationError, self._decrypt,
+                          bytes(modified))
+
+        # truncated at a segment boundary
+        self.assertRaises(AuthenticationError, self._decrypt,
+                          encrypted[:-segment])
+
+        # reordered
+        header = len(encrypted) - 4 * segment
+        first = encrypted[header:header + segment]
+        second = encrypted[header + segment:header + 2 * segment]
+        reordered = (encrypted[:header] + second + first +
+                     encrypted[header + 2 * segment:])
+        self.assertRaises(AuthenticationError, self._decrypt, reordered)
+
+        # invalid header
+        self.assertRaises(ValueError, self._decrypt, b"StorjSEG")
+
+
 if __name__ == '__main__':
     unittest.main()
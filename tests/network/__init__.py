@@ -1,6 +1,14 @@
 from . file_transfer import * # NOQA
 from . api import * # NOQA
+from . cache import * # NOQA
 from . map import * # NOQA
+from . multiplex import * # NOQA
+from . refresh import * # NOQA
+from . nodeid import * # NOQA
+from . routing import * # NOQA
+from . server import * # NOQA
+from . dht_storage import * # NOQA
+from . swarm import * # NOQA
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+import time
+import unittest
+from twisted.internet import defer
+from storjnode.network.api import Node
+from storjnode.network.cache import ValueCache
+
+
+class TestValueCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = ValueCache(size=4)
+        self.assertEqual(cache.get("a"), None)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    def test_none_not_cached(self):
+        cache = ValueCache(size=4)
+        cache.set("a", None)
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = ValueCache(size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")  # b now least recently used
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        cache = ValueCache(size=4, ttl=0.05)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.1)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = ValueCache(size=4)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.invalidate("a")
+        cache.invalidate("missing")
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b"), 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_generation(self):
+        cache = ValueCache(size=2)
+        generation = cache.generation()
+        cache.invalidate("a")
+        cache.set("a", "old", generation=generation)
+        cache.set("b", 2, generation=generation)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b"), 2)
+
+        # read after the invalidation
+        cache.set("a", "new", generation=cache.generation())
+        self.assertEqual(cache.get("a"), "new")
+
+    def test_generation_forgotten(self):
+        cache = ValueCache(size=2)
+        generation = cache.generation()
+        for key in ["a", "b", "c"]:
+            cache.invalidate(key)
+
+        # invalidation of a no longer recorded, assumed recent
+        cache.set("a", 1, generation=generation)
+        self.assertEqual(cache.get("a"), None)
+
+        generation = cache.generation()
+        cache.clear()
+        cache.set("b", 2, generation=generation)
+        self.assertEqual(cache.get("b"), None)
+
+
+class MockServer(object):
+
+    def __init__(self):
+        self.pending = []
+
+    def get(self, key):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def get_many(self, keys):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def set(self, key, value):
+        return defer.succeed(True)
+
+
+class TestNodeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.node = Node.__new__(Node)
+        self.node.server = MockServer()
+        self.node.dht_cache = ValueCache(size=4)
+
+    def test_get_resolved_after_set(self):
+        results = []
+        self.node.async_get("a").addCallback(results.append)
+        self.node.async_set("a", "new")
+        self.node.server.pending[0].callback("old")
+        self.assertEqual(results, ["old"])
+        self.assertEqual(self.node.dht_cache.get("a"), None)
+
+        # later gets cache the value
+        self.node.async_get("a")
+        self.node.server.pending[1].callback("new")
+        self.assertEqual(self.node.dht_cache.get("a"), "new")
+
+    def test_get_many_resolved_after_set(self):
+        results = []
+        self.node.async_get_many(["a", "b"]).addCallback(results.append)
+        self.node.async_set("a", "new")
+        self.node.server.pending[0].callback({"a": "old", "b": "value"})
+        self.assertEqual(results, [{"a": "old", "b": "value"}])
+        self.assertEqual(self.node.dht_cache.get("a"), None)
+        self.assertEqual(self.node.dht_cache.get("b"), "value")
+
+
+if __name__ == "__main__":
+    unittest.main()
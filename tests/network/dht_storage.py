@@ -0,0 +1,71 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from zope.interface.verify import verifyObject
+from kademlia.storage import IStorage
+from storjnode.network.storage import SqliteStorage
+
+
+class TestSqliteStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "dht.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(IStorage, SqliteStorage(":memory:")))
+
+    def test_set_get(self):
+        storage = SqliteStorage(":memory:")
+        storage[b"a"] = b"value"
+        storage[b"b"] = {u"list": [1, 2, 3]}
+        storage[b"a"] = b"updated"
+        self.assertEqual(storage[b"a"], b"updated")
+        self.assertEqual(storage.get(b"b"), {u"list": [1, 2, 3]})
+        self.assertEqual(storage.get(b"missing", 42), 42)
+        self.assertRaises(KeyError, lambda: storage[b"missing"])
+        self.assertTrue(b"a" in storage)
+        self.assertEqual(len(storage), 2)
+
+    def test_persistent(self):
+        storage = SqliteStorage(self.path)
+        storage[b"a"] = b"value"
+        storage.close()
+        storage = SqliteStorage(self.path)
+        self.assertEqual(storage[b"a"], b"value")
+        self.assertEqual(len(storage), 1)
+
+    def test_ttl(self):
+        storage = SqliteStorage(":memory:", ttl=0.05)
+        storage[b"a"] = b"value"
+        self.assertEqual(storage.get(b"a"), b"value")
+        time.sleep(0.1)
+        self.assertEqual(storage.get(b"a"), None)
+        self.assertEqual(list(storage.iteritems()), [])
+        storage.cull()
+        self.assertEqual(len(storage), 0)
+
+    def test_max_entries(self):
+        storage = SqliteStorage(":memory:", max_entries=3)
+        for i in range(5):
+            storage[str(i).encode("ascii")] = i
+        self.assertEqual(len(storage), 3)
+        self.assertEqual(sorted(storage), [b"2", b"3", b"4"])
+
+    def test_iterate(self):
+        storage = SqliteStorage(":memory:")
+        items = dict((os.urandom(20), i) for i in range(600))
+        for key, value in items.items():
+            storage[key] = value
+        self.assertEqual(dict(storage.iteritems()), items)
+        self.assertEqual(list(storage.iteritemsOlderThan(3600)), [])
+        self.assertEqual(dict(storage.iteritemsOlderThan(0)), items)
+
+
+if __name__ == "__main__":
+    unittest.main()
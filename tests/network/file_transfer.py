@@ -1,6 +1,10 @@
 import storjnode
 from storjnode.network.file_transfer import FileTransfer, process_transfers
-import storjnode.storage as storage
+from storjnode.network.file_transfer import FileHandleCache
+from storjnode.network.file_transfer import READ_FLAGS, WRITE_FLAGS
+from storjnode.network.file_transfer import TransferEngine
+from storjnode.network.file_transfer import TransferError, PROTOCOL_VERSION
+from storjnode.network.multiplex import DEFAULT_WINDOW
 import btctxstore
 import pyp2p
 import hashlib
@@ -10,7 +14,13 @@ import time
 import requests
 import unittest
 import shutil
+import socket
+import errno
+import json
 import logging
+from collections import OrderedDict
+from twisted.internet import defer
+from twisted.test.proto_helpers import MemoryReactorClock
 from crochet import setup
 setup()
 
@@ -24,6 +34,535 @@ TEST_NODE = {
 }
 
 
+class MockUNL(object):
+
+    def __init__(self, master=False):
+        self.master = master
+        self.connects = []
+
+    def is_master(self, their_unl):
+        return self.master
+
+    def connect(self, their_unl, events, force_master=1, nonce=None):
+        self.connects.append((their_unl, nonce))
+
+
+class MockNet(object):
+
+    is_net_started = 1
+    dht_node = None
+    passive = None
+
+    def __init__(self):
+        self.inbound = []
+        self.outbound = []
+        self.unl = MockUNL()
+
+    def __iter__(self):
+        return iter([n["con"] for n in self.inbound + self.outbound
+                     if n["con"].nonce is not None])
+
+    def synchronize(self):
+        pass
+
+
+class MockCon(object):
+
+    def __init__(self, nonce=None, sock=None, peer=None):
+        if sock is None:
+            sock, peer = socket.socketpair()
+        sock.setblocking(0)
+        self.s = sock
+        self.peer = peer
+        self.buf = u""
+        self.nonce = nonce
+        self.connected = 1
+        self.alive = time.time()
+
+    @classmethod
+    def pair(cls, nonce):
+        a, b = socket.socketpair()
+        return cls(nonce, a), cls(nonce, b)
+
+    def send(self, msg, send_all=0):
+        if not isinstance(msg, bytes):
+            msg = msg.encode("ascii")
+        sent = 0
+        while sent < len(msg):
+            try:
+                sent += self.s.send(msg[sent:])
+            except socket.error as e:
+                if e.args[0] != errno.EAGAIN or not send_all:
+                    break
+        return sent
+
+    def recv(self, n, encoding="unicode"):
+        try:
+            data = self.s.recv(n)
+        except socket.error as e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+            data = b""
+        if encoding == "unicode":
+            return data.decode("latin-1")
+        return data
+
+    def close(self):
+        if not self.connected:
+            return
+        self.connected = 0
+        self.s.close()
+        self.s = None
+        if self.peer is not None:
+            self.peer.close()
+
+
+class TestFileTransferStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.test_storage_dir = tempfile.mkdtemp()
+        self.store_config = {self.test_storage_dir: None}
+        self.client = FileTransfer(MockNet(), store_config=self.store_config)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_storage_dir)
+
+    def test_save_data_chunk_hashed(self):
+        data = os.urandom(1024 * 100)
+        data_id = hashlib.sha256(data).hexdigest()
+        temp_path = self.client.store.create_temp_file()
+        self.client.downloading[data_id] = temp_path
+        self.client.hashers[data_id] = hashlib.sha256()
+        for i in range(0, len(data), 4096):
+            self.client.save_data_chunk(data_id, data[i:i + 4096])
+        self.assertEqual(self.client.hashers[data_id].hexdigest(), data_id)
+        self.client.close_data_handles(data_id)
+        with open(temp_path, "rb") as fp:
+            self.assertEqual(fp.read(), data)
+
+    def test_save_data_chunk_positional(self):
+        data = os.urandom(1024 * 100)
+        data_id = hashlib.sha256(data).hexdigest()
+        temp_path = self.client.store.create_temp_file()
+        self.client.downloading[data_id] = temp_path
+        self.client.hashers[data_id] = hashlib.sha256()
+        self.client.save_data_chunk(data_id, data[:1000], 0)
+        self.client.save_data_chunk(data_id, data[1000:], 1000)
+        self.assertEqual(len(self.client.handles), 1)  # opened once
+        self.client.close_data_handles(data_id)
+        self.assertEqual(len(self.client.handles), 0)
+        with open(temp_path, "rb") as fp:
+            self.assertEqual(fp.read(), data)
+
+    def test_get_data_chunk(self):
+        data = os.urandom(1024 * 100)
+        data_id = self.client.move_file_to_storage(
+            self._write_file(data)
+        )["data_id"]
+        chunks = [self.client.get_data_chunk(data_id, i, chunk_size=4096)
+                  for i in range(0, len(data), 4096)]
+        self.assertEqual(b"".join(chunks), data)
+        self.assertEqual(len(self.client.handles), 1)  # opened once
+        self.client.close_data_handles(data_id)
+
+    def _write_file(self, data):
+        path = os.path.join(self.test_storage_dir, "loose")
+        with open(path, "wb") as fp:
+            fp.write(data)
+        return path
+
+
+class TestFileHandleCache(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.handles = FileHandleCache(max_open=2)
+
+    def tearDown(self):
+        self.handles.close_all()
+        shutil.rmtree(self.base_dir)
+
+    def test_lru_reopen(self):
+        paths = [os.path.join(self.base_dir, str(i)) for i in range(4)]
+        for i, path in enumerate(paths):
+            self.handles.open(i, path, WRITE_FLAGS)
+            self.handles.pwrite(i, b"data", 0)
+        self.assertEqual(len(self.handles._fds), 2)  # capped
+        self.assertEqual(len(self.handles), 4)  # all still registered
+
+        # evicted files reopened without truncating
+        self.handles.pwrite(0, b"more", 4)
+        self.handles.close_all()
+        with open(paths[0], "rb") as fp:
+            self.assertEqual(fp.read(), b"datamore")
+
+    def test_pread(self):
+        path = os.path.join(self.base_dir, "read")
+        with open(path, "wb") as fp:
+            fp.write(b"0123456789")
+        self.handles.open("key", path, READ_FLAGS)
+        self.assertEqual(self.handles.pread("key", 3, 4), b"456")
+        self.assertEqual(self.handles.pread("key", 3, 0), b"012")
+        self.assertEqual(self.handles.pread("key", 30, 8), b"89")
+
+
+class CountingTransferEngine(TransferEngine):
+
+    processed = 0
+
+    def process(self):
+        self.processed += 1
+        TransferEngine.process(self)
+
+
+class TestTransferEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.test_storage_dir = tempfile.mkdtemp()
+        self.client = FileTransfer(
+            MockNet(), store_config={self.test_storage_dir: None}
+        )
+        self.reactor = MemoryReactorClock()
+        self.engine = CountingTransferEngine(self.client,
+                                             reactor=self.reactor)
+        self.engine.start()
+
+    def tearDown(self):
+        self.engine.stop()
+        for node in self.client.net.inbound:
+            if node["con"].connected:
+                node["con"].close()
+        shutil.rmtree(self.test_storage_dir)
+
+    def _add_con(self, contract_id=None, host_unl=None):
+        con = MockCon(nonce=None if contract_id is None else u"0" * 64)
+        self.client.net.inbound.append({"con": con})
+        if contract_id is not None:
+            self.client.contracts[contract_id] = {
+                "host_unl": host_unl, "data_id": contract_id, "file_size": 0
+            }
+            self.client.open_stream(con, contract_id)
+        return con
+
+    def _watched(self):
+        readers = set(w.sock for w in self.reactor.getReaders())
+        writers = set(w.sock for w in self.reactor.getWriters())
+        return readers, writers
+
+    def test_idle_processed_by_timer(self):
+        self.reactor.advance(0)
+        self.assertEqual(self.engine.processed, 1)
+        for i in range(10):
+            self.reactor.advance(self.engine.timer_interval)
+        self.assertEqual(self.engine.processed, 11)
+        self.assertEqual(len(self.reactor.getReaders()), 0)
+        self.assertEqual(len(self.reactor.getWriters()), 0)
+
+    def test_schedule_coalesced(self):
+        self.reactor.advance(0)
+        for i in range(10):
+            self.engine.schedule()
+        self.reactor.advance(0)
+        self.assertEqual(self.engine.processed, 2)
+
+    def test_watch_interest(self):
+        self.client.our_unls = {u"ours": True, u"theirs": False}
+        syncing = self._add_con()
+        uploading = self._add_con(u"1" * 64, u"ours")
+        downloading = self._add_con(u"2" * 64, u"theirs")
+
+        # upload size and initial download window to send
+        self.engine.update()
+        readers, writers = self._watched()
+        self.assertEqual(readers, set([syncing, uploading, downloading]))
+        self.assertEqual(writers, set([uploading, downloading]))
+
+        # waiting for upload credit and download data
+        upload_info = self.client.con_info[uploading][u"1" * 64]
+        upload_info.update(file_size=1024, remaining=1024)
+        self.client.con_info[downloading][u"2" * 64]["grant"] = 0
+        self.engine.update()
+        self.assertEqual(self._watched()[1], set())
+
+        upload_info["credit"] = 512
+        self.engine.update()
+        self.assertEqual(self._watched()[1], set([uploading]))
+
+        # closed connections are no longer watched
+        downloading.close()
+        self.engine.update()
+        readers, writers = self._watched()
+        self.assertEqual(readers, set([syncing, uploading]))
+
+
+class TestMultiplexedTransfers(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.uploader = self._client(u"uploader", True)
+        self.downloader = self._client(u"downloader", False)
+        self._connect()
+        self.completed = []
+        self.failed = []
+
+    def tearDown(self):
+        self.up_con.close()
+        self.down_con.close()
+        self.uploader.handles.close_all()
+        self.downloader.handles.close_all()
+        shutil.rmtree(self.base_dir)
+
+    def _client(self, name, host):
+        path = os.path.join(self.base_dir, name)
+        client = FileTransfer(MockNet(), store_config={path: None})
+        client.our_unls = {u"uploader": host}
+        return client
+
+    def _connect(self):
+        self.up_con, self.down_con = MockCon.pair(u"0" * 64)
+        self.uploader.net.inbound = [{"con": self.up_con}]
+        self.downloader.net.inbound = [{"con": self.down_con}]
+
+    def _add_transfer(self, data, offset=0, length=None):
+        path = os.path.join(self.base_dir, "loose")
+        with open(path, "wb") as fp:
+            fp.write(data)
+        data_id = self.uploader.move_file_to_storage(path)["data_id"]
+        contract = {"host_unl": u"uploader", "data_id": data_id,
+                    "file_size": 0, "offset": offset, "length": length}
+        contract_id = hashlib.sha256(repr(contract).encode("ascii"))
+        contract_id = contract_id.hexdigest()
+        for client, con in [(self.uploader, self.up_con),
+                            (self.downloader, self.down_con)]:
+            client.contracts[contract_id] = dict(contract)
+            client.open_stream(con, contract_id)
+        d = self.downloader.defers[contract_id] = defer.Deferred()
+        d.addCallback(lambda result: self.completed.append(data_id))
+        d.addErrback(lambda failure: self.failed.append(failure.value))
+        return data_id
+
+    def _process(self, rounds=1000):
+        for i in range(rounds):
+            process_transfers(self.uploader)
+            process_transfers(self.downloader)
+            if not self.downloader.is_queued():
+                return
+
+    def test_small_not_stuck_behind_large(self):
+        large = self._add_transfer(os.urandom(1024 * 1024 * 2))
+        small = [self._add_transfer(os.urandom(1024)) for i in range(5)]
+        self._process()
+        self.assertEqual(set(self.completed[:5]), set(small))
+        self.assertEqual(self.completed[5], large)
+        for data_id in small + [large]:
+            path = self.downloader.store.find(data_id)
+            with open(path, "rb") as fp:
+                self.assertEqual(storjnode.storage.shard.get_id(fp), data_id)
+
+    def test_flow_control(self):
+        data_id = self._add_transfer(os.urandom(1024 * 1024))
+        process_transfers(self.downloader)  # grants initial window only
+        for i in range(10):
+            process_transfers(self.uploader)
+        con_info = list(self.uploader.con_info[self.up_con].values())[0]
+        sent = con_info["file_size"] - con_info["remaining"]
+        self.assertEqual(sent, DEFAULT_WINDOW)
+        self._process()
+        self.assertEqual(self.completed, [data_id])
+
+    def _interrupt(self, data):
+        data_id = self._add_transfer(data)
+        process_transfers(self.downloader)  # grants initial window only
+        process_transfers(self.uploader)
+        process_transfers(self.downloader)
+        self.up_con.close()
+        self.down_con.close()
+        process_transfers(self.uploader)
+        process_transfers(self.downloader)
+        self.assertEqual(len(self.failed), 1)
+        self.assertFalse(data_id in self.downloader.downloading)
+        return data_id
+
+    def _resume(self, data):
+        self._connect()
+        offset = self.downloader.get_partial_size(
+            hashlib.sha256(data).hexdigest()
+        )
+        self.assertTrue(0 < offset < len(data))
+        data_id = self._add_transfer(data, offset=offset)
+        self._process()
+        self.assertEqual(self.completed, [data_id])
+        path = self.downloader.store.find(data_id)
+        with open(path, "rb") as fp:
+            self.assertEqual(fp.read(), data)
+        self.assertEqual(self.downloader.store.find_partial(data_id), None)
+
+        # only the missing data was sent
+        con_info = list(self.uploader.con_info[self.up_con].values())[0]
+        self.assertEqual(con_info["remaining"], 0)
+        self.assertEqual(con_info["end"] - con_info["offset"],
+                         len(data) - offset)
+
+    def test_resume_after_disconnect(self):
+        data = os.urandom(1024 * 1024)
+        data_id = self._interrupt(data)
+        self.assertTrue(data_id in self.downloader.partials)
+        self._resume(data)
+
+    def test_resume_after_restart(self):
+        data = os.urandom(1024 * 1024)
+        self._interrupt(data)
+        self.downloader.partials = {}  # hash state lost, rehashed from disk
+        self._resume(data)
+
+    def test_byte_range(self):
+        data = os.urandom(1024 * 100)
+        data_id = self._add_transfer(data, length=1000)
+        self._process()
+        self.assertEqual(self.completed, [data_id])
+        self.assertEqual(self.downloader.store.find(data_id), None)
+        self.assertEqual(self.downloader.get_partial_size(data_id), 1000)
+        self.completed = []
+        self._resume(data)
+
+
+class TestLegacyTransfers(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.uploader = self._client(u"uploader", False)
+        self.downloader = self._client(u"downloader", True)
+        self.up_con, self.down_con = MockCon.pair(u"0" * 64)
+        self.uploader.net.inbound = [{"con": self.up_con}]
+        self.downloader.net.inbound = [{"con": self.down_con}]
+        self.completed = []
+
+    def tearDown(self):
+        self.up_con.close()
+        self.down_con.close()
+        self.uploader.handles.close_all()
+        self.downloader.handles.close_all()
+        shutil.rmtree(self.base_dir)
+
+    def _client(self, name, master):
+        path = os.path.join(self.base_dir, name)
+        client = FileTransfer(MockNet(), store_config={path: None})
+        client.net.unl.master = master
+        client.our_unls = {u"uploader": name == u"uploader",
+                           u"downloader": name == u"downloader"}
+        return client
+
+    def _add_transfer(self, data, offset=0, length=None):
+        path = os.path.join(self.base_dir, "loose")
+        with open(path, "wb") as fp:
+            fp.write(data)
+        data_id = self.uploader.move_file_to_storage(path)["data_id"]
+        contract = {"host_unl": u"uploader", "dest_unl": u"uploader",
+                    "src_unl": u"downloader", "data_id": data_id,
+                    "file_size": 0, "offset": offset, "length": length}
+        contract_id = hashlib.sha256(repr(contract).encode("ascii"))
+        contract_id = contract_id.hexdigest()
+        d = self.downloader.defers[contract_id] = defer.Deferred()
+        d.addCallback(lambda result: self.completed.append(data_id))
+        for client, con in [(self.uploader, self.up_con),
+                            (self.downloader, self.down_con)]:
+            client.contracts[contract_id] = dict(contract)
+            client.legacy_contracts.add(contract_id)
+            client.open_stream(con, contract_id)
+        return data_id
+
+    def _process(self, rounds=5000):
+        for i in range(rounds):
+            process_transfers(self.uploader)
+            process_transfers(self.downloader)
+            if not self.downloader.is_queued():
+                return
+
+    def test_multiple_transfers(self):
+        files = [os.urandom(1024 * 100) for i in range(3)] + [b"x"]
+        data_ids = [self._add_transfer(data) for data in files]
+        self._process()
+        self.assertEqual(sorted(self.completed), sorted(data_ids))
+        self.assertEqual(self.downloader.multiplexers, {})
+        for data_id, data in zip(data_ids, files):
+            path = self.downloader.store.find(data_id)
+            with open(path, "rb") as fp:
+                self.assertEqual(fp.read(), data)
+
+    def test_byte_range_ignored(self):
+        data = os.urandom(1024 * 100)
+        data_id = self._add_transfer(data, length=1000)
+        self._process()
+        self.assertEqual(self.completed, [data_id])
+        path = self.downloader.store.find(data_id)
+        with open(path, "rb") as fp:
+            self.assertEqual(fp.read(), data)
+
+
+class TestProtocolVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.test_storage_dir = tempfile.mkdtemp()
+        self.client = FileTransfer(
+            MockNet(), store_config={self.test_storage_dir: None}
+        )
+        self.client.is_valid_syn = lambda msg: 1
+        self.client.is_valid_contract_sig = lambda contract: 1
+        self.sent = []
+        self.client.send_msg = lambda msg, unl: self.sent.append(msg)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_storage_dir)
+
+    def _syn(self, **kwargs):
+        syn = OrderedDict([
+            (u"status", u"SYN"), (u"data_id", u"a" * 64),
+            (u"src_unl", u"requester"), (u"dest_unl", u"responder"),
+            (u"host_unl", u"responder")
+        ])
+        syn.update(kwargs)
+        return json.loads(json.dumps(syn), object_pairs_hook=OrderedDict)
+
+    def test_syn(self):
+        old = self._syn()
+        new = self._syn(version=PROTOCOL_VERSION)
+        self.client.protocol(json.dumps(old))
+        self.client.protocol(json.dumps(new))
+        self.assertEqual(self.client.legacy_contracts,
+                         set([self.client.contract_id(old)]))
+        for reply in self.sent:
+            self.assertEqual(reply[u"version"], PROTOCOL_VERSION)
+
+    def _syn_ack(self, syn, swarm=False, **kwargs):
+        contract_id = self.client.save_contract(syn)
+        if swarm:
+            self.client.swarms[syn[u"data_id"]] = None
+        errors = []
+        d = self.client.defers[contract_id] = defer.Deferred()
+        d.addErrback(lambda failure: errors.append(failure.value))
+        syn_ack = OrderedDict([(u"status", u"SYN-ACK"), (u"syn", syn)])
+        syn_ack.update(kwargs)
+        self.client.protocol(json.dumps(syn_ack))
+        legacy = contract_id in self.client.legacy_contracts
+        return legacy, errors
+
+    def test_syn_ack(self):
+        syn = self._syn(version=PROTOCOL_VERSION)
+        self.assertEqual(self._syn_ack(syn, version=1), (False, []))
+        syn = self._syn(version=PROTOCOL_VERSION, offset=1)
+        self.assertEqual(self._syn_ack(syn), (True, []))
+        self.assertEqual(len(self.client.net.unl.connects), 2)
+
+    def test_syn_ack_swarm(self):
+        syn = self._syn(version=PROTOCOL_VERSION)
+        legacy, errors = self._syn_ack(syn, swarm=True)
+        self.assertTrue(legacy)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], TransferError))
+        self.assertEqual(self.client.net.unl.connects, [])
+        self.assertEqual(self.sent, [])  # no ACK
+
+
 class TestFileTransfer(unittest.TestCase):
 
     def setUp(self):
@@ -129,7 +668,9 @@ class TestFileTransfer(unittest.TestCase):
 
         # Check we received this file.
         for i in range(0, 1):
-            path = storage.manager.find(store_config, file_infos[i]["data_id"])
+            path = storjnode.storage.manager.find(
+                store_config, file_infos[i]["data_id"]
+            )
             if not os.path.isfile(path):
                 assert(0)
             else:
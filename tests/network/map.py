@@ -1,11 +1,22 @@
+import os
+import io
 import time
+import csv
+import json
 import shutil
 import tempfile
 import random
 import unittest
+import binascii
+import xml.etree.ElementTree as ElementTree
 import btctxstore
 import storjnode
 from crochet import setup
+try:
+    from StringIO import StringIO  # py2, takes str and unicode
+except ImportError:
+    from io import StringIO  # py3
+from twisted.internet import defer
 from storjnode.network.server import QUERY_TIMEOUT, WALK_TIMEOUT
 setup()  # start twisted via crochet
 
@@ -62,5 +73,290 @@ class TestMapNetwork(unittest.TestCase):
             shutil.rmtree(tempdir)
 
 
+class MockProtocol(object):
+
+    def __init__(self, topology, unreachable=(), flaky=()):
+        self.topology = topology  # {id: [(id, ip, port)]}
+        self.unreachable = set(unreachable)
+        self.flaky = set(flaky)  # fail first request only
+        self.requests = {}  # {id: count}
+        self.pending = []  # [(node, deferred)] when deferring
+        self.defer_results = False
+
+    def callFindNode(self, node_to_ask, node_to_find):
+        count = self.requests.get(node_to_ask.id, 0) + 1
+        self.requests[node_to_ask.id] = count
+        if node_to_ask.id in self.unreachable or (
+                node_to_ask.id in self.flaky and count == 1):
+            result = (False, None)
+        else:
+            result = (True, [list(p) for p in self.topology[node_to_ask.id]])
+        if self.defer_results:
+            d = defer.Deferred()
+            self.pending.append((result, d))
+            return d
+        return defer.succeed(result)
+
+
+class MockServer(object):
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+
+def create_topology(size, degree=8):
+    ids = [os.urandom(20) for i in range(size)]
+    ports = dict((nodeid, 1000 + i) for i, nodeid in enumerate(ids))
+    peers = {}
+    for i, nodeid in enumerate(ids):
+        # ring so every node is reachable, plus random links
+        links = [ids[(i + 1) % size]] + random.sample(ids, degree - 1)
+        peers[nodeid] = [(p, "127.0.0.1", ports[p]) for p in links]
+    return ids, peers
+
+
+class TestNetworkMapper(unittest.TestCase):
+
+    def _crawl(self, protocol, start, **kwargs):
+        results = []
+        storjnode.network.map.crawl(MockServer(protocol), start, **kwargs
+                                    ).addCallback(results.append)
+        return results
+
+    def test_large_network(self):
+        ids, topology = create_topology(5000)
+        protocol = MockProtocol(topology)
+        progress = []
+        results = self._crawl(protocol, [(ids[0], "127.0.0.1", 1000)],
+                              progress=lambda s, p: progress.append(s))
+        netmap, unreached = results[0]
+        self.assertEqual(set(netmap.keys()), set(ids))
+        self.assertEqual(len(unreached), 0)
+        self.assertEqual(netmap[ids[0]]["peers"], topology[ids[0]])
+        self.assertEqual(progress[-1], 5000)
+
+        # every node asked once
+        self.assertEqual(set(protocol.requests.values()), set([1]))
+
+    def test_concurrency(self):
+        ids, topology = create_topology(100)
+        protocol = MockProtocol(topology)
+        protocol.defer_results = True
+        results = self._crawl(protocol, [(ids[0], "127.0.0.1", 1000)],
+                              concurrency=4)
+        while protocol.pending:
+            self.assertTrue(len(protocol.pending) <= 4)
+            result, d = protocol.pending.pop(0)
+            d.callback(result)
+        self.assertEqual(len(results[0][0]), 100)
+
+    def test_attempts(self):
+        ids, topology = create_topology(50)
+        protocol = MockProtocol(topology, unreachable=ids[1:3],
+                                flaky=ids[3:5])
+        results = self._crawl(protocol, [(ids[0], "127.0.0.1", 1000)],
+                              attempts=2)
+        netmap, unreached = results[0]
+        self.assertEqual(len(netmap), 50)
+        self.assertEqual(unreached, set(ids[1:3]))
+        self.assertEqual(netmap[ids[1]]["peers"], [])
+        for nodeid in ids[1:5]:
+            self.assertEqual(protocol.requests[nodeid], 2)
+
+        # single attempt
+        protocol = MockProtocol(topology, flaky=ids[3:5])
+        netmap, unreached = self._crawl(
+            protocol, [(ids[0], "127.0.0.1", 1000)]
+        )[0]
+        self.assertEqual(unreached, set(ids[3:5]))
+
+    def _outfile(self, data=None):
+        if str is bytes:  # py2
+            return io.BytesIO(data.encode("ascii") if data else b"")
+        return io.StringIO(data)
+
+    def test_dump_load(self):
+        ids, topology = create_topology(10)
+        protocol = MockProtocol(topology, unreachable=ids[1:2])
+        netmap, unreached = self._crawl(
+            protocol, [(ids[0], "127.0.0.1", 1000)]
+        )[0]
+        outfile = self._outfile()
+        storjnode.network.map.dump(netmap, outfile, unreached=unreached)
+        lines = outfile.getvalue().splitlines()
+        self.assertEqual(len(lines), 10)
+        records = dict((r["id"], r) for r in map(json.loads, lines))
+        record = records[binascii.hexlify(ids[0]).decode("ascii")]
+        self.assertEqual(len(record["neighbours"]), 8)
+
+        loaded = storjnode.network.map.load(self._outfile(
+            outfile.getvalue() if str is not bytes else
+            outfile.getvalue().decode("ascii")
+        ))
+        self.assertEqual(loaded, (netmap, unreached))
+
+    def test_stream(self):
+        ids, topology = create_topology(50)
+        records = []
+        results = self._crawl(
+            MockProtocol(topology), [(ids[0], "127.0.0.1", 1000)],
+            sink=lambda *record: records.append(record)
+        )
+        netmap, unreached = results[0]
+        self.assertEqual(len(records), 50)
+        self.assertEqual(records[0][0], ids[0])
+        self.assertEqual(records[0][2], topology[ids[0]])
+        self.assertEqual(set(netmap.values()), set([None]))  # not kept
+
+    def test_resume(self):
+        ids, topology = create_topology(200)
+        protocol = MockProtocol(topology, unreachable=ids[1:2])
+        protocol.defer_results = True
+        outfile = self._outfile()
+
+        def sink(nodeid, addr, peers, reached):
+            storjnode.network.map.write_record(outfile, nodeid, addr, peers,
+                                               reached)
+        self._crawl(protocol, [(ids[0], "127.0.0.1", 1000)], sink=sink)
+        for i in range(100):
+            result, d = protocol.pending.pop(0)
+            d.callback(result)
+
+        # interrupted while writing a record
+        data = outfile.getvalue()
+        if str is bytes:
+            data = data.decode("ascii")
+        partial = self._outfile(data + data.splitlines()[-1][:20])
+        resumed, unreached = storjnode.network.map.load(partial)
+        self.assertEqual(len(resumed), 100)
+        self.assertTrue(ids[1] in unreached)
+
+        # continue without scanning resumed nodes again
+        protocol = MockProtocol(topology)
+        resumed.pop(ids[1])
+        netmap, unreached = self._crawl(
+            protocol, [(ids[0], "127.0.0.1", 1000)], resume=resumed
+        )[0]
+        self.assertEqual(set(netmap.keys()), set(ids))
+        self.assertEqual(len(protocol.requests), 101)
+        self.assertTrue(ids[1] in protocol.requests)
+
+    def test_load_last_record_wins(self):
+        ids, topology = create_topology(10)
+        outfile = self._outfile()
+        write_record = storjnode.network.map.write_record
+        write_record(outfile, ids[0], ("127.0.0.1", 1000), [], False)
+        write_record(outfile, ids[1], ("127.0.0.1", 1001), [], False)
+        write_record(outfile, ids[0], ("127.0.0.1", 1000), topology[ids[0]])
+        outfile.seek(0)
+        netmap, unreached = storjnode.network.map.load(outfile)
+        self.assertEqual(unreached, set([ids[1]]))
+        self.assertEqual(netmap[ids[0]]["peers"], topology[ids[0]])
+
+    def test_resume_append(self):
+        key = btctxstore.BtcTxStore().create_wallet()
+        server = storjnode.network.StorjServer(key)
+        try:
+            ids = [os.urandom(20) for i in range(2)]
+            server.protocol.callFindNode = lambda node, find: defer.succeed(
+                (True, [[ids[1], "127.0.0.1", 1001]])
+            )
+
+            # interrupted while writing the record of the second node
+            outfile = self._outfile()
+            storjnode.network.map.write_record(
+                outfile, ids[0], ("127.0.0.1", 1000),
+                [(ids[1], "127.0.0.1", 1001)]
+            )
+            outfile.write(b'{"id": "' if str is bytes else '{"id": "')
+            outfile.seek(0)
+
+            results = []
+            server.map_network(outfile=outfile, resume=outfile).addCallback(
+                results.append
+            )
+            self.assertEqual(results, [(2, 0)])
+            outfile.seek(0)
+            netmap, unreached = storjnode.network.map.load(outfile)
+            self.assertEqual(set(netmap.keys()), set(ids))
+        finally:
+            server.stop()
+
+class TestRender(unittest.TestCase):
+
+    def setUp(self):
+        ids, topology = create_topology(1000)
+        self.netmap = dict(
+            (nodeid, {"addr": ("127.0.0.1", peers[0][2]), "peers": peers})
+            for nodeid, peers in topology.items()
+        )
+
+    def _get_connections(self, netmap):
+        connections = set()
+        for nodeid, results in netmap.items():
+            for peerid, ip, port in results["peers"]:
+                if peerid != nodeid and peerid in netmap:
+                    connections.add(frozenset([nodeid, peerid]))
+        return connections
+
+    def test_dedupe(self):
+        nodes, edges = storjnode.network.map.reduce_graph(self.netmap)
+        self.assertEqual(len(nodes), 1000)
+        self.assertEqual(len(edges), len(self._get_connections(self.netmap)))
+        unhex = lambda e: frozenset(binascii.unhexlify(k) for k in e)
+        self.assertEqual(set(unhex(e) for e in edges),
+                         self._get_connections(self.netmap))
+
+    def test_collapse_prefix(self):
+        nodes, edges = storjnode.network.map.reduce_graph(self.netmap,
+                                                          prefix_bits=4)
+        self.assertEqual(len(nodes), 16)
+        counts = [int(l.split("\n")[1].split()[0]) for l in nodes.values()]
+        self.assertEqual(sum(counts), 1000)
+        for a, b in edges:
+            self.assertTrue(a < b)
+            self.assertTrue(a in nodes and b in nodes)
+
+    def test_sample(self):
+        reduce_graph = storjnode.network.map.reduce_graph
+        nodes, edges = reduce_graph(self.netmap, sample=100, seed=1)
+        self.assertEqual(len(nodes), 100)
+        self.assertEqual((nodes, edges),
+                         reduce_graph(self.netmap, sample=100, seed=1))
+        for a, b in edges:
+            self.assertTrue(a in nodes and b in nodes)
+
+    def test_create_graph(self):
+        create_graph = storjnode.network.map.create_graph
+        graph = create_graph(self.netmap, "test", sample=20, seed=1)
+        self.assertEqual(graph.engine, "circo")
+        self.assertTrue("127.0.0.1" in graph.source)
+
+        graph = create_graph(self.netmap, "test")
+        self.assertEqual(graph.engine, "sfdp")
+        self.assertTrue("shape=point" in graph.source)
+        edges = storjnode.network.map.reduce_graph(self.netmap)[1]
+        self.assertEqual(graph.source.count(" -- "), len(edges))
+
+    def test_export_csv(self):
+        outfile = StringIO()
+        storjnode.network.map.export_csv(self.netmap, outfile, prefix_bits=8)
+        rows = list(csv.reader(outfile.getvalue().splitlines()))
+        self.assertEqual(rows[0], ["source", "target"])
+        edges = storjnode.network.map.reduce_graph(self.netmap,
+                                                   prefix_bits=8)[1]
+        self.assertEqual(set(tuple(r) for r in rows[1:]), edges)
+
+    def test_export_graphml(self):
+        outfile = StringIO()
+        storjnode.network.map.export_graphml(self.netmap, outfile)
+        root = ElementTree.fromstring(outfile.getvalue())
+        ns = "{http://graphml.graphdrawing.org/xmlns}"
+        graph = root.find(ns + "graph")
+        self.assertEqual(len(graph.findall(ns + "node")), 1000)
+        edges = storjnode.network.map.reduce_graph(self.netmap)[1]
+        self.assertEqual(len(graph.findall(ns + "edge")), len(edges))
+
+
 if __name__ == "__main__":
     unittest.main()
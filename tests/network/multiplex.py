@@ -0,0 +1,83 @@
+import socket
+import unittest
+from storjnode.network.multiplex import Multiplexer, HEADER
+from storjnode.network.multiplex import FRAME_WINDOW, FRAME_LENGTH, FRAME_DATA
+
+
+STREAM_ID = u"ab" * 32
+
+
+class MockSock(object):
+
+    def __init__(self, sock):
+        sock.setblocking(0)
+        self.s = sock
+        self.connected = 1
+        self.alive = 0
+
+    def close(self):
+        self.connected = 0
+        self.s.close()
+
+
+class TestMultiplexer(unittest.TestCase):
+
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.sender = Multiplexer(MockSock(a))
+        self.receiver = Multiplexer(MockSock(b))
+
+    def tearDown(self):
+        for mux in (self.sender, self.receiver):
+            if mux.con.connected:
+                mux.con.close()
+
+    def test_frames(self):
+        self.sender.window(STREAM_ID, 1024)
+        self.sender.length(STREAM_ID, 2 ** 40)
+        self.sender.data(STREAM_ID, b"data")
+        self.assertTrue(self.sender.buffered > 0)
+        self.sender.flush()
+        self.assertEqual(self.sender.buffered, 0)
+        self.assertTrue(self.sender.con.alive > 0)
+
+        frames = self.receiver.receive()
+        self.assertEqual([f[:2] for f in frames], [
+            (FRAME_WINDOW, STREAM_ID),
+            (FRAME_LENGTH, STREAM_ID),
+            (FRAME_DATA, STREAM_ID)
+        ])
+        self.assertEqual(frames[2][2], b"data")
+        self.assertEqual(self.receiver.receive(), [])
+
+    def test_partial_frame(self):
+        self.sender.data(STREAM_ID, b"x" * 1000)
+        raw = bytes(self.sender._outbuf)
+        self.sender.con.s.send(raw[:HEADER.size + 10])
+        self.assertEqual(self.receiver.receive(), [])
+        self.sender.con.s.send(raw[HEADER.size + 10:])
+        frames = self.receiver.receive()
+        self.assertEqual(frames, [(FRAME_DATA, STREAM_ID, b"x" * 1000)])
+
+    def test_invalid_frame_closes(self):
+        self.sender.con.s.send(HEADER.pack(99, b"\0" * 32, 0))
+        self.assertEqual(self.receiver.receive(), [])
+        self.assertFalse(self.receiver.con.connected)
+
+    def test_peer_closed(self):
+        self.sender.con.close()
+        self.receiver.receive()
+        self.assertFalse(self.receiver.con.connected)
+
+    def test_flush_partial(self):
+        # queue more than the socket buffers accept
+        while self.sender.buffered < 1024 * 1024 * 8:
+            self.sender.data(STREAM_ID, b"x" * 1024 * 1024)
+        queued = self.sender.buffered
+        sent = self.sender.flush()
+        self.assertTrue(0 < sent < queued)
+        self.assertEqual(self.sender.buffered, queued - sent)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import unittest
+from kademlia.node import Node
+from storjnode.network.nodeid import NodeId, distance, to_long
+
+
+class TestNodeId(unittest.TestCase):
+
+    def test_long_id(self):
+        nodeid = os.urandom(20)
+        self.assertEqual(to_long(nodeid), Node(nodeid).long_id)
+        self.assertEqual(NodeId(nodeid).long_id, Node(nodeid).long_id)
+        self.assertEqual(to_long(b"\0" * 20), 0)
+        self.assertEqual(to_long(b"\xff" * 20), 2 ** 160 - 1)
+
+    def test_distance(self):
+        a, b = os.urandom(20), os.urandom(20)
+        expected = Node(a).distanceTo(Node(b))
+        self.assertEqual(distance(a, b), expected)
+        self.assertEqual(distance(NodeId(a), b), expected)
+        self.assertEqual(distance(Node(a), NodeId(b)), expected)
+        self.assertEqual(NodeId(a).distanceTo(Node(b)), expected)
+        self.assertEqual(distance(a, a), 0)
+
+    def test_compact(self):
+        nodeid = NodeId(os.urandom(20))
+        self.assertFalse(hasattr(nodeid, "__dict__"))
+        self.assertEqual(nodeid, NodeId(nodeid.id))
+        self.assertNotEqual(nodeid, NodeId(os.urandom(20)))
+        self.assertEqual(len(set([nodeid, NodeId(nodeid.id)])), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
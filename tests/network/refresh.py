@@ -0,0 +1,125 @@
+import os
+import time
+import unittest
+from kademlia.node import Node
+from kademlia.routing import KBucket
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from storjnode.network.routing import StorjRoutingTable
+from storjnode.network.refresh import NeighbourRefresher, random_id_in
+
+
+class MockProtocol(object):
+
+    def __init__(self, node):
+        self.router = StorjRoutingTable(self, 20, node)
+        self.lookups = []
+
+    def callPing(self, node):
+        pass
+
+    def callFindNode(self, peer, node):
+        self.lookups.append(node.id)
+        return defer.succeed((True, []))
+
+
+class MockServer(object):
+
+    def __init__(self):
+        self.ksize = 20
+        self.alpha = 3
+        self.node = Node(os.urandom(20))
+        self.protocol = MockProtocol(self.node)
+
+
+class TestNeighbourRefresher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer()
+        self.router = self.server.protocol.router
+        self.clock = Clock()
+        self.refresher = NeighbourRefresher(self.server, 60.0,
+                                            clock=self.clock)
+        for i in range(100):
+            self._add_contact()
+        self._make_stale()
+
+    def _add_contact(self):
+        self.router.addContact(Node(os.urandom(20), "127.0.0.1", 1000))
+
+    def _make_stale(self):
+        for bucket in self.router.buckets:
+            bucket.lastUpdated = time.time() - 3600
+
+    def test_random_id_in(self):
+        for bucket in self.router.buckets:
+            nodeid = random_id_in(bucket)
+            self.assertEqual(len(nodeid), 20)
+            self.assertTrue(bucket.hasInRange(Node(nodeid)))
+
+        # upper bound of the last bucket is not a valid id
+        bucket = KBucket(2 ** 160 - 1, 2 ** 160, 20)
+        for i in range(8):
+            self.assertEqual(random_id_in(bucket), b"\xff" * 20)
+
+    def test_stale_buckets(self):
+        self.router.buckets[0].touchLastUpdated()
+        stale = self.refresher.get_stale_buckets()
+        self.assertEqual(len(stale), len(self.router.buckets) - 1)
+        self.assertFalse(self.router.buckets[0] in stale)
+
+        # refreshed buckets are not stale until the next refresh
+        self.refresher.refresh()
+        self.assertTrue(len(self.server.protocol.lookups) > 0)
+        self.assertEqual(self.refresher.get_stale_buckets(),
+                         [self.router.buckets[0]])
+        self.refresher.refresh()
+        self.assertEqual(len(self.refresher.get_stale_buckets()),
+                         len(self.router.buckets) - 1)
+
+    def test_backoff_when_stable(self):
+        self.refresher.start()
+        intervals = []
+        for i in range(6):
+            self.clock.advance(self.refresher.interval)
+            intervals.append(self.refresher.interval)
+        self.assertEqual(intervals, [60.0, 120.0, 240.0, 480.0, 480.0, 480.0])
+
+    def test_backoff_on_little_churn(self):
+        self.router.flush()
+        for i in range(15):
+            self._add_contact()
+        self.refresher.start()
+        self.clock.advance(60.0)  # first refresh records contacts
+        self._add_contact()
+        self.clock.advance(60.0)
+        self.assertEqual(self.refresher.interval, 120.0)
+
+    def test_speed_up_on_churn(self):
+        self.router.flush()
+        for i in range(10):
+            self._add_contact()
+        self.refresher.start()
+        self.clock.advance(60.0)  # first refresh records contacts
+        self._add_contact()
+        self.clock.advance(60.0)
+        self.assertEqual(self.refresher.interval, 30.0)
+        for i in range(3):  # no faster than a quarter of the interval
+            self._add_contact()
+            self._add_contact()
+            self.clock.advance(self.refresher.interval)
+        self.assertEqual(self.refresher.interval, 15.0)
+
+    def test_stop(self):
+        self.refresher.start()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.refresher.stop()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 0)
+
+        # refresh in progress does not schedule another
+        self.refresher.refresh()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
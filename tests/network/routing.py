@@ -0,0 +1,139 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from kademlia.node import Node
+from storjnode.network.routing import StorjRoutingTable
+from storjnode.network.routing import save_contacts, load_contacts
+
+
+class MockProtocol(object):
+
+    def __init__(self):
+        self.pinged = []
+
+    def callPing(self, node):
+        self.pinged.append(node)
+
+
+def random_node(port=None):
+    return Node(os.urandom(20), "127.0.0.1", port or random.randint(1, 2**16))
+
+
+def nearest(contacts, node, k):
+    """Brute force k nearest contacts."""
+    return sorted(contacts, key=lambda c: c.long_id ^ node.long_id)[:k]
+
+
+class TestStorjRoutingTable(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = MockProtocol()
+        self.table = StorjRoutingTable(self.protocol, 20, random_node())
+
+    def _get_contacts(self):
+        contacts = []
+        for bucket in self.table.buckets:
+            contacts.extend(bucket.getNodes())
+        return contacts
+
+    def test_exact_nearest(self):
+        for i in range(2000):
+            self.table.addContact(random_node())
+        contacts = self._get_contacts()
+        self.assertEqual(len(contacts), len(self.table._ids))
+        for i in range(50):
+            target = random_node()
+            for k in (1, 3, 20):
+                found = self.table.findNeighbors(target, k=k)
+                self.assertEqual(found, nearest(contacts, target, k))
+
+        # contacts near the own node, where buckets are split deepest
+        target = self.table.node
+        self.assertEqual(self.table.findNeighbors(target),
+                         nearest(contacts, target, 20))
+
+    def test_includes_target(self):
+        contact = random_node()
+        self.table.addContact(contact)
+        self.table.addContact(random_node())
+        self.assertEqual(self.table.findNeighbors(contact, k=1), [contact])
+
+    def test_exclude(self):
+        contacts = [random_node(port=1000 + i) for i in range(30)]
+        for contact in contacts:
+            self.table.addContact(contact)
+        excluded = contacts[0]
+        target = Node(excluded.id)
+        found = self.table.findNeighbors(target, k=5, exclude=excluded)
+        self.assertEqual(len(found), 5)
+        self.assertFalse(excluded in found)
+        expected = nearest([c for c in contacts if c is not excluded],
+                           target, 5)
+        self.assertEqual(found, expected)
+
+    def test_small_table(self):
+        self.assertEqual(self.table.findNeighbors(random_node()), [])
+        contact = random_node()
+        self.table.addContact(contact)
+        self.assertEqual(self.table.findNeighbors(random_node()), [contact])
+
+    def test_update_contact(self):
+        contact = random_node(port=1000)
+        self.table.addContact(contact)
+        moved = Node(contact.id, "127.0.0.1", 2000)
+        self.table.addContact(moved)
+        self.assertEqual(len(self.table._ids), 1)
+        self.assertTrue(self.table.findNeighbors(contact)[0] is moved)
+
+    def test_remove_contact(self):
+        for i in range(2000):
+            self.table.addContact(random_node())
+
+        # full buckets keep replacements that take removed contacts places
+        bucket = [b for b in self.table.buckets
+                  if len(b.replacementNodes) and not
+                  b.hasInRange(self.table.node)][0]
+        removed = list(bucket.getNodes())[0]
+        self.table.removeContact(removed)
+        contacts = self._get_contacts()
+        self.assertFalse(removed.long_id in self.table._nodes)
+        self.assertEqual(sorted(c.long_id for c in contacts),
+                         self.table._ids)
+        target = random_node()
+        self.assertEqual(self.table.findNeighbors(target),
+                         nearest(contacts, target, 20))
+
+    def test_flush(self):
+        self.table.addContact(random_node())
+        self.table.flush()
+        self.assertEqual(self.table.findNeighbors(random_node()), [])
+
+
+class TestContactsFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "new", "contacts.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_save_load(self):
+        contacts = [random_node(port=1000 + i) for i in range(10)]
+        save_contacts(self.path, contacts)
+        save_contacts(self.path, contacts)  # replaces existing
+        loaded = load_contacts(self.path)
+        self.assertEqual(loaded, [tuple(c) for c in contacts])
+
+    def test_load_missing_or_invalid(self):
+        self.assertEqual(load_contacts(self.path), [])
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as fp:
+            fp.write("{invalid")
+        self.assertEqual(load_contacts(self.path), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,286 @@
+import os
+import shutil
+import tempfile
+import unittest
+import btctxstore
+import storjnode
+from crochet import setup
+from kademlia.node import Node
+from kademlia.utils import digest
+from twisted.internet import defer
+
+
+setup()  # start twisted via crochet
+
+
+def near(nodeid, bit):
+    """Returns a node id differing from nodeid only in the given low bit."""
+    nodeid = bytearray(nodeid)
+    nodeid[-1] ^= 1 << bit
+    return bytes(nodeid)
+
+
+class TestRelayPool(unittest.TestCase):
+
+    def setUp(self):
+        key = btctxstore.BtcTxStore().create_wallet()
+        self.server = storjnode.network.StorjServer(key, max_relay_workers=2)
+        self.calls = []  # [(relay_node, dest, deferred)]
+
+        def call_relay_message(relay_node, dest, hop_limit, message):
+            d = defer.Deferred()
+            self.calls.append((relay_node, dest, d))
+            return d
+        self.server.protocol.callRelayMessage = call_relay_message
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _add_peer(self, nodeid, port):
+        self.server.protocol.router.addContact(Node(nodeid, "127.0.0.1", port))
+
+    def _queue(self, dest, message="test"):
+        self.server._relay_queue([{
+            "dest": dest, "message": message, "hop_limit": 4
+        }])
+
+    def _complete(self, call, success=True):
+        self.calls.remove(call)
+        call[2].callback((success, ("127.0.0.1", 1337) if success else None))
+
+    def test_max_workers(self):
+        dests = [os.urandom(20) for i in range(3)]
+        for i, dest in enumerate(dests):
+            self._add_peer(dest, 4000 + i)
+            self._queue(dest)
+        self.assertEqual([c[1] for c in self.calls], dests[:2])
+
+        # next entry started once a worker is free
+        self._complete(self.calls[0])
+        self.assertEqual([c[1] for c in self.calls], dests[1:])
+        while self.calls:
+            self._complete(self.calls[0])
+        self.assertEqual(len(self.server._relay_busy), 0)
+        self.assertEqual(len(self.server._relay_pending), 0)
+
+    def test_destination_order(self):
+        dest = os.urandom(20)
+        self._add_peer(dest, 4000)
+        self._queue(dest, message="first")
+        self._queue(dest, message="second")
+        self.assertEqual(len(self.calls), 1)
+        self._complete(self.calls[0])
+        self.assertEqual(len(self.calls), 1)
+        self._complete(self.calls[0])
+        self.assertEqual(len(self.server._relay_pending), 0)
+
+    def test_next_candidate(self):
+        dest = os.urandom(20)
+        self._add_peer(near(dest, 0), 4000)
+        self._add_peer(near(dest, 1), 4001)
+        self._queue(dest)
+        first = self.calls[0][0]
+        self.assertEqual(first.id, near(dest, 0))  # nearest first
+
+        # unreachable peer skipped
+        self._complete(self.calls[0], success=False)
+        self.assertEqual(self.calls[0][0].id, near(dest, 1))
+        self._complete(self.calls[0])
+        self.assertEqual(len(self.calls), 0)
+        self.assertEqual(len(self.server._relay_busy), 0)
+
+    def test_pending_limit(self):
+        self.server._max_messages = 2
+        dest = os.urandom(20)
+        self._add_peer(dest, 4000)
+        for i in range(4):
+            self._queue(dest, message=str(i))
+
+        # one relaying, two waiting, the last dropped
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual([e["message"] for e in self.server._relay_pending],
+                         ["1", "2"])
+
+    def test_no_candidates(self):
+        for i in range(4):
+            self._queue(os.urandom(20))
+        self.assertEqual(len(self.calls), 0)
+        self.assertEqual(len(self.server._relay_busy), 0)
+        self.assertEqual(len(self.server._relay_pending), 0)
+
+
+class TestBatchDHT(unittest.TestCase):
+
+    def setUp(self):
+        key = btctxstore.BtcTxStore().create_wallet()
+        self.server = storjnode.network.StorjServer(key, ksize=4)
+        self.network = [Node(os.urandom(20), "127.0.0.1", 5000 + i)
+                        for i in range(60)]
+        self.stored = {}  # dkey -> value
+        self.store_calls = []
+
+        def call_find_node(peer, node):
+            # peers know the whole network
+            nearest = self._nearest(node.id)
+            return defer.succeed((True, [tuple(n) for n in nearest]))
+
+        def call_find_value(peer, node):
+            if node.id in self.stored:
+                return defer.succeed((True, {"value": self.stored[node.id]}))
+            return defer.succeed((True, []))
+
+        def call_store(peer, dkey, value):
+            self.store_calls.append((peer, dkey, value))
+            self.stored[dkey] = value
+            return defer.succeed((True, True))
+
+        protocol = self.server.protocol
+        protocol.callPing = lambda node: defer.succeed((True, node.id))
+        protocol.callFindNode = call_find_node
+        protocol.callFindValue = call_find_value
+        protocol.callStore = call_store
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _add_peers(self, count):
+        for node in self.network[:count]:
+            self.server.protocol.router.addContact(node)
+
+    def _nearest(self, nodeid):
+        target = Node(nodeid)
+        nodes = sorted(self.network, key=lambda n: n.distanceTo(target))
+        return nodes[:self.server.ksize]
+
+    def _result(self, d):
+        results = []
+        d.addCallback(results.append)
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def test_set_many_stores_on_nearest(self):
+        self._add_peers(8)
+        items = dict(("key%i" % i, "value%i" % i) for i in range(10))
+        stored = self._result(self.server.set_many(items))
+        self.assertEqual(stored, dict((k, True) for k in items))
+
+        # every key stored on the nodes nearest to it
+        for key in items:
+            dkey = digest(key)
+            found = set(peer.id for peer, k, v in self.store_calls
+                        if k == dkey)
+            expected = set(n.id for n in self._nearest(dkey))
+            self.assertEqual(found, expected)
+
+    def test_set_many_without_neighbours(self):
+        stored = self._result(self.server.set_many([("a", 1), ("b", 2)]))
+        self.assertEqual(stored, {"a": False, "b": False})
+        self.assertEqual(len(self.store_calls), 0)
+
+    def test_get_many(self):
+        self._add_peers(5)
+        self._result(self.server.set_many({"a": 1, "b": 2}))
+        values = self._result(self.server.get_many(["a", "b", "missing"]))
+        self.assertEqual(values, {"a": 1, "b": 2, "missing": None})
+
+
+class TestRoutingTablePersistence(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "routing_table.json")
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tempdir)
+
+    def _create_server(self):
+        key = btctxstore.BtcTxStore().create_wallet()
+        server = storjnode.network.StorjServer(key,
+                                               routing_table_path=self.path)
+        self.servers.append(server)
+        return server
+
+    def test_warm_bootstrap(self):
+        contacts = [Node(os.urandom(20), "127.0.0.1", 6000 + i)
+                    for i in range(10)]
+        server = self._create_server()
+        for contact in contacts:
+            server.protocol.router.addContact(contact)
+        server.save_routing_table()
+
+        # restarted node pings all saved contacts at once
+        alive = dict((c.port, c.id) for c in contacts[:6])
+        pinged = []
+        server = self._create_server()
+        protocol = server.protocol
+
+        def ping(addr, nodeid):
+            pinged.append(addr)
+            if addr[1] in alive:
+                return defer.succeed((True, alive[addr[1]]))
+            return defer.succeed((False, None))
+
+        protocol.transport = object()
+        protocol.ping = ping
+        protocol.callFindNode = lambda peer, node: defer.succeed((True, []))
+        server.bootstrap([])
+        self.assertEqual(len(pinged), 10)
+        found = [c.id for c in server.get_known_peers()]
+        self.assertEqual(sorted(found), sorted(alive.values()))
+
+        # saved contacts only used once
+        server.bootstrap([])
+        self.assertEqual(len(pinged), 10)
+
+    def test_nothing_saved(self):
+        server = self._create_server()
+        server.save_routing_table()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestReadiness(unittest.TestCase):
+
+    def setUp(self):
+        key = btctxstore.BtcTxStore().create_wallet()
+        self.server = storjnode.network.StorjServer(key)
+        self.server.protocol.transport = object()
+        self.server.protocol.callFindNode = \
+            lambda peer, node: defer.succeed((True, []))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _add_peer(self, port):
+        self.server.protocol.router.addContact(
+            Node(os.urandom(20), "127.0.0.1", port)
+        )
+
+    def test_min_peers(self):
+        results = []
+        self.server.when_ready(min_peers=3).addCallback(results.append)
+        self._add_peer(5000)
+        self._add_peer(5001)
+        self.assertEqual(results, [])
+        self.assertFalse(self.server.is_ready(min_peers=3))
+        self._add_peer(5002)
+        self.assertEqual(results, [3])
+        self.assertTrue(self.server.is_ready(min_peers=3))
+
+        # already ready
+        self.server.when_ready(min_peers=3).addCallback(results.append)
+        self.assertEqual(results, [3, 3])
+
+    def test_bootstrapped(self):
+        results = []
+        self.server.when_ready(min_peers=3).addCallback(results.append)
+        self.server.bootstrap([])  # nothing found
+        self.assertEqual(results, [])
+        self._add_peer(5000)  # ready once any peer known
+        self.assertEqual(results, [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+import storjnode
+from crochet import setup
+from twisted.internet import defer
+from storjnode.network.swarm import SwarmDownload
+from storjnode.network.file_transfer import TransferError
+
+
+setup()  # deferToThread needs a running reactor
+
+
+PIECE_SIZE = 1024
+DATA = os.urandom(PIECE_SIZE * 4 + 100)
+DATA_ID = hashlib.sha256(DATA).hexdigest()
+
+
+class MockClient(object):
+
+    def __init__(self, store):
+        self.store = store
+        self.downloading = {}
+        self.swarms = {}
+        self.success_value = ("127.0.0.1", 1337)
+        self.requests = []  # [(peer_unl, offset, length, deferred)]
+        self.failing = set()
+
+    def data_request(self, action, data_id, file_size, node_unl,
+                     offset=None, length=None):
+        assert(action == u"download")
+        if node_unl in self.failing:
+            raise Exception("Unreachable peer.")
+        d = defer.Deferred()
+        self.requests.append((node_unl, offset, length, d))
+        return d
+
+    def close_data_handles(self, data_id):
+        pass
+
+    def complete(self, request, data=DATA):
+        """Write a requested piece and fire its deferred."""
+        self.requests.remove(request)
+        peer_unl, offset, length, d = request
+        path = self.downloading.get(DATA_ID)
+        if path is not None:  # else a late duplicate
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                f.seek(offset)
+                f.write(data[offset:offset + length])
+        d.callback(self.success_value)
+
+    def fail(self, request):
+        self.requests.remove(request)
+        request[3].errback(TransferError("Connection lost."))
+
+    def get_requests(self, peer_unl):
+        return [r for r in self.requests if r[0] == peer_unl]
+
+
+class TestSwarmDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.store = storjnode.storage.manager.Store({self.base_dir: None})
+        self.client = MockClient(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _start(self, peers, max_pending=1):
+        self.swarm = SwarmDownload(self.client, DATA_ID, peers, len(DATA),
+                                   piece_size=PIECE_SIZE,
+                                   max_pending=max_pending)
+        self.results = []
+        self.finished = threading.Event()
+
+        def on_done(result):
+            self.results.append(result)
+            self.finished.set()
+        self.swarm.start().addBoth(on_done)
+
+    def _wait(self):
+        self.assertTrue(self.finished.wait(10))
+        return self.results[0]
+
+    def test_assemble(self):
+        self._start([u"a", u"b"])
+        self.assertEqual(len(self.client.get_requests(u"a")), 1)
+        self.assertEqual(len(self.client.get_requests(u"b")), 1)
+        while self.client.requests:
+            self.client.complete(self.client.requests[0])
+        self.assertEqual(self._wait(), self.client.success_value)
+
+        # verified and moved into storage
+        path = self.store.find(DATA_ID)
+        with open(path, "rb") as shard:
+            self.assertEqual(shard.read(), DATA)
+        self.assertEqual(self.client.downloading, {})
+        self.assertEqual(self.client.swarms, {})
+
+    def test_fast_peer_gets_more(self):
+        self._start([u"fast", u"slow"])
+        offsets = []
+        for i in range(4):
+            request = self.client.get_requests(u"fast")[0]
+            offsets.append(request[1])
+            self.client.complete(request)
+
+        # slow peer still holds its first piece
+        slow_request = self.client.get_requests(u"slow")[0]
+        self.assertEqual(sorted(offsets + [slow_request[1]]),
+                         [0, 1024, 2048, 3072, 4096])
+
+        # endgame: the slow peers piece is also requested from the fast
+        fast_request = self.client.get_requests(u"fast")[0]
+        self.assertEqual(fast_request[1:3], slow_request[1:3])
+        self.client.complete(fast_request)
+        self.assertEqual(self._wait(), self.client.success_value)
+
+        # late duplicate is ignored
+        slow_request[3].callback(self.client.success_value)
+        self.assertEqual(len(self.results), 1)
+
+    def test_failed_peer_dropped(self):
+        self._start([u"good", u"bad"])
+        for i in range(2):
+            self.client.fail(self.client.get_requests(u"bad")[0])
+        self.assertFalse(u"bad" in self.swarm.peers)
+        self.assertEqual(self.client.get_requests(u"bad"), [])
+
+        # failed pieces were requested again
+        while self.client.requests:
+            self.client.complete(self.client.requests[0])
+        self.assertEqual(self._wait(), self.client.success_value)
+
+    def test_no_peers_left(self):
+        self.client.failing.add(u"a")
+        self._start([u"a"])
+        self.assertTrue(isinstance(self._wait().value, TransferError))
+        self.assertEqual(self.client.downloading, {})
+
+    def test_hash_mismatch(self):
+        self._start([u"a"], max_pending=8)
+        path = self.client.downloading[DATA_ID]
+        corrupt = b"x" * len(DATA)
+        while self.client.requests:
+            self.client.complete(self.client.requests[0], data=corrupt)
+        self.assertTrue(isinstance(self._wait().value, TransferError))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.store.find(DATA_ID), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 from . shard import *  # NOQA
 from . manager import *  # NOQA
+from . index import *  # NOQA
 
 
 if __name__ == "__main__":
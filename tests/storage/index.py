@@ -0,0 +1,121 @@
+import os
+import shutil
+import unittest
+import tempfile
+import storjnode
+
+
+SHARD_PATH = storjnode.util.full_path(
+    os.path.join(os.path.dirname(__file__), "test.shard")
+)
+SHARD_ID = "61f21f335c9ef06cac682c0b4de8a8786883e15adea8546bf8ff1dff000189d3"
+
+
+class TestShardIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.store_path = os.path.realpath(
+            os.path.join(self.base_dir, "store")
+        )
+        self.store_config = {self.store_path: None}
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _add_shard(self):
+        with open(SHARD_PATH, "rb") as shard:
+            return storjnode.storage.manager.add(self.store_config, shard)
+
+    def test_add_indexed(self):
+        save_path = self._add_shard()
+        index = storjnode.storage.index.get_index(self.store_path)
+        self.assertTrue(SHARD_ID in index)
+        self.assertEqual(index.get(SHARD_ID), save_path)
+
+    def test_find_without_filesystem(self):
+        save_path = self._add_shard()
+        os.remove(save_path)  # removed behind the managers back
+
+        # find is answered by the index alone
+        found = storjnode.storage.manager.find(self.store_config, SHARD_ID)
+        self.assertEqual(found, save_path)
+
+        # open notices and forgets the missing shard
+        def callback():
+            storjnode.storage.manager.open(self.store_config, SHARD_ID)
+        self.assertRaises(KeyError, callback)
+        found = storjnode.storage.manager.find(self.store_config, SHARD_ID)
+        self.assertEqual(found, None)
+
+    def test_persistent(self):
+        save_path = self._add_shard()
+        index = storjnode.storage.index.ShardIndex(self.store_path)
+        self.assertEqual(index.get(SHARD_ID), save_path)
+
+        storjnode.storage.manager.remove(self.store_config, SHARD_ID)
+        index = storjnode.storage.index.ShardIndex(self.store_path)
+        self.assertFalse(SHARD_ID in index)
+
+    def test_rebuild(self):
+        storjnode.storage.manager.setup(self.store_config)
+        found = storjnode.storage.manager.find(self.store_config, SHARD_ID)
+        self.assertEqual(found, None)
+
+        shard_path = os.path.join(self.store_path, SHARD_ID)
+        shutil.copyfile(SHARD_PATH, shard_path)  # added behind managers back
+        found = storjnode.storage.manager.find(self.store_config, SHARD_ID)
+        self.assertEqual(found, None)
+
+        storjnode.storage.manager.rebuild_index(self.store_config)
+        found = storjnode.storage.manager.find(self.store_config, SHARD_ID)
+        self.assertEqual(found, shard_path)
+
+    def test_rebuild_if_corrupt(self):
+        save_path = self._add_shard()
+        index = storjnode.storage.index.get_index(self.store_path)
+        with open(index.path, "a") as journal:
+            journal.write("[\"+\", \"trunc")  # interrupted write
+        index = storjnode.storage.index.ShardIndex(self.store_path)
+        self.assertEqual(index.get(SHARD_ID), save_path)
+
+    def test_usage_ledger(self):
+        index = storjnode.storage.index.get_index(self.store_path)
+        self.assertEqual(index.used, 0)
+        self._add_shard()
+        self.assertEqual(index.used, 1024)
+        self.assertEqual(len(index), 1)
+        storjnode.storage.manager.remove(self.store_config, SHARD_ID)
+        self.assertEqual(index.used, 0)
+        self.assertEqual(len(index), 0)
+
+    def test_reconcile(self):
+        save_path = self._add_shard()
+        index = storjnode.storage.index.get_index(self.store_path)
+
+        # shard changed behind the managers back
+        with open(save_path, "ab") as fobj:
+            fobj.write(b"x" * 1024)
+        self.assertEqual(index.reconcile(), 1)
+        self.assertEqual(index.used, 2048)
+
+        # shard removed behind the managers back
+        os.remove(save_path)
+        index.reconcile_in_background().join()
+        self.assertEqual(index.used, 0)
+        self.assertFalse(SHARD_ID in index)
+        self.assertEqual(index.reconcile(), 0)
+
+    def test_compact(self):
+        self._add_shard()
+        index = storjnode.storage.index.get_index(self.store_path)
+        for i in range(storjnode.storage.index.COMPACT_MIN_RECORDS):
+            index.remove(SHARD_ID)
+            self._add_shard()
+        with open(index.path, "r") as journal:
+            self.assertTrue(len(journal.readlines()) < 4)
+        self.assertTrue(SHARD_ID in index)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,6 @@
 import os
+import io
+import errno
 import filecmp
 import shutil
 import unittest
@@ -100,6 +102,25 @@ class TestManager(unittest.TestCase):
             relative_path = save_path[len(store_path)+1:]
             self.assertEqual(len(relative_path.split(os.path.sep)), 23)
 
+    def test_add_file_like(self):
+        store_path = os.path.join(self.base_dir, "mu")
+        with open(SHARD_PATH, "rb") as shard:
+            shard_id = storjnode.storage.shard.get_id(shard)
+            shard.seek(0)
+            data = shard.read()
+
+        # hashed while copied into the store
+        save_path = storjnode.storage.manager.add({store_path: None},
+                                                  io.BytesIO(data))
+        self.assertEqual(os.path.basename(save_path), shard_id)
+        self.assertTrue(filecmp.cmp(SHARD_PATH, save_path, shallow=False))
+        self.assertEqual(os.listdir(store_path).count(shard_id), 1)
+
+        # no leftover temp file if already stored
+        storjnode.storage.manager.add({store_path: None}, io.BytesIO(data))
+        self.assertEqual(sorted(os.listdir(store_path)),
+                         sorted([shard_id, ".shard_index"]))
+
     def test_remove(self):
         with open(SHARD_PATH, "rb") as shard:
             store_path = os.path.join(self.base_dir, "eta")
@@ -126,5 +147,160 @@ class TestManager(unittest.TestCase):
         self.assertRaises(KeyError, callback)
 
 
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.store_config = {os.path.join(self.base_dir, "kappa"): None}
+        self._get_free_space = storjnode.util.get_free_space
+
+    def tearDown(self):
+        storjnode.util.get_free_space = self._get_free_space
+        shutil.rmtree(self.base_dir)
+
+    def test_get_store_memoized(self):
+        store = storjnode.storage.manager.get_store(self.store_config)
+        same_config = {os.path.join(self.base_dir, "kappa"): None}
+        self.assertTrue(
+            store is storjnode.storage.manager.get_store(same_config)
+        )
+        other_config = {os.path.join(self.base_dir, "lambda"): None}
+        self.assertFalse(
+            store is storjnode.storage.manager.get_store(other_config)
+        )
+
+    def test_normalized_config(self):
+        store = storjnode.storage.manager.Store(self.store_config)
+        store_path = os.path.realpath(os.path.join(self.base_dir, "kappa"))
+        self.assertEqual(list(store.config.keys()), [store_path])
+        self.assertTrue("fs_type" in store.config[store_path])
+
+    def test_free_space_ttl(self):
+        calls = []
+
+        def get_free_space(path):
+            calls.append(path)
+            return self._get_free_space(path)
+        storjnode.util.get_free_space = get_free_space
+
+        store = storjnode.storage.manager.Store(self.store_config,
+                                                free_space_ttl=3600)
+        store_path = list(store.config.keys())[0]
+        del calls[:]  # ignore setup
+        free = store.get_free_space(store_path)
+        with open(SHARD_PATH, "rb") as shard:
+            store.add(shard)
+        self.assertEqual(len(calls), 1)  # cached
+        self.assertEqual(store.get_free_space(store_path), free - 1024)
+
+        store.free_space_ttl = 0.0
+        store.get_free_space(store_path)
+        self.assertEqual(len(calls), 2)  # refreshed
+
+    def test_move(self):
+        store = storjnode.storage.manager.Store(self.store_config)
+        store_path = list(store.config.keys())[0]
+        temp_path = store.create_temp_file()
+        self.assertEqual(os.path.dirname(temp_path), store_path)
+        shutil.copyfile(SHARD_PATH, temp_path)
+        with open(SHARD_PATH, "rb") as shard:
+            shard_id = storjnode.storage.shard.get_id(shard)
+
+        save_path = store.move(temp_path, shard_id)
+        self.assertFalse(os.path.exists(temp_path))
+        self.assertEqual(store.find(shard_id), save_path)
+        self.assertEqual(store.get_used_space(store_path), 1024)
+        self.assertTrue(filecmp.cmp(SHARD_PATH, save_path, shallow=False))
+
+        # already stored
+        temp_path = store.create_temp_file()
+        self.assertEqual(store.move(temp_path, shard_id), save_path)
+        self.assertFalse(os.path.exists(temp_path))
+
+    def _move_cross_device(self, store, path, shard_id):
+        rename = os.rename
+
+        def cross_device_rename(src, dst):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        os.rename = cross_device_rename
+        try:
+            return store.move(path, shard_id)
+        finally:
+            os.rename = rename
+
+    def test_move_free_space(self):
+        storjnode.util.get_free_space = lambda path: 1536
+        store = storjnode.storage.manager.Store(self.store_config,
+                                                free_space_ttl=3600)
+        store_path = list(store.config.keys())[0]
+        with open(SHARD_PATH, "rb") as shard:
+            shard_id = storjnode.storage.shard.get_id(shard)
+
+        # space used once when the temp file is created, not when moved
+        temp_path = store.create_temp_file(size=1024)
+        self.assertEqual(store.get_free_space(store_path), 512)
+        shutil.copyfile(SHARD_PATH, temp_path)
+        store.move(temp_path, shard_id)
+        self.assertEqual(store.get_free_space(store_path), 512)
+        store.remove(shard_id)
+        self.assertEqual(store.get_free_space(store_path), 1536)
+
+        # copied from another filesystem
+        other_path = os.path.join(self.base_dir, "other.shard")
+        shutil.copyfile(SHARD_PATH, other_path)
+        self._move_cross_device(store, other_path, shard_id)
+        self.assertEqual(store.get_free_space(store_path), 512)
+        self.assertFalse(os.path.exists(other_path))
+        store.remove(shard_id)
+
+        # not copied if the space is reserved
+        temp_path = store.create_temp_file(size=1024)
+        shutil.copyfile(SHARD_PATH, other_path)
+        self.assertRaises(MemoryError, self._move_cross_device, store,
+                          other_path, shard_id)
+        self.assertTrue(os.path.exists(other_path))
+        self.assertEqual(store.get_free_space(store_path), 512)
+        self.assertRaises(MemoryError, store.create_temp_file, size=1024)
+
+        # released when the temp file is removed
+        store.remove_temp_file(temp_path)
+        self.assertFalse(os.path.exists(temp_path))
+        self.assertEqual(store.get_free_space(store_path), 1536)
+
+    def test_partial_file(self):
+        store = storjnode.storage.manager.Store(self.store_config,
+                                                free_space_ttl=3600)
+        store_path = list(store.config.keys())[0]
+        with open(SHARD_PATH, "rb") as shard:
+            shard_id = storjnode.storage.shard.get_id(shard)
+        self.assertEqual(store.find_partial(shard_id), None)
+        free = store.get_free_space(store_path)
+        partial_path = store.create_partial_file(shard_id, size=1024)
+        self.assertEqual(store.get_free_space(store_path), free - 1024)
+        with open(partial_path, "ab") as partial:
+            partial.write(b"data")
+
+        # found again and kept, but not indexed as a shard
+        self.assertEqual(store.find_partial(shard_id), partial_path)
+        self.assertEqual(store.create_partial_file(shard_id), partial_path)
+        self.assertEqual(os.path.getsize(partial_path), 4)
+        store.rebuild_index()
+        self.assertEqual(store.find(shard_id), None)
+
+    def test_find_add_remove_open(self):
+        store = storjnode.storage.manager.Store(self.store_config)
+        with open(SHARD_PATH, "rb") as shard:
+            shard_id = storjnode.storage.shard.get_id(shard)
+            self.assertEqual(store.find(shard_id), None)
+            save_path = store.add(shard)
+            self.assertEqual(store.find(shard_id), save_path)
+            with store.open(shard_id) as retreived:
+                shard.seek(0)
+                self.assertEqual(shard.read(), retreived.read())
+            store.remove(shard_id)
+            self.assertEqual(store.find(shard_id), None)
+            self.assertFalse(os.path.isfile(save_path))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,5 +1,9 @@
 import os
+import io
+import sys
+import shutil
 import filecmp
+import hashlib
 import tempfile
 import unittest
 import storjnode
@@ -59,12 +63,89 @@ class TestShard(unittest.TestCase):
         result = storjnode.storage.shard.get_hash(self.shard, salt=b"salt")
         self.assertEqual(result, h)
 
+    def test_get_hash_blocks(self):
+        # expected hash h obtained from sha256sum (GNU coreutils 8.21)
+        h = "61f21f335c9ef06cac682c0b4de8a8786883e15adea8546bf8ff1dff000189d3"
+        for block_size in [1, 7, 1023, 1024, 1025]:
+            result = storjnode.storage.shard.get_hash(self.shard,
+                                                      block_size=block_size)
+            self.assertEqual(result, h)
+
+    def test_iter_blocks(self):
+        blocks = list(storjnode.storage.shard.iter_blocks(self.shard, 100))
+        self.assertEqual(len(blocks), 11)
+        self.assertTrue(all(len(block) <= 100 for block in blocks))
+        self.shard.seek(0)
+        self.assertEqual(b"".join(blocks), self.shard.read())
+
     def test_save(self):
         save_path = tempfile.mktemp()
         storjnode.storage.shard.save(self.shard, save_path)
-        filecmp.cmp(SHARD_PATH, save_path)
+        self.assertTrue(filecmp.cmp(SHARD_PATH, save_path, shallow=False))
         os.remove(save_path)
 
+    def test_save_hashed(self):
+        # expected hash h obtained from sha256sum (GNU coreutils 8.21)
+        h = "61f21f335c9ef06cac682c0b4de8a8786883e15adea8546bf8ff1dff000189d3"
+        save_path = tempfile.mktemp()
+        hasher = hashlib.sha256()
+        storjnode.storage.shard.save(self.shard, save_path, hasher=hasher)
+        self.assertEqual(hasher.hexdigest(), h)
+        self.assertTrue(filecmp.cmp(SHARD_PATH, save_path, shallow=False))
+        os.remove(save_path)
+
+    def test_save_link(self):
+        save_path = os.path.join(tempfile.mkdtemp(), "shard")
+        storjnode.storage.shard.save(self.shard, save_path, link=True)
+        self.assertTrue(filecmp.cmp(SHARD_PATH, save_path, shallow=False))
+        os.remove(save_path)
+        os.rmdir(os.path.dirname(save_path))
+
+    def test_save_link_unicode_path(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            src_path = os.path.join(tempdir, "src")
+            save_path = os.path.join(tempdir, "shard")
+            with open(src_path, "wb") as src:
+                src.write(self.shard.read())
+            with open(u"" + src_path, "rb") as src:
+                storjnode.storage.shard.save(src, save_path, link=True)
+            self.assertEqual(os.stat(save_path).st_ino,
+                             os.stat(src_path).st_ino)
+        finally:
+            shutil.rmtree(tempdir)
+
+    @unittest.skipIf(not sys.platform.startswith("linux"), "linux only")
+    def test_kernel_copy(self):
+        size = storjnode.storage.shard.get_size(self.shard)
+        with tempfile.TemporaryFile() as dest:
+            copied = storjnode.storage.shard._kernel_copy(
+                self.shard.fileno(), dest.fileno(), size
+            )
+            self.assertTrue(copied)
+            dest.seek(0)
+            self.shard.seek(0)
+            self.assertEqual(dest.read(), self.shard.read())
+
+        # sendfile of python 2, copies from an offset
+        sendfile = storjnode.storage.shard._libc_sendfile
+        with tempfile.TemporaryFile() as dest:
+            self.assertEqual(sendfile(dest.fileno(), self.shard.fileno(),
+                                      1000, 100), 24)
+            dest.seek(0)
+            self.shard.seek(1000)
+            self.assertEqual(dest.read(), self.shard.read())
+            self.assertRaises(OSError, sendfile, -1, self.shard.fileno(),
+                              0, 1)
+
+    def test_copy_file_like(self):
+        self.shard.seek(0)
+        src = io.BytesIO(self.shard.read())
+        dest = io.BytesIO()
+        self.assertFalse(storjnode.storage.shard.has_fileno(src))
+        storjnode.storage.shard.copy(src, dest, block_size=100)
+        self.assertEqual(dest.getvalue(), src.getvalue())
+
 
 if __name__ == "__main__":
     unittest.main()
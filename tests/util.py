@@ -1,4 +1,5 @@
 import unittest
+import threading
 import storjnode
 try:
     from Queue import Queue, Full  # py2
@@ -102,6 +103,37 @@ class TestEmptyQueue(unittest.TestCase):
          self.assertTrue(q.empty())  # queue now empty
 
 
+class TestWaitForQueue(unittest.TestCase):
+
+    def test_wait_for_queue(self):
+        q = Queue()
+        self.assertEqual(storjnode.util.wait_for_queue(q, 0.01), [])
+        q.put(1)
+        q.put(2)
+        self.assertEqual(storjnode.util.wait_for_queue(q, 0.01), [1, 2])
+        self.assertTrue(q.empty())
+
+    def test_wake_queue(self):
+        q = Queue()
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(
+                storjnode.util.wait_for_queue(q, 10.0)
+            )
+        )
+        thread.start()
+        storjnode.util.wake_queue(q)
+        thread.join(5.0)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results, [[]])  # wake entries dropped
+
+        # full queues wake waiters anyway
+        q = Queue(maxsize=1)
+        q.put(1)
+        storjnode.util.wake_queue(q)
+        self.assertEqual(storjnode.util.wait_for_queue(q, 0.01), [1])
+
+
 class TestEnsurePathExists(unittest.TestCase):
 
     def test_creates_for_nonexisting(path):